@@ -1,20 +1,44 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, WebSocket, WebSocketDisconnect, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, WebSocket, WebSocketDisconnect, Query, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, PlainTextResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
-from pydantic import BaseModel, Field, EmailStr
+from typing import Optional, List, Dict, Any, Union, Literal, Annotated, Collection, Tuple
+from collections import OrderedDict
+from pydantic import BaseModel, Field, EmailStr, TypeAdapter, ValidationError
+from PIL import Image, ImageOps
 import os
 import logging
 import uuid
 import json
+import time
+import base64
+import bisect
+import gzip
+import hashlib
+import unicodedata
+import re
+import orjson
 import asyncio
+import sys
+import threading
+import traceback
 from pathlib import Path
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from starlette.datastructures import FormData, Headers, MutableHeaders, UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
+
+try:
+    import brotli
+except ImportError:  # optional; compressed responses fall back to gzip
+    brotli = None
 
 # Load environment variables
 ROOT_DIR = Path(__file__).parent
@@ -28,53 +52,1012 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24  # 30 days
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
+# bcrypt takes 100-300 ms per call; it runs on a dedicated pool so it never blocks
+# the event loop. Requests beyond the pending limit are rejected with 503.
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "4"))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", "64"))
+password_hash_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash"
+)
+password_hash_pending = 0
+
+# Metrics: in-process histograms rendered in the Prometheus text format by
+# /api/metrics. pymongo reports command timings from its own threads, so
+# observations take a lock.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+metrics_registry: List["Histogram"] = []
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> per-bucket counts (the last one is +Inf) followed by the sum
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in snapshot:
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                total += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames + ('le',), labels + (le,))} {total}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {total}")
+        return lines
+
+def render_gauge(name: str, documentation: str, samples: List[tuple], labelnames: tuple = ()) -> List[str]:
+    """samples: (label values, value) pairs."""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+    lines.extend(f"{name}{format_labels(labelnames, labels)} {value}" for labels, value in samples)
+    return lines
+
+http_request_seconds = Histogram(
+    "messenger_http_request_duration_seconds", "HTTP request latency by route template.",
+    ("method", "route", "status")
+)
+mongo_command_seconds = Histogram(
+    "messenger_mongo_command_duration_seconds", "MongoDB command latency by collection and command.",
+    ("collection", "command", "outcome")
+)
+fanout_seconds = Histogram(
+    "messenger_ws_fanout_duration_seconds", "Time to publish one message event to its conversation.",
+    ("path",)
+)
+ws_send_seconds = Histogram("messenger_ws_send_duration_seconds", "Duration of one WebSocket frame send.")
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command the client sends; the collection comes from the started event."""
+
+    def __init__(self):
+        self._collections: Dict[tuple, str] = {}
+
+    def started(self, event):
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event):
+        self._record(event, "ok")
+
+    def failed(self, event):
+        self._record(event, "error")
+
+    def _record(self, event, outcome: str):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        mongo_command_seconds.observe(event.duration_micros / 1_000_000, collection, event.command_name, outcome)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandMetrics()])
 db = client[os.environ['DB_NAME']]
 
+# Fields never returned to clients: the password hash, search keys and presence refcount
+USER_PUBLIC_PROJECTION = {
+    "password_hash": 0, "search_tokens": 0, "search_prefixes": 0, "search_grams": 0, "presence_workers": 0
+}
+
+# Membership removals are kept this long for /sync; older cursors must reload
+SYNC_RETENTION_DAYS = int(os.environ.get("SYNC_RETENTION_DAYS", "30"))
+
+# Indexes required by the query shapes below: (collection, keys, options).
+# Every find/sort in the routes must be served by one of these;
+# tests/test_query_plans.py verifies that with explain().
+INDEX_SPECS = [
+    ("users", [("id", ASCENDING)], {"unique": True}),
+    ("users", [("username", ASCENDING)], {"unique": True}),
+    ("users", [("email", ASCENDING)], {"unique": True}),
+    ("users", [("search_tokens", ASCENDING), ("username", ASCENDING)], {}),
+    ("users", [("search_prefixes", ASCENDING), ("username", ASCENDING)], {}),
+    ("users", [("search_grams", ASCENDING), ("username", ASCENDING)], {}),
+    ("users", [("presence_workers", ASCENDING)], {}),
+    ("presence_workers", [("id", ASCENDING)], {"unique": True}),
+    ("presence_workers", [("expires_at", ASCENDING)], {}),
+    ("messages", [("id", ASCENDING)], {"unique": True}),
+    ("messages", [("sender_id", ASCENDING), ("client_id", ASCENDING)],
+     {"unique": True, "partialFilterExpression": {"client_id": {"$type": "string"}}}),
+    ("messages", [("conversation_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)], {}),
+    ("messages", [("conversation_id", ASCENDING), ("seq", ASCENDING)], {}),
+    ("message_terms", [("term", ASCENDING), ("conversation_id", ASCENDING),
+                       ("timestamp", DESCENDING), ("message_id", DESCENDING)], {}),
+    ("message_terms", [("message_id", ASCENDING), ("term", ASCENDING)], {"unique": True}),
+    ("conversations", [("id", ASCENDING)], {"unique": True}),
+    ("conversations", [("participant_ids", ASCENDING), ("updated_at", DESCENDING), ("id", DESCENDING)], {}),
+    ("conversations", [("participant_ids", ASCENDING), ("seq", ASCENDING)], {}),
+    ("conversation_members", [("conversation_id", ASCENDING), ("user_id", ASCENDING)], {"unique": True}),
+    ("conversation_members", [("user_id", ASCENDING), ("conversation_id", ASCENDING)], {}),
+    ("read_receipts", [("conversation_id", ASCENDING), ("user_id", ASCENDING)], {"unique": True}),
+    ("sync_removals", [("user_id", ASCENDING), ("seq", ASCENDING)], {}),
+    ("sync_removals", [("removed_at", ASCENDING)],
+     {"expireAfterSeconds": SYNC_RETENTION_DAYS * 86400}),
+]
+
 # Create the main app
-app = FastAPI(title="Messenger API")
+app = FastAPI(title="Messenger API", default_response_class=ORJSONResponse)
 api_router = APIRouter(prefix="/api")
 
 # WebSocket connection manager
-class ConnectionManager:
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", "256"))
+# What to do when a client cannot keep up: "drop_oldest" discards the oldest
+# queued frame, "disconnect" closes the slow consumer so it can resync.
+WS_OVERFLOW_POLICY = os.environ.get("WS_OVERFLOW_POLICY", "drop_oldest")
+# Connections opened with ?batch=1 get the events produced within this window
+# sent together as one JSON array frame: one send, syscall and TLS record per
+# burst instead of per event, and a better permessage-deflate ratio.
+WS_COALESCE_MS = float(os.environ.get("WS_COALESCE_MS", "5"))
+WS_COALESCE_MAX_FRAMES = int(os.environ.get("WS_COALESCE_MAX_FRAMES", "64"))
+# Sockets that have not sent a valid auth frame within this many seconds are closed
+WS_AUTH_TIMEOUT = float(os.environ.get("WS_AUTH_TIMEOUT", "10"))
+# Offered to clients that request it in the handshake (uvicorn run below)
+WS_PER_MESSAGE_DEFLATE = os.environ.get("WS_PER_MESSAGE_DEFLATE", "1") == "1"
+
+def encode_frame(message: dict) -> str:
+    """Serialize a WebSocket event; datetimes are encoded as ISO 8601 strings."""
+    return orjson.dumps(message).decode()
+
+class ClientConnection:
+    """A WebSocket with its own bounded outbound queue, drained by a writer task."""
+
+    def __init__(self, websocket: WebSocket, user_id: str, connection_id: str, queue_size: int,
+                 coalesce_ms: float = 0):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.connection_id = connection_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped_frames = 0
+        self.coalesce = coalesce_ms / 1000
+        self.sends = 0
+        self.writer: Optional[asyncio.Task] = None
+
+    async def run_writer(self, manager: "ConnectionManager"):
+        try:
+            while True:
+                message = await self.queue.get()
+                if self.coalesce:
+                    await asyncio.sleep(self.coalesce)
+                    frames = [message]
+                    while len(frames) < WS_COALESCE_MAX_FRAMES and not self.queue.empty():
+                        frames.append(self.queue.get_nowait())
+                    # Frames are already-encoded JSON, so the array is built by joining
+                    message = f"[{','.join(frames)}]"
+                started = time.perf_counter()
+                await self.websocket.send_text(message)
+                ws_send_seconds.observe(time.perf_counter() - started)
+                self.sends += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info("WebSocket %s send failed, dropping connection: %s", self.connection_id, e)
+            manager.disconnect(self.connection_id, self.user_id)
+
+# Event bus: fan-out goes through per-user pub/sub channels so a message sent on
+# one worker reaches sockets held by every other worker or node. Subscriptions
+# follow local connections: a worker listens on a user's channel only while it
+# holds at least one of that user's sockets.
+EVENT_BUS_URL = os.environ.get("EVENT_BUS_URL", "")
+# Publishes waiting to be written plus bytes the transport has not sent yet; past
+# this, a slow or stalled Redis makes publishes drop (and count) instead of
+# buffering without bound
+EVENT_BUS_MAX_BUFFER_BYTES = int(os.environ.get("EVENT_BUS_MAX_BUFFER_BYTES", str(16 * 1024 * 1024)))
+USER_CHANNEL_PREFIX = "user:"
+# A worker that dropped publishes announces it here once it can publish again
+BUS_GAP_CHANNEL = "bus-gap"
+
+def user_channel(user_id: str) -> str:
+    return f"{USER_CHANNEL_PREFIX}{user_id}"
+
+class InMemoryEventBus:
+    """Single-process bus; publishes are delivered directly to local subscribers."""
+
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
+        self.handler = None
+        # Never called: nothing published in-process is lost
+        self.gap_handler = None
+        self.channels = set()
+        self.published = 0
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, channel: str):
+        self.channels.add(channel)
+
+    def unsubscribe(self, channel: str):
+        self.channels.discard(channel)
+
+    def publish(self, channel: str, frame: str):
+        self.published += 1
+        if channel in self.channels:
+            self.handler(channel, frame)
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "channels": len(self.channels), "published": self.published}
+
+class RespError(Exception):
+    pass
+
+def _resp_command(*args: bytes) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+async def _read_resp(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Event bus connection closed")
+    prefix, rest = line[:1], line[1:-2]
+    if prefix == b"+":
+        return rest
+    if prefix == b"-":
+        return RespError(rest.decode())
+    if prefix == b":":
+        return int(rest)
+    if prefix == b"$":
+        length = int(rest)
+        if length == -1:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if prefix == b"*":
+        length = int(rest)
+        if length == -1:
+            return None
+        return [await _read_resp(reader) for _ in range(length)]
+    raise ConnectionError(f"Unexpected reply from event bus: {line!r}")
+
+class RedisEventBus:
+    """Pub/sub over the Redis protocol (RESP2), speaking to Redis or any compatible server.
+
+    One connection publishes and one stays in subscribe mode. Publishes made in
+    the same event-loop iteration are pipelined into a single write. The bus
+    reconnects with backoff and re-subscribes; publishes made while it is down,
+    or while more than max_buffer_bytes are waiting to be sent, are dropped and
+    counted.
+
+    gap_handler() is called whenever traffic may have been lost: on every
+    (re)connect, since messages published while disconnected were missed, when
+    a publish is dropped, and when another worker announces on BUS_GAP_CHANNEL
+    that it dropped publishes.
+    """
+
+    def __init__(self, url: str, max_buffer_bytes: int = EVENT_BUS_MAX_BUFFER_BYTES):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.max_buffer_bytes = max_buffer_bytes
+        self.handler = None
+        self.gap_handler = None
+        self.channels = set()
+        self.published = 0
+        self.publish_batches = 0
+        self.dropped_publishes = 0
+        self.received = 0
+        self.gaps = 0
+        self._announce_gap = False
+        self._pending = bytearray()
+        self._pending_count = 0
+        self._flush_scheduled = False
+        self._pub_writer: Optional[asyncio.StreamWriter] = None
+        self._sub_writer: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+        self._closing = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            logger.warning("Event bus at %s:%s not reachable yet, retrying in background", self.host, self.port)
+
+    async def stop(self):
+        self._closing = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _open(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(_resp_command(b"AUTH", self.password.encode()))
+            reply = await _read_resp(reader)
+            if isinstance(reply, RespError):
+                writer.close()
+                raise ConnectionError(f"Event bus authentication failed: {reply}")
+        return reader, writer
+
+    async def _run(self):
+        delay = 0.5
+        while not self._closing:
+            tasks = []
+            try:
+                pub_reader, self._pub_writer = await self._open()
+                sub_reader, self._sub_writer = await self._open()
+                channels = self.channels | {BUS_GAP_CHANNEL}
+                self._sub_writer.write(_resp_command(b"SUBSCRIBE", *(c.encode() for c in channels)))
+                self._connected.set()
+                logger.info("Event bus connected to %s:%s", self.host, self.port)
+                self._report_gap()
+                delay = 0.5
+                tasks = [
+                    asyncio.create_task(self._read_publish_replies(pub_reader)),
+                    asyncio.create_task(self._read_messages(sub_reader)),
+                ]
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+                logger.warning("Event bus connection lost: %s", e)
+            finally:
+                self._connected.clear()
+                for task in tasks:
+                    task.cancel()
+                for writer in (self._pub_writer, self._sub_writer):
+                    if writer:
+                        writer.close()
+                self._pub_writer = self._sub_writer = None
+            if not self._closing:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 10)
+
+    async def _read_publish_replies(self, reader: asyncio.StreamReader):
+        while True:
+            reply = await _read_resp(reader)
+            if isinstance(reply, RespError):
+                logger.warning("Event bus publish failed: %s", reply)
+
+    async def _read_messages(self, reader: asyncio.StreamReader):
+        while True:
+            reply = await _read_resp(reader)
+            if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                self.received += 1
+                if reply[1] == BUS_GAP_CHANNEL.encode():
+                    self._report_gap()
+                else:
+                    self.handler(reply[1].decode(), reply[2].decode())
+            elif isinstance(reply, RespError):
+                logger.warning("Event bus subscription error: %s", reply)
+
+    def subscribe(self, channel: str):
+        self.channels.add(channel)
+        if self._sub_writer:
+            self._sub_writer.write(_resp_command(b"SUBSCRIBE", channel.encode()))
+
+    def unsubscribe(self, channel: str):
+        self.channels.discard(channel)
+        if self._sub_writer:
+            self._sub_writer.write(_resp_command(b"UNSUBSCRIBE", channel.encode()))
+
+    def buffered_bytes(self) -> int:
+        unsent = self._pub_writer.transport.get_write_buffer_size() if self._pub_writer else 0
+        return len(self._pending) + unsent
+
+    def publish(self, channel: str, frame: str):
+        command = _resp_command(b"PUBLISH", channel.encode(), frame.encode())
+        if self.buffered_bytes() + len(command) > self.max_buffer_bytes:
+            self.dropped_publishes += 1
+            self._announce_gap = True
+            self._report_gap()
+            return
+        self._pending += command
+        self._pending_count += 1
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self._pub_writer is None:
+            if self._pending_count:
+                self.dropped_publishes += self._pending_count
+                self._announce_gap = True
+                self._report_gap()
+        else:
+            if self._announce_gap:
+                # Lets the other workers drop state our lost publishes would have updated
+                self._pub_writer.write(_resp_command(b"PUBLISH", BUS_GAP_CHANNEL.encode(), b""))
+                self._announce_gap = False
+            self._pub_writer.write(bytes(self._pending))
+            self.published += self._pending_count
+            self.publish_batches += 1
+        self._pending.clear()
+        self._pending_count = 0
+
+    def stats(self) -> dict:
+        return {
+            "backend": "redis",
+            "connected": self._connected.is_set(),
+            "channels": len(self.channels),
+            "published": self.published,
+            "publish_batches": self.publish_batches,
+            "dropped_publishes": self.dropped_publishes,
+            "buffered_bytes": self.buffered_bytes(),
+            "received": self.received,
+            "gaps": self.gaps,
+        }
+
+    def _report_gap(self):
+        self.gaps += 1
+        if self.gap_handler:
+            self.gap_handler()
+
+def create_event_bus(url: str):
+    if not url:
+        return InMemoryEventBus()
+    if urlparse(url).scheme in ("redis", "resp"):
+        return RedisEventBus(url)
+    raise ValueError(f"Unsupported EVENT_BUS_URL: {url}")
+
+class ConnectionManager:
+    def __init__(
+        self,
+        bus=None,
+        queue_size: int = WS_SEND_QUEUE_SIZE,
+        overflow_policy: str = WS_OVERFLOW_POLICY
+    ):
+        if overflow_policy not in ("drop_oldest", "disconnect"):
+            raise ValueError(f"Unknown WebSocket overflow policy: {overflow_policy}")
+        self.bus = bus or InMemoryEventBus()
+        self.bus.handler = self.deliver
+        self.channel_handlers: Dict[str, Any] = {}
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.active_connections: Dict[str, ClientConnection] = {}
         self.user_connections: Dict[str, List[str]] = {}
+        self.dropped_frames = 0
+        self.slow_consumer_disconnects = 0
 
-    async def connect(self, websocket: WebSocket, user_id: str, connection_id: str):
-        await websocket.accept()
-        self.active_connections[connection_id] = websocket
+    async def connect(self, websocket: WebSocket, user_id: str, connection_id: str, coalesce_ms: float = 0):
+        """Register an accepted websocket and subscribe it to user_id's events."""
+        connection = ClientConnection(websocket, user_id, connection_id, self.queue_size, coalesce_ms)
+        connection.writer = asyncio.create_task(connection.run_writer(self))
+        self.active_connections[connection_id] = connection
         if user_id not in self.user_connections:
             self.user_connections[user_id] = []
+            self.bus.subscribe(user_channel(user_id))
         self.user_connections[user_id].append(connection_id)
 
     def disconnect(self, connection_id: str, user_id: str):
-        if connection_id in self.active_connections:
-            del self.active_connections[connection_id]
+        connection = self.active_connections.pop(connection_id, None)
+        if connection and connection.writer and connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
         if user_id in self.user_connections:
             if connection_id in self.user_connections[user_id]:
                 self.user_connections[user_id].remove(connection_id)
             if not self.user_connections[user_id]:
                 del self.user_connections[user_id]
+                self.bus.unsubscribe(user_channel(user_id))
+
+    def _enqueue(self, connection: ClientConnection, message: str):
+        try:
+            connection.queue.put_nowait(message)
+            return
+        except asyncio.QueueFull:
+            pass
+        if self.overflow_policy == "drop_oldest":
+            connection.queue.get_nowait()
+            connection.queue.put_nowait(message)
+            connection.dropped_frames += 1
+            self.dropped_frames += 1
+        else:
+            logger.info("Disconnecting slow WebSocket consumer %s", connection.connection_id)
+            self.slow_consumer_disconnects += 1
+            self.dropped_frames += connection.queue.qsize() + 1
+            self.disconnect(connection.connection_id, connection.user_id)
+            asyncio.create_task(self._close(connection.websocket))
+
+    async def _close(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        except Exception:
+            pass
 
     async def send_personal_message(self, message: str, connection_id: str):
         if connection_id in self.active_connections:
-            websocket = self.active_connections[connection_id]
-            await websocket.send_text(message)
+            self._enqueue(self.active_connections[connection_id], message)
+
+    def send_frame_to_user(self, frame: str, user_id: str):
+        """Deliver to this worker's sockets for user_id."""
+        for connection_id in list(self.user_connections.get(user_id, ())):
+            self._enqueue(self.active_connections[connection_id], frame)
+
+    def deliver(self, channel: str, frame: str):
+        if channel.startswith(USER_CHANNEL_PREFIX):
+            self.send_frame_to_user(frame, channel[len(USER_CHANNEL_PREFIX):])
+        elif channel in self.channel_handlers:
+            self.channel_handlers[channel](frame)
+
+    def subscribe_channel(self, channel: str, handler):
+        """Route a worker-wide channel (not tied to any socket) to handler(frame)."""
+        self.channel_handlers[channel] = handler
+        self.bus.subscribe(channel)
 
     async def send_to_user(self, message: dict, user_id: str):
-        if user_id in self.user_connections:
-            message_str = json.dumps(message)
-            for connection_id in self.user_connections[user_id]:
-                await self.send_personal_message(message_str, connection_id)
+        self.bus.publish(user_channel(user_id), encode_frame(message))
 
     async def send_to_group(self, message: dict, user_ids: List[str]):
+        # Serialized once and shared by every recipient connection. This only
+        # publishes; each worker enqueues on its own sockets and their writer
+        # tasks do the actual sends.
+        frame = encode_frame(message)
+        for user_id in user_ids:
+            self.bus.publish(user_channel(user_id), frame)
+
+    def send_frame_to_members(
+        self, frame: str, member_ids: Collection[str], exclude_user_id: Optional[str] = None
+    ):
+        """Deliver to this worker's sockets for the given members, walking
+        whichever of the member set and the live-connection map is smaller."""
+        if len(self.user_connections) < len(member_ids):
+            targets = [user_id for user_id in self.user_connections if user_id in member_ids]
+        else:
+            targets = [user_id for user_id in member_ids if user_id in self.user_connections]
+        for user_id in targets:
+            if user_id != exclude_user_id:
+                self.send_frame_to_user(frame, user_id)
+
+    def stats(self) -> dict:
+        depths = [c.queue.qsize() for c in self.active_connections.values()]
+        return {
+            "connections": len(self.active_connections),
+            "coalescing_connections": sum(1 for c in self.active_connections.values() if c.coalesce),
+            "users": len(self.user_connections),
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "dropped_frames": self.dropped_frames,
+            "slow_consumer_disconnects": self.slow_consumer_disconnects,
+            "bus": self.bus.stats(),
+        }
+
+manager = ConnectionManager(create_event_bus(EVENT_BUS_URL))
+
+# In-process caches that other workers must invalidate go through this channel
+CACHE_INVALIDATION_CHANNEL = "cache-invalidation"
+invalidatable_caches: Dict[str, "TTLCache"] = {}
+
+def invalidate_cached(cache_name: str, key: str):
+    """Drop key from a named cache on this worker now and on every other worker."""
+    invalidatable_caches[cache_name].pop(key)
+    manager.bus.publish(CACHE_INVALIDATION_CHANNEL, encode_frame({"cache": cache_name, "key": key}))
+
+def _on_cache_invalidation(frame: str):
+    event = orjson.loads(frame)
+    cache = invalidatable_caches.get(event["cache"])
+    if cache:
+        cache.pop(event["key"])
+
+def clear_invalidatable_caches():
+    # Invalidations (and shared recent messages) may have been lost with bus
+    # traffic, so no entry can be trusted any more
+    for cache in invalidatable_caches.values():
+        cache.clear()
+
+manager.subscribe_channel(CACHE_INVALIDATION_CHANNEL, _on_cache_invalidation)
+manager.bus.gap_handler = clear_invalidatable_caches
+
+# Presence: a user is online while any worker holds one of their sockets. Each
+# worker keeps local connection refcounts and records itself in the user's
+# presence_workers array (the cross-worker refcount) in periodic bulk batches,
+# not on every connect and disconnect. A worker leaving its last socket for a
+# user removes itself and recomputes is_online in the same atomic update, so
+# the user only goes offline once no worker holds a socket. Going offline waits
+# out a grace period so reloads and reconnect storms neither flap nor write.
+# Workers heartbeat in presence_workers; the entries of a worker that stops
+# heartbeating (crashed, or shut down and not replaced) are removed by the
+# others once its heartbeat expires.
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get("PRESENCE_FLUSH_INTERVAL", "2"))
+PRESENCE_OFFLINE_GRACE = float(os.environ.get("PRESENCE_OFFLINE_GRACE", "5"))
+PRESENCE_WORKER_TTL = float(os.environ.get("PRESENCE_WORKER_TTL", "30"))
+# Contacts in groups larger than this are not sent presence updates
+PRESENCE_MAX_GROUP_SIZE = int(os.environ.get("PRESENCE_MAX_GROUP_SIZE", "100"))
+WORKER_ID = str(uuid.uuid4())
+
+def leave_presence_update(worker_id: str, last_seen: datetime) -> List[dict]:
+    """Remove worker_id from a user's presence and recompute is_online atomically."""
+    return [
+        {"$set": {"presence_workers": {"$filter": {
+            "input": {"$ifNull": ["$presence_workers", []]},
+            "cond": {"$ne": ["$$this", worker_id]}
+        }}}},
+        {"$set": {"is_online": {"$gt": [{"$size": "$presence_workers"}, 0]}, "last_seen": last_seen}},
+    ]
+
+class PresenceTracker:
+    def __init__(self, manager: ConnectionManager, worker_id: str = WORKER_ID):
+        self.manager = manager
+        self.worker_id = worker_id
+        self.pending_offline: Dict[str, asyncio.TimerHandle] = {}
+        # Users whose first local socket opened, whose last one closed, and
+        # whose last_seen moved while other local sockets stay open
+        self.joined: Dict[str, datetime] = {}
+        self.left: Dict[str, datetime] = {}
+        self.seen: Dict[str, datetime] = {}
+        self.flushes = 0
+        self.flushed_users = 0
+        self.reaped_workers = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def is_online(self, user_id: str) -> bool:
+        return user_id in self.manager.user_connections or user_id in self.pending_offline
+
+    def connected(self, user_id: str):
+        timer = self.pending_offline.pop(user_id, None)
+        if timer:
+            timer.cancel()  # Reconnected within the grace period
+        elif len(self.manager.user_connections.get(user_id, ())) == 1:
+            self.left.pop(user_id, None)
+            self.joined[user_id] = datetime.utcnow()
+
+    def disconnected(self, user_id: str):
+        if user_id in self.manager.user_connections:
+            # Other tabs are still open
+            self.seen[user_id] = datetime.utcnow()
+        elif user_id not in self.pending_offline:
+            loop = asyncio.get_running_loop()
+            self.pending_offline[user_id] = loop.call_later(
+                PRESENCE_OFFLINE_GRACE, self._went_offline, user_id
+            )
+
+    def _went_offline(self, user_id: str):
+        self.pending_offline.pop(user_id, None)
+        if user_id not in self.manager.user_connections:
+            self.joined.pop(user_id, None)
+            self.seen.pop(user_id, None)
+            self.left[user_id] = datetime.utcnow()
+
+    async def start(self):
+        await self.heartbeat()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        for user_id, timer in list(self.pending_offline.items()):
+            timer.cancel()
+            self._went_offline(user_id)
+        await self.flush()
+        others = await db.presence_workers.count_documents(
+            {"id": {"$ne": self.worker_id}, "expires_at": {"$gt": datetime.utcnow()}}
+        )
+        if others:
+            # A rolling restart: clients are reconnecting to the other workers.
+            # Expire this worker after the grace period and let them remove its
+            # entries, so users who moved over never show as offline.
+            await db.presence_workers.update_one(
+                {"id": self.worker_id},
+                {"$set": {"expires_at": datetime.utcnow() + timedelta(seconds=PRESENCE_OFFLINE_GRACE)}}
+            )
+        else:
+            await db.presence_workers.delete_one({"id": self.worker_id})
+            await self.remove_worker(self.worker_id)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+                await self.heartbeat()
+                await self.reap_workers()
+            except Exception:
+                logger.exception("Presence flush failed")
+
+    async def heartbeat(self):
+        await db.presence_workers.update_one(
+            {"id": self.worker_id},
+            {"$set": {"expires_at": datetime.utcnow() + timedelta(seconds=PRESENCE_WORKER_TTL)}},
+            upsert=True
+        )
+
+    async def reap_workers(self):
+        """Remove the presence entries of workers whose heartbeat expired."""
+        now = datetime.utcnow()
+        async for worker in db.presence_workers.find({"expires_at": {"$lt": now}}, {"id": 1}):
+            # Claimed by deleting, so only one live worker cleans up after it
+            if await db.presence_workers.find_one_and_delete({"id": worker["id"], "expires_at": {"$lt": now}}):
+                await self.remove_worker(worker["id"])
+                self.reaped_workers += 1
+
+    async def remove_worker(self, worker_id: str):
+        user_ids = await db.users.distinct("id", {"presence_workers": worker_id})
+        now = datetime.utcnow()
+        for i in range(0, len(user_ids), 1000):
+            chunk = user_ids[i:i + 1000]
+            await db.users.bulk_write(
+                [UpdateOne({"id": user_id}, leave_presence_update(worker_id, now)) for user_id in chunk],
+                ordered=False
+            )
+            await self._notify_offline(chunk)
+
+    async def _notify_offline(self, user_ids: List[str]):
+        """Notify contacts of the users that are now offline on every worker."""
         for user_id in user_ids:
-            await self.send_to_user(message, user_id)
+            invalidate_user_cache(user_id)
+        offline = await db.users.distinct("id", {"id": {"$in": user_ids}, "is_online": False})
+        if offline:
+            await self.notify_contacts({user_id: False for user_id in offline})
+
+    async def flush(self):
+        joined, self.joined = self.joined, {}
+        left, self.left = self.left, {}
+        seen, self.seen = self.seen, {}
+        updates = [
+            UpdateOne(
+                {"id": user_id},
+                {"$addToSet": {"presence_workers": self.worker_id}, "$set": {"is_online": True, "last_seen": at}}
+            )
+            for user_id, at in joined.items()
+        ]
+        updates += [UpdateOne({"id": user_id}, leave_presence_update(self.worker_id, at)) for user_id, at in left.items()]
+        updates += [UpdateOne({"id": user_id}, {"$set": {"last_seen": at}}) for user_id, at in seen.items()]
+        if not updates:
+            return
+        try:
+            await db.users.bulk_write(updates, ordered=False)
+        except Exception:
+            # Keep anything newer that arrived while the write was in flight
+            for pending, flushed in ((self.joined, joined), (self.left, left), (self.seen, seen)):
+                for user_id, at in flushed.items():
+                    pending.setdefault(user_id, at)
+            raise
+        self.flushes += 1
+        self.flushed_users += len(updates)
+        for user_id in joined:
+            invalidate_user_cache(user_id)
+        for user_id in seen:
+            invalidate_user_cache(user_id)
+        if joined:
+            await self.notify_contacts({user_id: True for user_id in joined})
+        if left:
+            # Users still connected through another worker stay online
+            await self._notify_offline(list(left))
+
+    async def notify_contacts(self, changed: Dict[str, bool]):
+        contacts: Dict[str, set] = {user_id: set() for user_id in changed}
+        conversations = db.conversations.find(
+            {
+                "participant_ids": {"$in": list(changed)},
+                f"participant_ids.{PRESENCE_MAX_GROUP_SIZE}": {"$exists": False}
+            },
+            {"participant_ids": 1}
+        )
+        async for conversation in conversations:
+            member_ids = set(conversation["participant_ids"])
+            for user_id in member_ids & contacts.keys():
+                contacts[user_id] |= member_ids - {user_id}
+        for user_id, online in changed.items():
+            if contacts[user_id]:
+                await self.manager.send_to_group(
+                    {"type": "user_online" if online else "user_offline", "user_id": user_id},
+                    list(contacts[user_id])
+                )
+
+    def stats(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "online_users": len(self.manager.user_connections),
+            "pending_offline": len(self.pending_offline),
+            "flushes": self.flushes,
+            "flushed_users": self.flushed_users,
+            "reaped_workers": self.reaped_workers,
+        }
+
+presence = PresenceTracker(manager)
+
+# Post-commit pipelines: work that must follow a committed write but must not
+# delay the response. Jobs with the same key run in order on the same worker,
+# so events for one conversation are delivered in commit order. There are two:
+# post_commit only publishes to the event bus (WebSocket fan-out and other
+# in-memory work) and must never wait on the database, while db_side_effects
+# runs slow writes such as conversation summaries, so a slow bulk_write cannot
+# hold up delivery for the conversations sharing its lane.
+POST_COMMIT_WORKERS = int(os.environ.get("POST_COMMIT_WORKERS", "8"))
+POST_COMMIT_QUEUE_SIZE = int(os.environ.get("POST_COMMIT_QUEUE_SIZE", "10000"))
+DB_SIDE_EFFECT_WORKERS = int(os.environ.get("DB_SIDE_EFFECT_WORKERS", "4"))
+
+class PostCommitPipeline:
+    def __init__(self, workers: int = POST_COMMIT_WORKERS, queue_size: int = POST_COMMIT_QUEUE_SIZE):
+        self.queues = [asyncio.Queue(maxsize=max(queue_size // workers, 1)) for _ in range(workers)]
+        self.completed = 0
+        self.failed = 0
+        self._workers: List[asyncio.Task] = []
+        self._next = 0
+
+    def _ensure_started(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._run(queue)) for queue in self.queues]
+
+    async def submit(self, key: Optional[str], func, *args):
+        """Schedule func(*args); waits only if the target queue is full (backpressure)."""
+        self._ensure_started()
+        if key is None:
+            self._next = (self._next + 1) % len(self.queues)
+            queue = self.queues[self._next]
+        else:
+            queue = self.queues[hash(key) % len(self.queues)]
+        await queue.put((func, args))
+
+    async def _run(self, queue: asyncio.Queue):
+        while True:
+            func, args = await queue.get()
+            try:
+                await func(*args)
+                self.completed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Post-commit job %s failed", getattr(func, "__name__", func))
+            finally:
+                queue.task_done()
 
-manager = ConnectionManager()
+    async def drain(self, timeout: float = 10):
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Post-commit pipeline drain timed out with %d jobs left",
+                           sum(q.qsize() for q in self.queues))
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+    def stats(self) -> dict:
+        return {
+            "queued": sum(q.qsize() for q in self.queues),
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+post_commit = PostCommitPipeline()
+db_side_effects = PostCommitPipeline(workers=DB_SIDE_EFFECT_WORKERS)
+
+# Hooks run for every committed message as hook(message, member_ids), where
+# member_ids is the conversation's frozenset of participant ids. They run on the
+# post_commit lanes, so they must not wait on the database.
+message_hooks = []
+
+def message_hook(func):
+    message_hooks.append(func)
+    return func
+
+# Group commit for message inserts: messages arriving within the batch window
+# are written with one insert_many. Each caller resumes once its own batch is
+# acknowledged; the batch's conversation summaries are then updated with one
+# bulk_write, and its search postings written with one insert_many, on the
+# db_side_effects pipeline.
+MESSAGE_BATCH_SIZE = int(os.environ.get("MESSAGE_BATCH_SIZE", "100"))
+MESSAGE_BATCH_WINDOW_MS = float(os.environ.get("MESSAGE_BATCH_WINDOW_MS", "2"))
+
+class MessageWriteBatcher:
+    def __init__(self, max_batch: int = MESSAGE_BATCH_SIZE, window_ms: float = MESSAGE_BATCH_WINDOW_MS):
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+        self.pending: List[tuple] = []
+        self.batches = 0
+        self.messages = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes = set()
+
+    async def submit(self, message_dict: dict):
+        """Queue a message for the next batch and wait until it is stored.
+
+        Raises DuplicateKeyError if the message's client_id was already used.
+        """
+        message_dict.setdefault("seq", next_sync_seq())
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((message_dict, future))
+        if len(self.pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._start_flush)
+        await future
+
+    def _start_flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List[tuple]):
+        failed: Dict[int, Exception] = {}
+        try:
+            await db.messages.insert_many([message for message, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                error_class = DuplicateKeyError if error["code"] == 11000 else OperationFailure
+                failed[error["index"]] = error_class(error["errmsg"], error["code"])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        stored = [message for i, (message, _) in enumerate(batch) if i not in failed]
+        self.batches += 1
+        self.messages += len(stored)
+        for i, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if i in failed:
+                future.set_exception(failed[i])
+            else:
+                future.set_result(None)
+        if stored:
+            await db_side_effects.submit(None, update_conversation_summaries, stored)
+            await db_side_effects.submit(None, index_message_terms, stored)
+
+    async def drain(self):
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch_size": self.messages / self.batches if self.batches else 0,
+        }
+
+async def update_conversation_summaries(messages: List[dict]):
+    """One bulk_write per batch with one pipeline update per conversation, so the
+    count, updated_at and last_message move together. last_message is kept when
+    a later batch already wrote a newer one."""
+    latest: Dict[str, dict] = {}
+    counts: Dict[str, int] = {}
+    for message in messages:
+        conversation_id = message["conversation_id"]
+        counts[conversation_id] = counts.get(conversation_id, 0) + 1
+        if conversation_id not in latest or message["timestamp"] >= latest[conversation_id]["timestamp"]:
+            latest[conversation_id] = message
+    updates = [
+        UpdateOne({"id": conversation_id}, [{"$set": {
+            "last_message": {"$cond": [
+                {"$gt": ["$last_message.timestamp", message["timestamp"]]},
+                "$last_message",
+                # Message content must never be read as an expression
+                {"$literal": Message(**message).model_dump()}
+            ]},
+            "updated_at": {"$max": ["$updated_at", message["timestamp"]]},
+            # Stamped now: the summary commits after the message, possibly
+            # later than SYNC_SETTLE_SECONDS past the message's own seq
+            "seq": next_sync_seq(),
+            "message_count": {"$add": [{"$ifNull": ["$message_count", 0]}, counts[conversation_id]]}
+        }}])
+        for conversation_id, message in latest.items()
+    ]
+    await db.conversations.bulk_write(updates, ordered=False)
+
+message_writer = MessageWriteBatcher()
 
 # Pydantic Models
 class UserCreate(BaseModel):
@@ -93,6 +1076,8 @@ class UserProfile(BaseModel):
     email: str
     display_name: str
     avatar_url: Optional[str] = None
+    # Thumbnail URLs keyed by edge length in pixels, for uploaded avatars
+    avatar_thumbnails: Optional[Dict[str, str]] = None
     is_online: bool = False
     last_seen: Optional[datetime] = None
     created_at: datetime
@@ -106,6 +1091,8 @@ class UserSettings(BaseModel):
 class MessageCreate(BaseModel):
     content: str = Field(max_length=1000)
     conversation_id: str
+    # Optional client-generated id; retries with the same id return the original message
+    client_id: Optional[str] = Field(default=None, max_length=64)
 
 class Message(BaseModel):
     id: str
@@ -116,6 +1103,14 @@ class Message(BaseModel):
     conversation_id: str
     timestamp: datetime
     message_type: str = "text"
+    client_id: Optional[str] = None
+    seq: Optional[int] = None
+
+class MessageSearchHit(BaseModel):
+    message: Message
+    snippet: str
+    # [start, end) offsets of matched terms within snippet
+    highlights: List[List[int]]
 
 class ConversationCreate(BaseModel):
     participant_ids: List[str]
@@ -128,9 +1123,23 @@ class Conversation(BaseModel):
     is_group: bool
     group_name: Optional[str] = None
     last_message: Optional[Message] = None
+    message_count: int = 0
+    # Large groups list only the first LARGE_GROUP_PREVIEW participants
+    member_count: int = 0
     created_at: datetime
     updated_at: datetime
 
+class SyncBatch(BaseModel):
+    # Pass as ?since= on the next call
+    cursor: str
+    # More changes are waiting; call again right away with cursor
+    has_more: bool = False
+    # The cursor is too old to sync from; reload everything, then sync from cursor
+    reset: bool = False
+    messages: List[Message] = []
+    conversations: List[Conversation] = []
+    removed_conversation_ids: List[str] = []
+
 class GroupCreate(BaseModel):
     name: str = Field(max_length=100)
     description: Optional[str] = Field(max_length=500)
@@ -141,12 +1150,63 @@ class Token(BaseModel):
     token_type: str = "bearer"
     user: UserProfile
 
+# WebSocket commands sent by clients. Every command may carry a client_id that
+# is echoed back in the matching "ack" or "error" frame.
+class SendMessageCommand(MessageCreate):
+    type: Literal["send_message"]
+
+class TypingCommand(BaseModel):
+    type: Literal["typing"]
+    conversation_id: str
+    is_typing: bool = True
+    client_id: Optional[str] = None
+
+class MarkReadCommand(BaseModel):
+    type: Literal["mark_read"]
+    conversation_id: str
+    message_id: str
+    client_id: Optional[str] = None
+
+class AuthCommand(BaseModel):
+    """Authenticates the socket; until then it neither receives events nor counts
+    as online. Sent as a frame rather than in the URL, which proxies and the
+    server access log record."""
+    type: Literal["auth"]
+    token: str
+    client_id: Optional[str] = None
+
+class AckCommand(BaseModel):
+    """Delivery receipt for a new_message event; forwarded to the sender."""
+    type: Literal["ack"]
+    message_id: str
+    client_id: Optional[str] = None
+
+WebSocketCommand = TypeAdapter(Annotated[
+    Union[AuthCommand, SendMessageCommand, TypingCommand, MarkReadCommand, AckCommand],
+    Field(discriminator="type")
+])
+
 # Utility functions
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def run_password_hash(func, *args):
+    global password_hash_pending
+    if password_hash_pending >= PASSWORD_HASH_MAX_PENDING:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, please try again",
+            headers={"Retry-After": "1"},
+        )
+    password_hash_pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_hash_executor, func, *args)
+    finally:
+        password_hash_pending -= 1
+
+async def verify_password(plain_password, hashed_password):
+    return await run_password_hash(pwd_context.verify, plain_password, hashed_password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await run_password_hash(pwd_context.hash, password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -158,25 +1218,148 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# Keyset pagination cursors: an opaque, url-safe encoding of the sort key of the
+# last item on a page. The next page is fetched with a range query on the same
+# compound index, so deep pages cost the same as the first one.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def encode_cursor(*values) -> str:
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, *types: type) -> list:
+    """The values of a cursor made by encode_cursor, which must be one of each
+    of types (datetimes are parsed back from ISO strings); 400 otherwise."""
+    invalid = HTTPException(status_code=400, detail="Invalid cursor")
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise invalid
+    if not isinstance(values, list) or len(values) != len(types):
+        raise invalid
+    for i, expected in enumerate(types):
+        if expected is datetime:
+            try:
+                values[i] = datetime.fromisoformat(values[i])
+            except (ValueError, TypeError):
+                raise invalid
+        # bool is an int subclass but never a valid cursor value
+        elif not isinstance(values[i], expected) or isinstance(values[i], bool):
+            raise invalid
+    return values
+
+def keyset_filter(field: str, value, item_id: str, op: str, id_field: str = "id") -> dict:
+    """Rows strictly after (value, item_id) in the direction given by op ($lt or $gt)."""
+    return {"$or": [{field: {op: value}}, {field: value, id_field: {op: item_id}}]}
+
+# Sync sequence: every message, conversation change and membership removal is
+# stamped with a seq, the write time in microseconds shifted left with a
+# per-process suffix, strictly increasing within a worker. A write commits within
+# SYNC_SETTLE_SECONDS of taking its seq (worker clocks must also agree to within
+# that), so every change with a seq below now - SYNC_SETTLE_SECONDS is visible.
+SYNC_SETTLE_SECONDS = float(os.environ.get("SYNC_SETTLE_SECONDS", "5"))
+SYNC_SUFFIX_BITS = 10
+_sync_suffix = os.getpid() & ((1 << SYNC_SUFFIX_BITS) - 1)
+_last_sync_micros = 0
+
+def sync_seq_at(timestamp: float) -> int:
+    """Lowest seq a change written at timestamp (epoch seconds) can carry."""
+    return int(timestamp * 1_000_000) << SYNC_SUFFIX_BITS
+
+def next_sync_seq() -> int:
+    global _last_sync_micros
+    _last_sync_micros = max(int(time.time() * 1_000_000), _last_sync_micros + 1)
+    return (_last_sync_micros << SYNC_SUFFIX_BITS) | _sync_suffix
+
+def settled_sync_cursor(seq: int) -> str:
+    """Cursor for a client that has seen the change with this seq: it resumes
+    SYNC_SETTLE_SECONDS earlier, so changes still committing are not skipped."""
+    return encode_cursor(seq - sync_seq_at(SYNC_SETTLE_SECONDS))
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after a TTL."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+# Authenticated principal cache: decoded token claims by token, profiles by user id.
+# Steady-state authenticated requests therefore touch neither jwt.decode nor users.
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("PRINCIPAL_CACHE_SIZE", "10000"))
+PRINCIPAL_CACHE_TTL = float(os.environ.get("PRINCIPAL_CACHE_TTL", "60"))
+token_cache = TTLCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+profile_cache = TTLCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+invalidatable_caches["profiles"] = profile_cache
+
+def invalidate_user_cache(user_id: str):
+    # Profiles are stamped into new messages (sender_name, sender_avatar), so
+    # every worker must drop a changed one, not just this one
+    invalidate_cached("profiles", user_id)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await authenticate_token(credentials.credentials)
+
+async def authenticate_token(token: str) -> UserProfile:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    claims = token_cache.get(token)
+    if claims is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username: str = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+        except JWTError:
             raise credentials_exception
-    except JWTError:
+        claims = {"sub": username, "exp": payload["exp"], "user_id": None}
+    elif claims["exp"] <= time.time():
+        token_cache.pop(token)
         raise credentials_exception
     
-    user = await db.users.find_one({"username": username})
-    if user is None:
-        raise credentials_exception
-    return UserProfile(**user)
+    user_profile = profile_cache.get(claims["user_id"]) if claims["user_id"] else None
+    if user_profile is None:
+        user = await db.users.find_one({"username": claims["sub"]}, USER_PUBLIC_PROJECTION)
+        if user is None:
+            raise credentials_exception
+        user_profile = UserProfile(**user)
+        profile_cache.set(user_profile.id, user_profile)
+    if claims["user_id"] is None:
+        claims["user_id"] = user_profile.id
+        token_cache.set(token, claims, ttl=claims["exp"] - time.time())
+    return user_profile
 
 # Authentication routes
 @api_router.post("/register", response_model=Token)
@@ -192,7 +1375,7 @@ async def register(user_data: UserCreate):
         )
     
     # Create user
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash(user_data.password)
     user_dict = {
         "id": str(uuid.uuid4()),
         "username": user_data.username,
@@ -204,10 +1387,18 @@ async def register(user_data: UserCreate):
         "last_seen": datetime.utcnow(),
         "created_at": datetime.utcnow(),
         "theme": "light",
-        "notifications_enabled": True
+        "notifications_enabled": True,
+        **user_search_fields(user_data.username, user_data.display_name)
     }
     
-    await db.users.insert_one(user_dict)
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration; the unique indexes caught it
+        raise HTTPException(
+            status_code=400,
+            detail="Username or email already registered"
+        )
     user_dict.pop("password_hash")
     user_profile = UserProfile(**user_dict)
     
@@ -222,19 +1413,14 @@ async def register(user_data: UserCreate):
 @api_router.post("/login", response_model=Token)
 async def login(user_data: UserLogin):
     user = await db.users.find_one({"username": user_data.username})
-    if not user or not verify_password(user_data.password, user["password_hash"]):
+    if not user or not await verify_password(user_data.password, user["password_hash"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    # Update online status
-    await db.users.update_one(
-        {"id": user["id"]},
-        {"$set": {"is_online": True, "last_seen": datetime.utcnow()}}
-    )
-    
+    # is_online and last_seen follow the user's WebSockets, see PresenceTracker
     user.pop("password_hash")
     user_profile = UserProfile(**user)
     
@@ -246,13 +1432,203 @@ async def login(user_data: UserLogin):
     return Token(access_token=access_token, user=user_profile)
 
 @api_router.post("/logout")
-async def logout(current_user: UserProfile = Depends(get_current_user)):
-    await db.users.update_one(
-        {"id": current_user.id},
-        {"$set": {"is_online": False, "last_seen": datetime.utcnow()}}
-    )
+async def logout(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    current_user: UserProfile = Depends(get_current_user)
+):
+    # Sockets still open elsewhere keep the user online
+    token_cache.pop(credentials.credentials)
     return {"message": "Successfully logged out"}
 
+# Avatar uploads are streamed to disk in chunks with file I/O off the event loop,
+# capped by the bytes actually read, and typed from their magic bytes rather than
+# the client's filename or content type. Square thumbnails are rendered on a
+# worker pool so lists and chat headers never download the original.
+# Files are named by the SHA-256 of the upload, so identical uploads share one
+# file and a name never changes content: avatars are served as immutable with
+# the name as a strong ETag, and small ones are kept in memory.
+AVATAR_DIR = ROOT_DIR / "uploads" / "avatars"
+AVATAR_MAX_BYTES = int(os.environ.get("AVATAR_MAX_BYTES", str(5 * 1024 * 1024)))
+AVATAR_THUMBNAIL_SIZES = [int(size) for size in os.environ.get("AVATAR_THUMBNAIL_SIZES", "48,96,256").split(",")]
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Room for the multipart boundaries and part headers around the file
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "2"))
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+# Decoded size limit; Pillow refuses images over twice this many pixels
+Image.MAX_IMAGE_PIXELS = int(os.environ.get("AVATAR_MAX_PIXELS", "40000000"))
+AVATAR_HASH_LENGTH = 32
+AVATAR_CACHE_CONTROL = "public, max-age=31536000, immutable"
+AVATAR_FILE_CACHE_BYTES = int(os.environ.get("AVATAR_FILE_CACHE_BYTES", str(32 * 1024 * 1024)))
+AVATAR_FILE_CACHE_MAX_FILE_BYTES = int(os.environ.get("AVATAR_FILE_CACHE_MAX_FILE_BYTES", str(256 * 1024)))
+AVATAR_MEDIA_TYPES = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png", "gif": "image/gif", "webp": "image/webp"}
+
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+]
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """File extension for a supported image format, detected from its first bytes."""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    for signature, extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    return None
+
+def _open_upload(path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return open(path, "wb")
+
+def _write_chunk(out, digest, chunk: bytes):
+    digest.update(chunk)
+    out.write(chunk)
+
+async def read_upload_form(request: Request, max_bytes: int) -> FormData:
+    """Parse a multipart body of at most max_bytes. Starlette's own form parsing
+    spools the whole body before the route runs; this answers 413 as soon as
+    Content-Length or the bytes received exceed the limit, without reading on."""
+    content_type, _, _ = request.headers.get("content-type", "").partition(";")
+    if content_type.strip().lower() != "multipart/form-data":
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail="File too large")
+
+    too_large = False
+
+    async def capped_stream():
+        nonlocal too_large
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > max_bytes:
+                too_large = True
+                # The parser closes its spooled files only on MultiPartException
+                raise MultiPartException("File too large")
+            yield chunk
+
+    try:
+        return await MultiPartParser(request.headers, capped_stream(), max_files=1, max_fields=10).parse()
+    except MultiPartException as e:
+        if too_large:
+            raise HTTPException(status_code=413, detail="File too large")
+        raise HTTPException(status_code=400, detail=e.message)
+
+async def save_upload(file: UploadFile, path: Path, max_bytes: int) -> Tuple[bytes, str]:
+    """Stream an upload to path; returns its first bytes and SHA-256 hex digest.
+    Raises 413 once more than max_bytes have been read."""
+    head = b""
+    size = 0
+    digest = hashlib.sha256()
+    out = await asyncio.to_thread(_open_upload, path)
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail="File too large")
+            if len(head) < 16:
+                head += chunk[:16 - len(head)]
+            await asyncio.to_thread(_write_chunk, out, digest, chunk)
+    except BaseException:
+        await asyncio.to_thread(out.close)
+        await asyncio.to_thread(path.unlink, missing_ok=True)
+        raise
+    await asyncio.to_thread(out.close)
+    return head, digest.hexdigest()
+
+def render_avatar_thumbnails(source: Path, stem: str) -> Dict[str, str]:
+    """Runs on image_executor: center-crop the source to each thumbnail size.
+    Thumbnails left by an earlier upload of the same image are reused."""
+    thumbnails = {str(size): f"/api/uploads/avatars/{stem}_{size}.webp" for size in AVATAR_THUMBNAIL_SIZES}
+    missing = [size for size in AVATAR_THUMBNAIL_SIZES if not (AVATAR_DIR / f"{stem}_{size}.webp").exists()]
+    if not missing:
+        return thumbnails
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image).convert("RGBA")
+        for size in missing:
+            # Write then rename, so a concurrent upload of the same image never
+            # exposes a partly written file
+            partial = AVATAR_DIR / f"{stem}_{size}.{uuid.uuid4()}.part"
+            ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS).save(partial, "WEBP", quality=85)
+            partial.replace(AVATAR_DIR / f"{stem}_{size}.webp")
+    return thumbnails
+
+class FileCache:
+    """LRU of small immutable files, bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes: int, max_file_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._data: OrderedDict = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[bytes]:
+        content = self._data.get(key)
+        if content is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return content
+
+    def set(self, key, content: bytes):
+        if len(content) > self.max_file_bytes or key in self._data:
+            return
+        self._data[key] = content
+        self.size += len(content)
+        while self.size > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self.size -= len(evicted)
+
+    def stats(self) -> dict:
+        return {"files": len(self._data), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+avatar_file_cache = FileCache(AVATAR_FILE_CACHE_BYTES, AVATAR_FILE_CACHE_MAX_FILE_BYTES)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+def parse_byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive (start, end) of a single "bytes=" range, or None to serve the
+    whole file (malformed and multi-range headers may be ignored, including a
+    last byte before the first). Raises 416 when the range lies outside the file."""
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    if not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        return None
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the last N bytes; zero of them cannot be satisfied
+        start = max(size - int(last), 0)
+        end = size - 1 if int(last) else -1
+    if start > end or start >= size:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+def read_file_range(path: Path, start: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(length)
+
 # User routes
 @api_router.get("/me", response_model=UserProfile)
 async def get_current_user_profile(current_user: UserProfile = Depends(get_current_user)):
@@ -260,51 +1636,86 @@ async def get_current_user_profile(current_user: UserProfile = Depends(get_curre
 
 @api_router.post("/upload-avatar")
 async def upload_avatar(
-    file: UploadFile = File(...),
+    request: Request,
     current_user: UserProfile = Depends(get_current_user)
 ):
-    # Check file type
-    if not file.content_type.startswith('image/'):
-        raise HTTPException(status_code=400, detail="File must be an image")
-    
-    # Check file size (max 5MB)
-    if file.size > 5 * 1024 * 1024:
-        raise HTTPException(status_code=400, detail="File too large")
-    
-    # Create uploads directory if not exists
-    import os
-    uploads_dir = ROOT_DIR / "uploads" / "avatars"
-    uploads_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Generate unique filename
-    import uuid
-    file_extension = file.filename.split('.')[-1]
-    unique_filename = f"{uuid.uuid4()}.{file_extension}"
-    file_path = uploads_dir / unique_filename
-    
-    # Save file
-    with open(file_path, "wb") as buffer:
-        content = await file.read()
-        buffer.write(content)
-    
-    # Update user avatar URL
+    """Multipart upload with the image in the "file" field."""
+    form = await read_upload_form(request, AVATAR_MAX_BYTES + UPLOAD_FORM_OVERHEAD)
+    try:
+        file = form.get("file")
+        if not isinstance(file, UploadFile):
+            raise HTTPException(status_code=400, detail="Upload the image in the file field")
+        upload_path = AVATAR_DIR / f"{uuid.uuid4()}.part"
+        head, digest = await save_upload(file, upload_path, AVATAR_MAX_BYTES)
+    finally:
+        await form.close()
+
+    extension = sniff_image_type(head)
+    if extension is None:
+        await asyncio.to_thread(upload_path.unlink, missing_ok=True)
+        raise HTTPException(status_code=400, detail="File must be a JPEG, PNG, GIF or WebP image")
+
+    # Same content, same name: re-uploads replace the file with identical bytes
+    stem = digest[:AVATAR_HASH_LENGTH]
+    unique_filename = f"{stem}.{extension}"
+    file_path = AVATAR_DIR / unique_filename
+    await asyncio.to_thread(upload_path.replace, file_path)
+    try:
+        loop = asyncio.get_running_loop()
+        thumbnails = await loop.run_in_executor(image_executor, render_avatar_thumbnails, file_path, stem)
+    except (OSError, Image.DecompressionBombError):
+        await asyncio.to_thread(file_path.unlink, missing_ok=True)
+        raise HTTPException(status_code=400, detail="Invalid image")
+
     avatar_url = f"/api/uploads/avatars/{unique_filename}"
     await db.users.update_one(
         {"id": current_user.id},
-        {"$set": {"avatar_url": avatar_url}}
+        {"$set": {"avatar_url": avatar_url, "avatar_thumbnails": thumbnails}}
     )
-    
-    return {"avatar_url": avatar_url}
+    invalidate_user_cache(current_user.id)
+
+    return {"avatar_url": avatar_url, "avatar_thumbnails": thumbnails}
 
 @api_router.get("/uploads/avatars/{filename}")
-async def get_avatar(filename: str):
-    from fastapi.responses import FileResponse
-    file_path = ROOT_DIR / "uploads" / "avatars" / filename
-    
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="Avatar not found")
-    
-    return FileResponse(file_path)
+async def get_avatar(filename: str, request: Request):
+    # Avatar files are never rewritten under the same name (content hashes, or
+    # random ids for older uploads), so the name is a strong validator
+    etag = f'"{Path(filename).stem}"'
+    headers = {"ETag": etag, "Cache-Control": AVATAR_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    file_path = AVATAR_DIR / filename
+    media_type = AVATAR_MEDIA_TYPES.get(Path(filename).suffix[1:].lower(), "application/octet-stream")
+    content = avatar_file_cache.get(filename)
+    stat_result = None
+    if content is None:
+        try:
+            stat_result = await asyncio.to_thread(file_path.stat)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Avatar not found")
+        if stat_result.st_size <= AVATAR_FILE_CACHE_MAX_FILE_BYTES:
+            content = await asyncio.to_thread(file_path.read_bytes)
+            avatar_file_cache.set(filename, content)
+    # Only once the file is known to exist: a deleted avatar must not stay
+    # "not modified" in caches forever
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    size = len(content) if content is not None else stat_result.st_size
+    byte_range = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if byte_range and (not if_range or if_range == etag):
+        span = parse_byte_range(byte_range, size)
+        if span is not None:
+            start, end = span
+            if content is not None:
+                body = content[start:end + 1]
+            else:
+                body = await asyncio.to_thread(read_file_range, file_path, start, end - start + 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            return Response(body, status_code=status.HTTP_206_PARTIAL_CONTENT, headers=headers, media_type=media_type)
+
+    if content is not None:
+        return Response(content, headers=headers, media_type=media_type)
+    return FileResponse(file_path, headers=headers, media_type=media_type, stat_result=stat_result)
 
 @api_router.put("/me", response_model=UserProfile)
 async def update_profile(
@@ -318,115 +1729,693 @@ async def update_profile(
     }
     if settings.avatar_url:
         update_data["avatar_url"] = settings.avatar_url
+        # Thumbnails belong to the uploaded avatar; drop them for any other image
+        if urlparse(settings.avatar_url).path != current_user.avatar_url:
+            update_data["avatar_thumbnails"] = None
+    update_data.update(user_search_fields(current_user.username, settings.display_name))
     
     await db.users.update_one(
         {"id": current_user.id},
         {"$set": update_data}
     )
+    invalidate_user_cache(current_user.id)
     
-    updated_user = await db.users.find_one({"id": current_user.id})
-    updated_user.pop("password_hash")
+    updated_user = await db.users.find_one({"id": current_user.id}, USER_PUBLIC_PROJECTION)
     return UserProfile(**updated_user)
 
 @api_router.get("/users", response_model=List[UserProfile])
-async def get_users(current_user: UserProfile = Depends(get_current_user)):
+async def get_users(
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=200),
+    current_user: UserProfile = Depends(get_current_user)
+):
+    id_filter = {"$ne": current_user.id}
+    if after:
+        id_filter["$gt"] = decode_cursor(after, str)[0]
     users = await db.users.find(
-        {"id": {"$ne": current_user.id}},
-        {"password_hash": 0}
-    ).to_list(100)
+        {"id": id_filter},
+        USER_PUBLIC_PROJECTION
+    ).sort("id", 1).limit(limit).to_list(limit)
+    if len(users) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(users[-1]["id"])
     return [UserProfile(**user) for user in users]
 
-@api_router.get("/users/search")
+# User search: every user document carries normalized search keys so that
+# exact, prefix and substring matches are all equality lookups on a multikey
+# index instead of an unanchored regex scan.
+SEARCH_MAX_PREFIX = 30
+SEARCH_CONTACT_LIMIT = 1000
+# Trigram candidates fetched per wanted result, since some contain the
+# trigrams but not the query itself
+SEARCH_SUBSTRING_OVERFETCH = 3
+
+def normalize_search_text(text: str) -> str:
+    """Casefold, strip accents and collapse whitespace."""
+    decomposed = unicodedata.normalize("NFKD", text)
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(stripped.casefold().split())
+
+def search_trigrams(text: str) -> List[str]:
+    return sorted({text[i:i + 3] for i in range(len(text) - 2)})
+
+def user_search_fields(username: str, display_name: str) -> dict:
+    name = normalize_search_text(display_name)
+    handle = normalize_search_text(username)
+    tokens = {handle, name, *name.split(), *handle.replace("_", " ").replace(".", " ").replace("-", " ").split()}
+    tokens.discard("")
+    return {
+        "search_tokens": sorted(tokens),
+        "search_prefixes": sorted({t[:i] for t in tokens for i in range(1, min(len(t), SEARCH_MAX_PREFIX) + 1)}),
+        "search_grams": sorted({gram for t in tokens for gram in search_trigrams(t)}),
+    }
+
+async def get_contact_ids(user_id: str) -> List[str]:
+    """Users who share a direct chat or a small group with user_id."""
+    contacts = set()
+    async for conversation in db.conversations.find(
+        {"participant_ids": user_id, f"participant_ids.{PRESENCE_MAX_GROUP_SIZE}": {"$exists": False}},
+        {"participant_ids": 1}
+    ).sort([("updated_at", -1)]).limit(SEARCH_CONTACT_LIMIT):
+        contacts.update(conversation["participant_ids"])
+        if len(contacts) > SEARCH_CONTACT_LIMIT:
+            break
+    contacts.discard(user_id)
+    return list(contacts)
+
+@api_router.get("/users/search", response_model=List[UserProfile])
 async def search_users(
-    query: str,
+    response: Response,
+    query: str = Query(min_length=1, max_length=100),
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=100),
+    boost_contacts: bool = False,
     current_user: UserProfile = Depends(get_current_user)
 ):
-    users = await db.users.find(
-        {
-            "$and": [
-                {"id": {"$ne": current_user.id}},
-                {
-                    "$or": [
-                        {"username": {"$regex": query, "$options": "i"}},
-                        {"display_name": {"$regex": query, "$options": "i"}}
-                    ]
-                }
-            ]
-        },
-        {"password_hash": 0}
-    ).to_list(50)
+    """Users ranked exact > prefix > substring match on username or display name.
+
+    With boost_contacts, people the caller already chats with come first within
+    each rank. Results are paged with the X-Next-Cursor header.
+    """
+    q = normalize_search_text(query)
+    if not q:
+        raise HTTPException(status_code=400, detail="Query must not be blank")
+    
+    # Each tier excludes the matches of the tiers ranked above it. The last is
+    # (filter, True): trigrams only narrow it to candidates that must still
+    # contain q in one of their tokens.
+    tiers = [
+        ({"search_tokens": q}, False),
+        ({"search_prefixes": q, "search_tokens": {"$ne": q}}, False),
+    ]
+    if len(q) >= 3:
+        tiers.append(({"search_grams": {"$all": search_trigrams(q)}, "search_prefixes": {"$ne": q}}, True))
+    if boost_contacts:
+        contact_ids = await get_contact_ids(current_user.id)
+        tiers = [
+            ({**tier, "id": id_filter}, substring)
+            for tier, substring in tiers
+            for id_filter in ({"$in": contact_ids}, {"$nin": contact_ids + [current_user.id]})
+        ]
+    else:
+        tiers = [({**tier, "id": {"$ne": current_user.id}}, substring) for tier, substring in tiers]
+    substring_projection = {k: v for k, v in USER_PUBLIC_PROJECTION.items() if k != "search_tokens"}
+    
+    tier_index, after_username = decode_cursor(after, int, str) if after else (0, None)
+    if not 0 <= tier_index < len(tiers):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    users = []
+    last_tier = tier_index
+    for index in range(tier_index, len(tiers)):
+        query_filter, substring = dict(tiers[index][0]), tiers[index][1]
+        resume_after = after_username if index == tier_index else None
+        while len(users) < limit:
+            if resume_after is not None:
+                query_filter["username"] = {"$gt": resume_after}
+            wanted = limit - len(users)
+            batch = wanted * SEARCH_SUBSTRING_OVERFETCH if substring else wanted
+            page = await db.users.find(
+                query_filter, substring_projection if substring else USER_PUBLIC_PROJECTION
+            ).sort("username", 1).limit(batch).to_list(None)
+            matches = page
+            if substring:
+                matches = [user for user in page if any(q in token for token in user.pop("search_tokens"))]
+            if matches:
+                users.extend(matches[:wanted])
+                last_tier = index
+            if len(page) < batch:
+                break
+            resume_after = page[-1]["username"]
+        if len(users) == limit:
+            break
+    
+    if len(users) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(last_tier, users[-1]["username"])
     return [UserProfile(**user) for user in users]
 
 # Message routes
-@api_router.post("/messages", response_model=Message)
-async def send_message(
-    message_data: MessageCreate,
-    current_user: UserProfile = Depends(get_current_user)
-):
-    # Check if conversation exists and user is participant
-    conversation = await db.conversations.find_one({"id": message_data.conversation_id})
-    if not conversation:
+# Conversation membership is stored as a compact participant_ids array; profiles
+# are hydrated with one $in query only when a response needs them. Member sets
+# are cached for authorization checks.
+# Groups above LARGE_GROUP_THRESHOLD members are fanned out with a single
+# publish and list only a preview of their participants; use the paged
+# /groups/{id}/members endpoint for the full list. Their membership moves to
+# conversation_members (one document per member) and the conversation keeps
+# only member_preview and large=True: a multikey participant_ids array would
+# make every message's updated_at/seq bump rewrite one index key per member in
+# each inbox index, and the whole array with the document.
+LARGE_GROUP_THRESHOLD = int(os.environ.get("LARGE_GROUP_THRESHOLD", "500"))
+LARGE_GROUP_PREVIEW = int(os.environ.get("LARGE_GROUP_PREVIEW", "50"))
+GROUP_FANOUT_CHANNEL = "group-fanout"
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get("MEMBERSHIP_CACHE_SIZE", "50000"))
+MEMBERSHIP_CACHE_TTL = float(os.environ.get("MEMBERSHIP_CACHE_TTL", "300"))
+membership_cache = TTLCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL)
+invalidatable_caches["membership"] = membership_cache
+
+async def get_conversation_members(conversation_id: str) -> Optional[dict]:
+    """{"member_ids": frozenset, "is_group": bool, "large": bool, "created_by": str}
+    for a conversation, or None if it does not exist."""
+    members = membership_cache.get(conversation_id)
+    if members is None:
+        conversation = await db.conversations.find_one(
+            {"id": conversation_id}, {"participant_ids": 1, "is_group": 1, "created_by": 1, "large": 1}
+        )
+        if not conversation:
+            return None
+        # A group being converted to large has members in both places until
+        # participant_ids is unset
+        member_ids = conversation.get("participant_ids", [])
+        if conversation.get("large"):
+            member_ids = member_ids + [
+                member["user_id"] async for member in
+                db.conversation_members.find({"conversation_id": conversation_id}, {"user_id": 1})
+            ]
+        members = {
+            "member_ids": frozenset(member_ids),
+            "is_group": conversation["is_group"],
+            "large": bool(conversation.get("large")),
+            "created_by": conversation.get("created_by")
+        }
+        membership_cache.set(conversation_id, members)
+    return members
+
+async def large_conversation_ids(user_id: str) -> List[str]:
+    return await db.conversation_members.distinct("conversation_id", {"user_id": user_id})
+
+async def member_conversation_ids(user_id: str) -> List[str]:
+    """Ids of every conversation user_id belongs to, large groups included."""
+    small = await db.conversations.distinct("id", {"participant_ids": user_id})
+    return list(dict.fromkeys(small + await large_conversation_ids(user_id)))
+
+def merge_conversation_pages(pages: List[List[dict]], key, limit: int, reverse: bool = False) -> List[dict]:
+    """Merge pages of conversations sorted by key into one page of at most limit,
+    dropping duplicates (a group mid-conversion can appear in two pages)."""
+    by_id = {conv["id"]: conv for page in pages for conv in page}
+    return sorted(by_id.values(), key=key, reverse=reverse)[:limit]
+
+async def insert_group_members(group_id: str, user_ids: List[str]) -> int:
+    """Add members of a large group; returns how many were not members already."""
+    if not user_ids:
+        return 0
+    now = datetime.utcnow()
+    try:
+        result = await db.conversation_members.insert_many(
+            [{"conversation_id": group_id, "user_id": user_id, "joined_at": now} for user_id in user_ids],
+            ordered=False
+        )
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        # The unique index skips existing members, so concurrent adds never double count
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+        return e.details["nInserted"]
+
+async def convert_to_large_group(group_id: str):
+    """Move a group's participant_ids into conversation_members."""
+    # Flagging first sends concurrent adds down the large-group path
+    conversation = await db.conversations.find_one_and_update(
+        {"id": group_id, "large": {"$ne": True}}, {"$set": {"large": True}}, projection={"participant_ids": 1}
+    )
+    if conversation is None:
+        return
+    participant_ids = conversation["participant_ids"]
+    await insert_group_members(group_id, participant_ids)
+    await db.conversations.update_one(
+        {"id": group_id},
+        {"$set": {"member_preview": participant_ids[:LARGE_GROUP_PREVIEW]}, "$unset": {"participant_ids": ""}}
+    )
+    invalidate_cached("membership", group_id)
+
+async def require_membership(conversation_id: str, user_id: str) -> frozenset:
+    """Member ids of a conversation, raising 404/403 unless user_id is one of them."""
+    members = await get_conversation_members(conversation_id)
+    if members is None:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    
-    participant_ids = [p["id"] for p in conversation["participants"]]
-    if current_user.id not in participant_ids:
+    if user_id not in members["member_ids"]:
         raise HTTPException(status_code=403, detail="Not a participant in this conversation")
+    return members["member_ids"]
+
+def sorted_member_ids(members: dict) -> List[str]:
+    # Computed once per cached member set and reused for every page
+    if "sorted_ids" not in members:
+        members["sorted_ids"] = sorted(members["member_ids"])
+    return members["sorted_ids"]
+
+def listed_member_ids(conversation: dict) -> List[str]:
+    # Large groups only keep a preview on the conversation document
+    if "participant_ids" in conversation:
+        return conversation["participant_ids"]
+    return conversation.get("member_preview", [])
+
+async def hydrate_participants(conversations: List[dict]) -> List[dict]:
+    """Fill conversation["participants"] from participant_ids with one batched users query."""
+    for conv in conversations:
+        conv.setdefault("member_count", len(listed_member_ids(conv)))
+    user_ids = {user_id for conv in conversations for user_id in listed_member_ids(conv)}
+    users = await db.users.find(
+        {"id": {"$in": list(user_ids)}},
+        USER_PUBLIC_PROJECTION
+    ).to_list(None)
+    by_id = {user["id"]: user for user in users}
+    for conv in conversations:
+        conv["participants"] = [by_id[user_id] for user_id in listed_member_ids(conv) if user_id in by_id]
+    return conversations
+
+# Recent messages: the newest RECENT_MESSAGES_PER_CONVERSATION messages of
+# recently read conversations, so opening an active chat needs no messages query.
+# A buffer is loaded from Mongo on the first default-page read and then kept
+# current: the writing worker adds each message before responding and shares it
+# on RECENT_MESSAGES_CHANNEL, where every other worker adds it too. Entries
+# expire after RECENT_MESSAGES_TTL to bound staleness if a publish is lost, and
+# idle conversations are evicted first once RECENT_MESSAGES_MAX_BYTES is reached.
+RECENT_MESSAGES_CHANNEL = "recent-messages"
+RECENT_MESSAGES_PER_CONVERSATION = int(os.environ.get("RECENT_MESSAGES_PER_CONVERSATION", "50"))
+RECENT_MESSAGES_MAX_BYTES = int(os.environ.get("RECENT_MESSAGES_MAX_BYTES", str(64 * 1024 * 1024)))
+RECENT_MESSAGES_TTL = float(os.environ.get("RECENT_MESSAGES_TTL", "300"))
+# Rough per-message overhead of the model and its fields, on top of the text
+RECENT_MESSAGE_OVERHEAD_BYTES = 400
+
+def _message_key(message: Message) -> tuple:
+    return (message.timestamp, message.id)
+
+class RecentMessageBuffer:
+    """Per-conversation ring buffers of the newest messages, LRU-bounded by size."""
+
+    def __init__(self, per_conversation: int = RECENT_MESSAGES_PER_CONVERSATION,
+                 max_bytes: int = RECENT_MESSAGES_MAX_BYTES, ttl: float = RECENT_MESSAGES_TTL):
+        self.per_conversation = per_conversation
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # conversation_id -> {"messages": sorted list, "ids": set, "bytes": int,
+        # "expires": monotonic deadline, "loading": bool}
+        self._entries: OrderedDict = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+
+    def page(self, conversation_id: str, limit: int) -> Optional[List[Message]]:
+        """The newest limit messages in chronological order, or None on a miss."""
+        entry = self._entries.get(conversation_id)
+        if entry is None or entry["loading"]:
+            self.misses += 1
+            return None
+        if entry["expires"] < time.monotonic():
+            self.pop(conversation_id)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(conversation_id)
+        self.hits += 1
+        return entry["messages"][-limit:]
+
+    def start_loading(self, conversation_id: str):
+        """Reserve an entry before reading Mongo, so messages added meanwhile are kept."""
+        if conversation_id not in self._entries:
+            self._entries[conversation_id] = {
+                "messages": [], "ids": set(), "bytes": 0, "expires": 0, "loading": True
+            }
+
+    def finish_loading(self, conversation_id: str, messages: List[Message]):
+        entry = self._entries.get(conversation_id)
+        if entry is None or not entry["loading"]:
+            return  # Popped or loaded by a concurrent read meanwhile
+        for message in messages:
+            self._insert(entry, message)
+        entry["loading"] = False
+        entry["expires"] = time.monotonic() + self.ttl
+        self._entries.move_to_end(conversation_id)
+        self._evict()
+
+    def add(self, message: Message):
+        entry = self._entries.get(message.conversation_id)
+        if entry is not None:
+            self._insert(entry, message)
+            self._evict()
+
+    def _insert(self, entry: dict, message: Message):
+        if message.id in entry["ids"]:
+            return
+        bisect.insort(entry["messages"], message, key=_message_key)
+        entry["ids"].add(message.id)
+        added = len(message.content) + RECENT_MESSAGE_OVERHEAD_BYTES
+        entry["bytes"] += added
+        self.size += added
+        if len(entry["messages"]) > self.per_conversation:
+            dropped = entry["messages"].pop(0)
+            entry["ids"].discard(dropped.id)
+            removed = len(dropped.content) + RECENT_MESSAGE_OVERHEAD_BYTES
+            entry["bytes"] -= removed
+            self.size -= removed
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            conversation_id = next(iter(self._entries))
+            self.pop(conversation_id)
+
+    def pop(self, conversation_id: str):
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self.size -= entry["bytes"]
+
+    def clear(self):
+        # Loads in flight find their entry gone and are not cached
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "conversations": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+        }
+
+recent_messages = RecentMessageBuffer()
+# Kept current by RECENT_MESSAGES_CHANNEL rather than per-key invalidations;
+# registered so that lost bus traffic clears it with the other caches
+invalidatable_caches["recent_messages"] = recent_messages
+
+@message_hook
+async def share_recent_message(message: Message, member_ids: frozenset):
+    manager.bus.publish(RECENT_MESSAGES_CHANNEL, encode_frame(message.model_dump()))
+
+def _on_recent_message(frame: str):
+    recent_messages.add(Message(**orjson.loads(frame)))
+
+manager.subscribe_channel(RECENT_MESSAGES_CHANNEL, _on_recent_message)
+
+async def create_message(message_data: MessageCreate, sender: UserProfile) -> Message:
+    """Store a message and fan it out; shared by the HTTP and WebSocket send paths."""
+    # Check if conversation exists and user is participant
+    member_ids = await require_membership(message_data.conversation_id, sender.id)
     
     # Create message
     message_dict = {
         "id": str(uuid.uuid4()),
-        "sender_id": current_user.id,
-        "sender_name": current_user.display_name,
-        "sender_avatar": current_user.avatar_url,
+        "sender_id": sender.id,
+        "sender_name": sender.display_name,
+        "sender_avatar": sender.avatar_url,
         "content": message_data.content,
         "conversation_id": message_data.conversation_id,
         "timestamp": datetime.utcnow(),
         "message_type": "text"
     }
-    
-    await db.messages.insert_one(message_dict)
-    
-    # Update conversation last message
-    await db.conversations.update_one(
-        {"id": message_data.conversation_id},
-        {"$set": {"updated_at": datetime.utcnow()}}
-    )
+    if message_data.client_id:
+        message_dict["client_id"] = message_data.client_id
+    message_dict["seq"] = next_sync_seq()
     
     message = Message(**message_dict)
+    try:
+        await message_writer.submit(message_dict)
+    except DuplicateKeyError:
+        # A retry of a message that was already stored: return the original
+        existing = await db.messages.find_one(
+            {"sender_id": sender.id, "client_id": message_data.client_id}
+        )
+        if existing is None:
+            raise
+        if (existing["conversation_id"], existing["content"]) != (message_data.conversation_id, message_data.content):
+            raise HTTPException(status_code=409, detail="client_id was already used for another message")
+        return Message(**existing)
     
-    # Send to all participants via WebSocket
-    message_dict_for_ws = message_dict.copy()
-    message_dict_for_ws["timestamp"] = message_dict["timestamp"].isoformat()
-    
-    await manager.send_to_group({
-        "type": "new_message",
-        "message": message_dict_for_ws
-    }, participant_ids)
+    # Before responding, so the sender's next history read on this worker has it
+    recent_messages.add(message)
+    # Fan-out and other side effects run after the response is sent
+    for hook in message_hooks:
+        await post_commit.submit(message.conversation_id, hook, message, member_ids)
     
     return message
 
+@message_hook
+async def fan_out_message(message: Message, member_ids: frozenset):
+    started = time.perf_counter()
+    event = {"type": "new_message", "message": message.model_dump(), "cursor": settled_sync_cursor(message.seq)}
+    if len(member_ids) <= LARGE_GROUP_THRESHOLD:
+        # Send to all participants via WebSocket
+        await manager.send_to_group(event, member_ids)
+        fanout_seconds.observe(time.perf_counter() - started, "per_member")
+    else:
+        publish_to_large_group(message.conversation_id, event)
+        fanout_seconds.observe(time.perf_counter() - started, "large_group")
+
+def publish_to_large_group(conversation_id: str, event: dict, exclude_user_id: Optional[str] = None):
+    """One publish for the whole group; every worker delivers only to the
+    members it holds live sockets for."""
+    payload = {"conversation_id": conversation_id, "frame": encode_frame(event)}
+    if exclude_user_id:
+        payload["exclude_user_id"] = exclude_user_id
+    manager.bus.publish(GROUP_FANOUT_CHANNEL, encode_frame(payload))
+
+# Frames (with the member to skip) for conversations whose members are being
+# loaded, in arrival order, and the tasks loading them
+pending_group_frames: Dict[str, List[tuple]] = {}
+group_member_loads: Dict[str, asyncio.Task] = {}
+
+async def deliver_pending_group_frames(conversation_id: str):
+    try:
+        members = await get_conversation_members(conversation_id)
+    except Exception as e:
+        logger.error("Loading members of %s for fan-out failed: %s", conversation_id, e)
+        members = None
+    finally:
+        group_member_loads.pop(conversation_id, None)
+        frames = pending_group_frames.pop(conversation_id, [])
+    if members:
+        for frame, exclude_user_id in frames:
+            manager.send_frame_to_members(frame, members["member_ids"], exclude_user_id)
+
+def _on_group_fanout(payload: str):
+    event = orjson.loads(payload)
+    conversation_id = event["conversation_id"]
+    # Behind a pending load, a frame waits its turn even if the cache has since
+    # been filled, so members never see messages out of order
+    frame, exclude_user_id = event["frame"], event.get("exclude_user_id")
+    if conversation_id in pending_group_frames:
+        pending_group_frames[conversation_id].append((frame, exclude_user_id))
+        return
+    members = membership_cache.get(conversation_id)
+    if members:
+        manager.send_frame_to_members(frame, members["member_ids"], exclude_user_id)
+    else:
+        pending_group_frames[conversation_id] = [(frame, exclude_user_id)]
+        group_member_loads[conversation_id] = asyncio.create_task(deliver_pending_group_frames(conversation_id))
+
+manager.subscribe_channel(GROUP_FANOUT_CHANNEL, _on_group_fanout)
+
+@api_router.post("/messages", response_model=Message)
+async def send_message(
+    message_data: MessageCreate,
+    current_user: UserProfile = Depends(get_current_user)
+):
+    return await create_message(message_data, current_user)
+
+async def recent_message_page(conversation_id: str, limit: int) -> List[Message]:
+    """Newest limit messages, loading the conversation's buffer on a miss."""
+    page = recent_messages.page(conversation_id, limit)
+    if page is not None:
+        return page
+    recent_messages.start_loading(conversation_id)
+    try:
+        newest = await db.messages.find({"conversation_id": conversation_id}).sort(
+            [("timestamp", -1), ("id", -1)]
+        ).limit(recent_messages.per_conversation).to_list(None)
+    except BaseException:
+        # Includes cancellation, which would otherwise leave the entry loading
+        recent_messages.pop(conversation_id)
+        raise
+    messages = [Message(**msg) for msg in reversed(newest)]
+    recent_messages.finish_loading(conversation_id, messages)
+    return messages[-limit:]
+
 @api_router.get("/conversations/{conversation_id}/messages", response_model=List[Message])
 async def get_messages(
     conversation_id: str,
-    limit: int = 50,
+    response: Response,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
     current_user: UserProfile = Depends(get_current_user)
 ):
+    """Message history in chronological order.
+
+    Without a cursor the newest page is returned. `before` pages back in time
+    and `after` pages forward; the X-Next-Cursor header continues in the same
+    direction and is omitted once there are no more messages.
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+
     # Check if user is participant
-    conversation = await db.conversations.find_one({"id": conversation_id})
-    if not conversation:
-        raise HTTPException(status_code=404, detail="Conversation not found")
+    await require_membership(conversation_id, current_user.id)
     
-    participant_ids = [p["id"] for p in conversation["participants"]]
-    if current_user.id not in participant_ids:
-        raise HTTPException(status_code=403, detail="Not a participant in this conversation")
+    if not (before or after) and limit <= recent_messages.per_conversation:
+        messages = await recent_message_page(conversation_id, limit)
+        if len(messages) == limit:
+            edge = messages[0]
+            response.headers[NEXT_CURSOR_HEADER] = encode_cursor(edge.timestamp, edge.id)
+        return messages
+    recent_messages.bypasses += 1
     
-    messages = await db.messages.find(
-        {"conversation_id": conversation_id}
-    ).sort("timestamp", -1).limit(limit).to_list(limit)
+    query = {"conversation_id": conversation_id}
+    direction = 1 if after else -1
+    cursor = before or after
+    if cursor:
+        timestamp, message_id = decode_cursor(cursor, datetime, str)
+        query.update(keyset_filter("timestamp", timestamp, message_id, "$gt" if after else "$lt"))
     
-    messages.reverse()  # Return in chronological order
+    messages = await db.messages.find(query).sort(
+        [("timestamp", direction), ("id", direction)]
+    ).limit(limit).to_list(limit)
+    
+    if len(messages) == limit:
+        # The page edge furthest from the starting point
+        edge = messages[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(edge["timestamp"], edge["id"])
+    if direction == -1:
+        messages.reverse()  # Return in chronological order
     return [Message(**msg) for msg in messages]
 
+# Message search: an inverted index in message_terms with one posting per
+# (term, message), kept in commit order by a post-commit hook. Queries walk the
+# postings of one term across the caller's conversations newest first and
+# check the remaining terms against the message content.
+MESSAGE_SEARCH_MAX_TERMS = 100
+MESSAGE_SEARCH_SCAN_LIMIT = 5000
+SNIPPET_CONTEXT = 60
+_WORD_RE = re.compile(r"\w+")
+
+def message_search_terms(text: str) -> List[str]:
+    terms = dict.fromkeys(
+        term for term in _WORD_RE.findall(normalize_search_text(text)) if len(term) >= 2
+    )
+    return list(terms)[:MESSAGE_SEARCH_MAX_TERMS]
+
+def message_postings(message: dict) -> List[dict]:
+    return [
+        {
+            "term": term,
+            "conversation_id": message["conversation_id"],
+            "timestamp": message["timestamp"],
+            "message_id": message["id"]
+        }
+        for term in message_search_terms(message["content"])
+    ]
+
+async def insert_postings(postings: List[dict]):
+    try:
+        await db.message_terms.insert_many(postings, ordered=False)
+    except BulkWriteError as e:
+        # Re-indexing an already indexed message is harmless
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+
+async def index_message_terms(messages: List[dict]):
+    """Search postings for a write batch, stored with one insert_many."""
+    postings = [posting for message in messages for posting in message_postings(message)]
+    if postings:
+        await insert_postings(postings)
+
+def build_snippet(content: str, terms: set) -> tuple:
+    matches = [
+        (m.start(), m.end()) for m in _WORD_RE.finditer(content)
+        if normalize_search_text(m.group()) in terms
+    ]
+    if not matches:
+        return content[:SNIPPET_CONTEXT * 2], []
+    start = max(matches[0][0] - SNIPPET_CONTEXT, 0)
+    end = min(matches[0][1] + SNIPPET_CONTEXT, len(content))
+    highlights = [[s - start, e - start] for s, e in matches if s >= start and e <= end]
+    return content[start:end], highlights
+
+@api_router.get("/messages/search", response_model=List[MessageSearchHit])
+async def search_messages(
+    response: Response,
+    query: str = Query(min_length=1, max_length=200),
+    conversation_id: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    current_user: UserProfile = Depends(get_current_user)
+):
+    """Messages containing every query term, newest first, from conversations
+    the caller belongs to. Paged with the X-Next-Cursor header; a page may be
+    short when the scan limit is hit, in which case the cursor continues it."""
+    terms = message_search_terms(query)
+    if not terms:
+        raise HTTPException(status_code=400, detail="Query must contain a word of at least 2 characters")
+    
+    if conversation_id:
+        await require_membership(conversation_id, current_user.id)
+        conversation_ids = [conversation_id]
+    else:
+        conversation_ids = await member_conversation_ids(current_user.id)
+    
+    # Drive the scan with the longest term, usually the most selective one
+    driver = max(terms, key=len)
+    wanted = set(terms)
+    query_filter = {"term": driver, "conversation_id": {"$in": conversation_ids}}
+    if after:
+        timestamp, message_id = decode_cursor(after, datetime, str)
+        query_filter.update(keyset_filter("timestamp", timestamp, message_id, "$lt", id_field="message_id"))
+    
+    postings = db.message_terms.find(query_filter, {"message_id": 1, "timestamp": 1}).sort(
+        [("timestamp", -1), ("message_id", -1)]
+    )
+    hits = []
+    scanned = 0
+    last_posting = None
+    exhausted = False
+    chunk_size = limit * 4
+    while len(hits) < limit and scanned < MESSAGE_SEARCH_SCAN_LIMIT:
+        chunk = await postings.to_list(length=chunk_size)
+        scanned += len(chunk)
+        if chunk:
+            last_posting = await _collect_search_hits(chunk, wanted, hits, limit)
+        if len(chunk) < chunk_size and (not chunk or last_posting is chunk[-1]):
+            exhausted = True
+            break
+    
+    if not exhausted and last_posting:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(last_posting["timestamp"], last_posting["message_id"])
+    return hits
+
+async def _collect_search_hits(chunk: List[dict], wanted: set, hits: List[MessageSearchHit], limit: int) -> dict:
+    """Append hits from a chunk of postings; returns the last posting examined."""
+    messages = await db.messages.find({"id": {"$in": [p["message_id"] for p in chunk]}}).to_list(None)
+    by_id = {message["id"]: message for message in messages}
+    last = chunk[-1]
+    for posting in chunk:
+        last = posting
+        message = by_id.get(posting["message_id"])
+        if message and wanted.issubset(message_search_terms(message["content"])):
+            snippet, highlights = build_snippet(message["content"], wanted)
+            hits.append(MessageSearchHit(message=Message(**message), snippet=snippet, highlights=highlights))
+            if len(hits) == limit:
+                break
+    return last
+
 # Conversation routes
 @api_router.post("/conversations", response_model=Conversation)
 async def create_conversation(
@@ -440,45 +2429,74 @@ async def create_conversation(
     if not conv_data.is_group and len(participant_ids) == 2:
         existing_conv = await db.conversations.find_one({
             "is_group": False,
-            "participants.id": {"$all": participant_ids}
+            "participant_ids": {"$all": participant_ids, "$size": 2}
         })
         if existing_conv:
+            await hydrate_participants([existing_conv])
             return Conversation(**existing_conv)
     
     # Get participant profiles
     participants = await db.users.find(
         {"id": {"$in": participant_ids}},
-        {"password_hash": 0}
-    ).to_list(100)
+        USER_PUBLIC_PROJECTION
+    ).to_list(None)
     
+    member_ids = [user["id"] for user in participants]
     conversation_dict = {
         "id": str(uuid.uuid4()),
-        "participants": participants,
+        "participant_ids": member_ids,
+        "member_count": len(participants),
+        "created_by": current_user.id,
         "is_group": conv_data.is_group,
         "group_name": conv_data.group_name,
         "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow()
+        "updated_at": datetime.utcnow(),
+        "seq": next_sync_seq()
     }
+    if conv_data.is_group and len(member_ids) > LARGE_GROUP_THRESHOLD:
+        # Members first: until the conversation exists nobody can see them
+        await insert_group_members(conversation_dict["id"], member_ids)
+        del conversation_dict["participant_ids"]
+        conversation_dict.update(large=True, member_preview=member_ids[:LARGE_GROUP_PREVIEW])
+        participants = participants[:LARGE_GROUP_PREVIEW]
     
     await db.conversations.insert_one(conversation_dict)
     
-    return Conversation(**conversation_dict)
+    return Conversation(**conversation_dict, participants=participants)
 
 @api_router.get("/conversations", response_model=List[Conversation])
-async def get_conversations(current_user: UserProfile = Depends(get_current_user)):
+async def get_conversations(
+    response: Response,
+    before: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=200),
+    current_user: UserProfile = Depends(get_current_user)
+):
+    keyset = {}
+    if before:
+        updated_at, conversation_id = decode_cursor(before, datetime, str)
+        keyset = keyset_filter("updated_at", updated_at, conversation_id, "$lt")
+    # participant_ids grows with group size; the inbox only needs a preview
     conversations = await db.conversations.find(
-        {"participants.id": current_user.id}
-    ).sort("updated_at", -1).to_list(100)
-    
-    # Get last message for each conversation
-    for conv in conversations:
-        last_message = await db.messages.find_one(
-            {"conversation_id": conv["id"]},
-            sort=[("timestamp", -1)]
+        {"participant_ids": current_user.id, **keyset}, {"_id": 0, "participant_ids": {"$slice": LARGE_GROUP_PREVIEW}}
+    ).sort(
+        [("updated_at", -1), ("id", -1)]
+    ).limit(limit).to_list(limit)
+    # Large groups are found through conversation_members. A user is in few of
+    # them, so they are fetched by id and merged in here.
+    large_ids = await large_conversation_ids(current_user.id)
+    if large_ids:
+        large = await db.conversations.find(
+            {"id": {"$in": large_ids}, **keyset}, {"_id": 0}
+        ).to_list(None)
+        conversations = merge_conversation_pages(
+            [conversations, large], lambda conv: (conv["updated_at"], conv["id"]), limit, reverse=True
         )
-        if last_message:
-            conv["last_message"] = last_message
+    if len(conversations) == limit:
+        edge = conversations[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(edge["updated_at"], edge["id"])
     
+    # last_message is kept on the conversation document by send_message
+    await hydrate_participants(conversations)
     return [Conversation(**conv) for conv in conversations]
 
 # Group routes
@@ -494,67 +2512,616 @@ async def create_group(
     )
     return await create_conversation(conv_data, current_user)
 
+MAX_PARTICIPANTS_PER_REQUEST = 1000
+
+async def require_group_member(group_id: str, user_id: str) -> dict:
+    members = await get_conversation_members(group_id)
+    if not members or not members["is_group"]:
+        raise HTTPException(status_code=404, detail="Group not found")
+    
+    if user_id not in members["member_ids"]:
+        raise HTTPException(status_code=403, detail="Not a member of this group")
+    return members
+
 @api_router.put("/groups/{group_id}/participants")
 async def add_participants(
     group_id: str,
     participant_ids: List[str],
     current_user: UserProfile = Depends(get_current_user)
 ):
-    conversation = await db.conversations.find_one({"id": group_id, "is_group": True})
-    if not conversation:
-        raise HTTPException(status_code=404, detail="Group not found")
-    
-    current_participant_ids = [p["id"] for p in conversation["participants"]]
-    if current_user.id not in current_participant_ids:
-        raise HTTPException(status_code=403, detail="Not a member of this group")
+    if len(participant_ids) > MAX_PARTICIPANTS_PER_REQUEST:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_PARTICIPANTS_PER_REQUEST} participants per request"
+        )
+    members = await require_group_member(group_id, current_user.id)
     
-    # Get new participants
+    # Only add users that exist and are not members yet
+    candidate_ids = [user_id for user_id in set(participant_ids) if user_id not in members["member_ids"]]
     new_participants = await db.users.find(
-        {"id": {"$in": participant_ids}},
-        {"password_hash": 0}
-    ).to_list(100)
+        {"id": {"$in": candidate_ids}},
+        {"id": 1}
+    ).to_list(None)
     
-    # Update conversation
-    all_participants = conversation["participants"] + new_participants
-    await db.conversations.update_one(
-        {"id": group_id},
-        {"$set": {"participants": all_participants, "updated_at": datetime.utcnow()}}
-    )
+    new_ids = [user["id"] for user in new_participants]
+    added = 0
+    if new_ids:
+        changed = {"updated_at": datetime.utcnow(), "seq": next_sync_seq()}
+        previous = None
+        if not members["large"]:
+            # One atomic update appends the ids that are not members yet, in
+            # order, and recounts; concurrent adds never duplicate or miscount
+            previous = await db.conversations.find_one_and_update(
+                {"id": group_id, "large": {"$ne": True}},
+                [
+                    {"$set": {"participant_ids": {"$concatArrays": ["$participant_ids", {"$filter": {
+                        "input": new_ids,
+                        "cond": {"$eq": [{"$in": ["$$this", "$participant_ids"]}, False]}
+                    }}]}}},
+                    {"$set": {"member_count": {"$size": "$participant_ids"}, **changed}},
+                ],
+                projection={"participant_ids": 1}
+            )
+        if previous is not None:
+            added = len(set(new_ids) - set(previous["participant_ids"]))
+            if len(previous["participant_ids"]) + added > LARGE_GROUP_THRESHOLD:
+                await convert_to_large_group(group_id)
+        else:
+            added = await insert_group_members(group_id, new_ids)
+            await db.conversations.update_one({"id": group_id}, {"$inc": {"member_count": added}, "$set": changed})
+        invalidate_cached("membership", group_id)
     
-    return {"message": "Participants added successfully"}
+    return {"message": "Participants added successfully", "added": added}
+
+@api_router.delete("/groups/{group_id}/participants/{user_id}")
+async def remove_participant(
+    group_id: str,
+    user_id: str,
+    current_user: UserProfile = Depends(get_current_user)
+):
+    members = await require_group_member(group_id, current_user.id)
+    if user_id != current_user.id and members["created_by"] != current_user.id:
+        raise HTTPException(status_code=403, detail="Only the group creator can remove other members")
+    
+    changed = {"updated_at": datetime.utcnow(), "seq": next_sync_seq()}
+    removed = False
+    if not members["large"]:
+        result = await db.conversations.update_one(
+            {"id": group_id, "participant_ids": user_id},
+            {"$pull": {"participant_ids": user_id}, "$inc": {"member_count": -1}, "$set": changed}
+        )
+        removed = result.modified_count > 0
+    if not removed:
+        # A large group, or one converted since its members were cached
+        result = await db.conversation_members.delete_one({"conversation_id": group_id, "user_id": user_id})
+        if result.deleted_count:
+            await db.conversations.update_one(
+                {"id": group_id},
+                {"$pull": {"member_preview": user_id}, "$inc": {"member_count": -1}, "$set": changed}
+            )
+            removed = True
+    if not removed:
+        raise HTTPException(status_code=404, detail="User is not a member of this group")
+    # The removed user no longer matches the conversation, so /sync reports it from here
+    await db.sync_removals.insert_one({
+        "user_id": user_id, "conversation_id": group_id,
+        "seq": next_sync_seq(), "removed_at": datetime.utcnow()
+    })
+    invalidate_cached("membership", group_id)
+    return {"message": "Participant removed successfully"}
+
+@api_router.get("/groups/{group_id}/members", response_model=List[UserProfile])
+async def get_group_members(
+    group_id: str,
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
+    current_user: UserProfile = Depends(get_current_user)
+):
+    """Group members ordered by user id, paged with the X-Next-Cursor header."""
+    members = await require_group_member(group_id, current_user.id)
+    member_ids = sorted_member_ids(members)
+    start = bisect.bisect_right(member_ids, decode_cursor(after, str)[0]) if after else 0
+    page_ids = member_ids[start:start + limit]
+    
+    users = await db.users.find(
+        {"id": {"$in": page_ids}},
+        USER_PUBLIC_PROJECTION
+    ).sort("id", 1).to_list(None)
+    if start + limit < len(member_ids):
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(page_ids[-1])
+    return [UserProfile(**user) for user in users]
+
+# Delta sync: one request returns every change since a cursor, so reconnecting
+# clients need not refetch conversations and their messages. Changes from the
+# last SYNC_SETTLE_SECONDS may be returned again; clients merge them by id.
+SYNC_BATCH_LIMIT = int(os.environ.get("SYNC_BATCH_LIMIT", "500"))
+
+@api_router.get("/sync", response_model=SyncBatch)
+async def sync_changes(
+    since: Optional[str] = None,
+    limit: int = Query(SYNC_BATCH_LIMIT, ge=1, le=1000),
+    current_user: UserProfile = Depends(get_current_user)
+):
+    """Changes ordered by seq. Apply removed_conversation_ids before conversations:
+    a group the caller left and rejoined is listed in both."""
+    now = time.time()
+    horizon = sync_seq_at(now - SYNC_SETTLE_SECONDS)
+    since_seq = decode_cursor(since, int)[0] if since else None
+    if since_seq is None or since_seq < sync_seq_at(now - SYNC_RETENTION_DAYS * 86400):
+        return SyncBatch(cursor=encode_cursor(horizon), reset=True)
+
+    async def changed_messages():
+        conversation_ids = await member_conversation_ids(current_user.id)
+        return await db.messages.find(
+            {"conversation_id": {"$in": conversation_ids}, "seq": {"$gt": since_seq}}, {"_id": 0}
+        ).sort("seq", 1).limit(limit + 1).to_list(limit + 1)
+
+    async def changed_conversations():
+        small = await db.conversations.find(
+            {"participant_ids": current_user.id, "seq": {"$gt": since_seq}},
+            {"_id": 0, "participant_ids": {"$slice": LARGE_GROUP_PREVIEW}}
+        ).sort("seq", 1).limit(limit + 1).to_list(limit + 1)
+        large_ids = await large_conversation_ids(current_user.id)
+        if not large_ids:
+            return small
+        large = await db.conversations.find({"id": {"$in": large_ids}, "seq": {"$gt": since_seq}}, {"_id": 0}).to_list(None)
+        return merge_conversation_pages([small, large], lambda conv: conv["seq"], limit + 1)
+
+    conversations, removals, messages = await asyncio.gather(
+        changed_conversations(),
+        db.sync_removals.find(
+            {"user_id": current_user.id, "seq": {"$gt": since_seq}}
+        ).sort("seq", 1).limit(limit + 1).to_list(limit + 1),
+        changed_messages(),
+    )
+
+    # A full page ends the batch at its last seq; other lists may run past it
+    # and are returned again on the next call. The last batch resumes from the
+    # horizon, which may be behind since: that re-reads recent changes so any
+    # still committing when the pages were read are picked up next time.
+    page_ends = []
+    for changes in (conversations, removals, messages):
+        if len(changes) > limit:
+            del changes[limit:]
+            page_ends.append(changes[-1]["seq"])
+    cursor = min(page_ends) if page_ends else horizon
+
+    await hydrate_participants(conversations)
+    return SyncBatch(
+        cursor=encode_cursor(cursor),
+        has_more=bool(page_ends),
+        messages=[Message(**message) for message in messages],
+        conversations=[Conversation(**conv) for conv in conversations],
+        removed_conversation_ids=[removal["conversation_id"] for removal in removals],
+    )
 
 # WebSocket endpoint
+async def handle_websocket_command(command, user: UserProfile, connection_id: str):
+    if isinstance(command, SendMessageCommand):
+        message = await create_message(command, user)
+        await manager.send_personal_message(encode_frame({
+            "type": "ack",
+            "client_id": command.client_id,
+            "message": message.model_dump()
+        }), connection_id)
+        return
+
+    if isinstance(command, AckCommand):
+        message = await db.messages.find_one(
+            {"id": command.message_id}, {"sender_id": 1, "conversation_id": 1}
+        )
+        if not message:
+            raise HTTPException(status_code=404, detail="Message not found")
+        await require_membership(message["conversation_id"], user.id)
+        await manager.send_to_user({
+            "type": "delivered",
+            "message_id": command.message_id,
+            "conversation_id": message["conversation_id"],
+            "user_id": user.id
+        }, message["sender_id"])
+        return
+
+    member_ids = await require_membership(command.conversation_id, user.id)
+    members = await get_conversation_members(command.conversation_id)
+
+    async def send_to_others(event: dict):
+        if members["large"]:
+            # Live-only, like large-group messages: one publish instead of one per member
+            publish_to_large_group(command.conversation_id, event, exclude_user_id=user.id)
+        else:
+            await manager.send_to_group(event, [p for p in member_ids if p != user.id])
+
+    if isinstance(command, TypingCommand):
+        await send_to_others({
+            "type": "typing",
+            "conversation_id": command.conversation_id,
+            "user_id": user.id,
+            "is_typing": command.is_typing
+        })
+    elif isinstance(command, MarkReadCommand):
+        read_at = datetime.utcnow()
+        # Kept apart from the conversation document, which would otherwise grow
+        # and be rewritten with every member's read position
+        await db.read_receipts.update_one(
+            {"conversation_id": command.conversation_id, "user_id": user.id},
+            {"$set": {"message_id": command.message_id, "read_at": read_at}},
+            upsert=True
+        )
+        await send_to_others({
+            "type": "message_read",
+            "conversation_id": command.conversation_id,
+            "message_id": command.message_id,
+            "user_id": user.id,
+            "read_at": read_at
+        })
+    if command.client_id:
+        await manager.send_personal_message(
+            encode_frame({"type": "ack", "client_id": command.client_id}), connection_id
+        )
+
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
+async def websocket_endpoint(websocket: WebSocket, user_id: str, batch: bool = False):
+    # Nothing is delivered until the client sends an "auth" frame with its token
+    # within WS_AUTH_TIMEOUT; the token is checked again for every command, so
+    # an expired token or a token for another user closes the socket. With
+    # ?batch=1 every frame sent to the client is a JSON array of events.
+    await websocket.accept()
+    token = None
     connection_id = str(uuid.uuid4())
-    await manager.connect(websocket, user_id, connection_id)
+    auth_deadline = asyncio.get_running_loop().time() + WS_AUTH_TIMEOUT
     
-    # Update user online status
-    await db.users.update_one(
-        {"id": user_id},
-        {"$set": {"is_online": True, "last_seen": datetime.utcnow()}}
-    )
+    async def reply(frame: dict):
+        if token is None:
+            # Not registered with the manager yet
+            await websocket.send_text(encode_frame(frame))
+        else:
+            await manager.send_personal_message(encode_frame(frame), connection_id)
     
     try:
         while True:
-            data = await websocket.receive_text()
-            # Handle incoming WebSocket messages if needed
-            pass
+            if token is None:
+                try:
+                    data = await asyncio.wait_for(
+                        websocket.receive_text(), auth_deadline - asyncio.get_running_loop().time()
+                    )
+                except asyncio.TimeoutError:
+                    await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                    return
+            else:
+                data = await websocket.receive_text()
+            client_id = None
+            try:
+                frame = orjson.loads(data)
+                if isinstance(frame, dict):
+                    client_id = frame.get("client_id")
+                command = WebSocketCommand.validate_python(frame)
+                if token is None and not isinstance(command, AuthCommand):
+                    raise HTTPException(status_code=401, detail="Send an auth frame to send commands")
+                try:
+                    user = await authenticate_token(command.token if isinstance(command, AuthCommand) else token)
+                except HTTPException:
+                    user = None
+                if user is None or user.id != user_id:
+                    await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                    return
+                if isinstance(command, AuthCommand):
+                    if token is None:
+                        await manager.connect(websocket, user_id, connection_id, WS_COALESCE_MS if batch else 0)
+                        presence.connected(user_id)
+                    token = command.token
+                    if command.client_id:
+                        await reply({"type": "ack", "client_id": command.client_id})
+                    continue
+                await handle_websocket_command(command, user, connection_id)
+            except orjson.JSONDecodeError:
+                await reply({"type": "error", "status": 400, "detail": "Invalid JSON"})
+            except ValidationError as e:
+                await reply({
+                    "type": "error", "client_id": client_id, "status": 422,
+                    "detail": e.errors(include_url=False, include_context=False, include_input=False)
+                })
+            except HTTPException as e:
+                await reply({"type": "error", "client_id": client_id, "status": e.status_code, "detail": e.detail})
+            except Exception:
+                # A failed command (e.g. a database error) must not close the socket
+                logger.exception("WebSocket command failed")
+                await reply({"type": "error", "client_id": client_id, "status": 500, "detail": "Internal server error"})
     except WebSocketDisconnect:
-        manager.disconnect(connection_id, user_id)
-        # Update user offline status
-        await db.users.update_one(
-            {"id": user_id},
-            {"$set": {"is_online": False, "last_seen": datetime.utcnow()}}
-        )
+        pass
+    finally:
+        if token is not None:
+            manager.disconnect(connection_id, user_id)
+            presence.disconnected(user_id)
 
 # Health check
 @api_router.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.utcnow()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.utcnow(),
+        "caches": {
+            "tokens": token_cache.stats(),
+            "profiles": profile_cache.stats(),
+            "membership": membership_cache.stats(),
+            "avatar_files": avatar_file_cache.stats(),
+            "recent_messages": recent_messages.stats()
+        },
+        "websockets": manager.stats(),
+        "presence": presence.stats(),
+        "message_writes": message_writer.stats(),
+        "post_commit": post_commit.stats(),
+        "db_side_effects": db_side_effects.stats(),
+        "loop_lag": loop_lag_monitor.stats()
+    }
+
+# Response compression for the large JSON list endpoints: brotli when the client
+# accepts it and the brotli package is installed, gzip otherwise. Small bodies are
+# sent as they are; large ones are compressed off the event loop.
+COMPRESSED_PATHS = re.compile(
+    r"^/api/(conversations|users|users/search|sync|messages/search"
+    r"|conversations/[^/]+/messages|groups/[^/]+/members)$"
+)
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSION_THREAD_MIN_BYTES = 256 * 1024
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=5)
+
+class ListCompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET" or not COMPRESSED_PATHS.match(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        chunks = []
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            body = b"".join(chunks)
+            headers = MutableHeaders(raw=start["headers"])
+            if len(body) >= COMPRESSION_MIN_BYTES and "content-encoding" not in headers:
+                if len(body) >= COMPRESSION_THREAD_MIN_BYTES:
+                    body = await asyncio.to_thread(compress_body, body, encoding)
+                else:
+                    body = compress_body(body, encoding)
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(body))
+                headers.add_vary_header("Accept-Encoding")
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_compressed)
+
+@api_router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus text exposition of the histograms plus live gauges."""
+    connections_per_user: Dict[str, int] = {}
+    for connection_ids in manager.user_connections.values():
+        bucket = str(len(connection_ids)) if len(connection_ids) < 4 else "4+"
+        connections_per_user[bucket] = connections_per_user.get(bucket, 0) + 1
+    websockets = manager.stats()
+    lines = []
+    for histogram in metrics_registry:
+        lines.extend(histogram.render())
+    lines.extend(render_gauge(
+        "messenger_ws_active_connections", "Open WebSocket connections on this worker.",
+        [((), websockets["connections"])]
+    ))
+    lines.extend(render_gauge(
+        "messenger_ws_connected_users", "Users with at least one WebSocket on this worker.",
+        [((), websockets["users"])]
+    ))
+    # Bucketed rather than labelled by user id, which would be one series per user
+    lines.extend(render_gauge(
+        "messenger_ws_users_by_connection_count", "Connected users by their number of open sockets.",
+        sorted(((bucket,), count) for bucket, count in connections_per_user.items()), ("connections",)
+    ))
+    lines.extend(render_gauge(
+        "messenger_ws_queued_frames", "Frames waiting in WebSocket send queues.",
+        [((), websockets["queued_frames"])]
+    ))
+    lines.extend(render_gauge(
+        "messenger_post_commit_queued", "Jobs waiting on the post-commit pipelines.",
+        [(("fanout",), post_commit.stats()["queued"]), (("db",), db_side_effects.stats()["queued"])],
+        ("pipeline",)
+    ))
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+# Diagnostics. The loop lag monitor is a heartbeat coroutine watched by a thread:
+# when the heartbeat is late by more than LOOP_LAG_THRESHOLD_MS, the thread logs
+# the stack the event loop is stuck in, once per stall. A threshold of 0 (the
+# default) leaves it off. Admins (ADMIN_USERNAMES) can run a time-bounded
+# sampling profile of this worker and get collapsed stacks for flamegraph.pl or
+# speedscope; nothing is sampled outside a profile.
+LOOP_LAG_THRESHOLD_MS = float(os.environ.get("LOOP_LAG_THRESHOLD_MS", "0"))
+LOOP_LAG_INTERVAL = 0.05
+ADMIN_USERNAMES = {name for name in os.environ.get("ADMIN_USERNAMES", "").split(",") if name}
+PROFILE_MAX_SECONDS = 60
+
+loop_lag_seconds = Histogram("messenger_event_loop_lag_seconds", "How late the loop lag heartbeat woke up.")
+
+def format_stack(frame) -> str:
+    return "".join(traceback.format_stack(frame))
+
+class LoopLagMonitor:
+    def __init__(self, threshold_ms: float = LOOP_LAG_THRESHOLD_MS, interval: float = LOOP_LAG_INTERVAL):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval
+        self.last_beat = time.monotonic()
+        self.stalls = 0
+        self._loop_thread_id: Optional[int] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self):
+        if not self.threshold or self._heartbeat:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self.last_beat = time.monotonic()
+        self._heartbeat = asyncio.create_task(self._beat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        if not self._heartbeat:
+            return
+        self._stop.set()
+        self._heartbeat.cancel()
+        self._heartbeat = None
+
+    async def _beat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_beat = time.monotonic()
+            loop_lag_seconds.observe(max(self.last_beat - expected, 0))
+
+    def _watch(self):
+        reported = None
+        while not self._stop.wait(self.interval):
+            beat = self.last_beat
+            stalled_for = time.monotonic() - beat
+            if stalled_for < self.threshold or reported == beat:
+                continue
+            reported = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            logger.warning(
+                "Event loop blocked for %.0f ms so far, in:\n%s",
+                stalled_for * 1000, format_stack(frame) if frame else "<no frame>"
+            )
+
+    def stats(self) -> dict:
+        return {"enabled": bool(self.threshold), "threshold_ms": self.threshold * 1000, "stalls": self.stalls}
+
+loop_lag_monitor = LoopLagMonitor()
+
+def collapse_frame(frame) -> str:
+    """Root-first "func (file:line)" frames joined with ";", as flamegraph.pl expects."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class SamplingProfiler:
+    """Samples every thread's stack at a fixed interval from a background thread."""
+
+    def __init__(self):
+        self.running = False
+
+    def run(self, seconds: float, interval: float) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = f"{names.get(thread_id, thread_id)};{collapse_frame(frame)}"
+                counts[stack] = counts.get(stack, 0) + 1
+            time.sleep(interval)
+        return counts
+
+profiler = SamplingProfiler()
+
+async def require_admin(current_user: UserProfile = Depends(get_current_user)) -> UserProfile:
+    if current_user.username not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return current_user
+
+@api_router.post("/admin/profile", response_class=PlainTextResponse)
+async def profile_worker(
+    seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+    interval_ms: float = Query(5, ge=1, le=1000),
+    admin: UserProfile = Depends(require_admin)
+):
+    """Profile this worker for the given time; returns collapsed stacks, one
+    "thread;frame;...;frame count" line per distinct stack."""
+    if profiler.running:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    profiler.running = True
+    try:
+        counts = await asyncio.to_thread(profiler.run, seconds, interval_ms / 1000)
+    finally:
+        profiler.running = False
+    body = "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+    return PlainTextResponse(body, headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'})
+
+class RequestMetricsMiddleware:
+    """Observes http_request_seconds, labelled with the matched route's path template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            http_request_seconds.observe(
+                time.perf_counter() - started, scope["method"],
+                route.path if route is not None else "unmatched", str(status_code)
+            )
 
 # Include the router in the main app
 app.include_router(api_router)
+app.add_middleware(ListCompressionMiddleware)
+app.add_middleware(RequestMetricsMiddleware)
 
 # CORS middleware
 app.add_middleware(
@@ -563,6 +3130,7 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 # Configure logging
@@ -572,10 +3140,190 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def _index_name(keys):
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+def _normalize_index_keys(keys):
+    # The server may report directions as floats (1.0) for indexes built by other tools
+    return [
+        (field, int(direction) if isinstance(direction, (int, float)) else direction)
+        for field, direction in keys
+    ]
+
+async def ensure_indexes():
+    """Create the indexes in INDEX_SPECS and report any that are missing or differ.
+
+    Returns a list of problems; an empty list means every index is in place.
+    """
+    problems = []
+    for collection_name, keys, options in INDEX_SPECS:
+        collection = db[collection_name]
+        name = _index_name(keys)
+        try:
+            await collection.create_index(keys, name=name, **options)
+        except OperationFailure as e:
+            # An index with the same keys or name but different options already exists
+            problems.append(f"{collection_name}.{name}: could not be created ({e.details or e})")
+            continue
+
+        existing = await collection.index_information()
+        matching = [
+            info for info in existing.values()
+            if _normalize_index_keys(info["key"]) == keys
+        ]
+        if not matching:
+            problems.append(f"{collection_name}.{name}: missing")
+        elif not any(bool(info.get("unique", False)) == options.get("unique", False) for info in matching):
+            problems.append(
+                f"{collection_name}.{name}: built with unique={matching[0].get('unique', False)}, "
+                f"expected unique={options.get('unique', False)}"
+            )
+
+    for problem in problems:
+        logger.warning("Index check failed: %s", problem)
+    if not problems:
+        logger.info("All %d indexes verified", len(INDEX_SPECS))
+    return problems
+
+@app.on_event("startup")
+async def startup_ensure_indexes():
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def startup_event_bus():
+    await manager.bus.start()
+    await presence.start()
+    loop_lag_monitor.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await message_writer.drain()
+    await post_commit.drain()
+    await db_side_effects.drain()
+    await presence.stop()
+    await loop_lag_monitor.stop()
+    await manager.bus.stop()
     client.close()
+    password_hash_executor.shutdown(wait=False, cancel_futures=True)
+    image_executor.shutdown(wait=False, cancel_futures=True)
+
+async def backfill_conversation_summaries():
+    """One-off: fill last_message and message_count for conversations created before they were tracked."""
+    pipeline = [
+        {"$sort": {"conversation_id": 1, "timestamp": -1}},
+        {"$group": {
+            "_id": "$conversation_id",
+            "last_message": {"$first": "$$ROOT"},
+            "message_count": {"$sum": 1}
+        }}
+    ]
+    updates = []
+    async for summary in db.messages.aggregate(pipeline, allowDiskUse=True):
+        last_message = Message(**summary["last_message"])
+        updates.append(UpdateOne(
+            {"id": summary["_id"]},
+            {"$set": {"last_message": last_message.model_dump(), "message_count": summary["message_count"]}}
+        ))
+        if len(updates) >= 1000:
+            await db.conversations.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        await db.conversations.bulk_write(updates, ordered=False)
+    logger.info("Backfilled conversation summaries")
+
+async def migrate_conversation_membership():
+    """One-off: replace embedded participant profiles with a participant_ids array and member_count."""
+    updates = []
+    async for conversation in db.conversations.find(
+        {
+            "$or": [{"participant_ids": {"$exists": False}}, {"member_count": {"$exists": False}}],
+            "large": {"$ne": True}
+        },
+        {"id": 1, "participants.id": 1, "participant_ids": 1}
+    ):
+        if "participant_ids" in conversation:
+            participant_ids = conversation["participant_ids"]
+        else:
+            participant_ids = list(dict.fromkeys(p["id"] for p in conversation.get("participants", [])))
+        updates.append(UpdateOne(
+            {"id": conversation["id"]},
+            {
+                "$set": {"participant_ids": participant_ids, "member_count": len(participant_ids)},
+                "$unset": {"participants": ""}
+            }
+        ))
+        if len(updates) >= 1000:
+            await db.conversations.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        await db.conversations.bulk_write(updates, ordered=False)
+    logger.info("Migrated conversation membership")
+
+async def migrate_large_groups():
+    """One-off: move large groups' members to conversation_members and read_state to read_receipts."""
+    async for conversation in db.conversations.find(
+        {"is_group": True, f"participant_ids.{LARGE_GROUP_THRESHOLD}": {"$exists": True}}, {"id": 1}
+    ):
+        await convert_to_large_group(conversation["id"])
+    receipts = []
+    async for conversation in db.conversations.find({"read_state": {"$exists": True}}, {"id": 1, "read_state": 1}):
+        receipts.extend(
+            UpdateOne(
+                {"conversation_id": conversation["id"], "user_id": user_id},
+                # Receipts written since the deploy are newer than read_state
+                {"$setOnInsert": {"message_id": state["message_id"], "read_at": state["read_at"]}},
+                upsert=True
+            )
+            for user_id, state in conversation["read_state"].items()
+        )
+        if len(receipts) >= 1000:
+            await db.read_receipts.bulk_write(receipts, ordered=False)
+            receipts = []
+    if receipts:
+        await db.read_receipts.bulk_write(receipts, ordered=False)
+    await db.conversations.update_many({"read_state": {"$exists": True}}, {"$unset": {"read_state": ""}})
+    logger.info("Migrated large groups and read receipts")
+
+async def backfill_user_search_fields():
+    """One-off: add search keys to users registered before search indexing."""
+    updates = []
+    async for user in db.users.find(
+        {"search_tokens": {"$exists": False}}, {"id": 1, "username": 1, "display_name": 1}
+    ):
+        updates.append(UpdateOne(
+            {"id": user["id"]},
+            {"$set": user_search_fields(user["username"], user["display_name"])}
+        ))
+        if len(updates) >= 1000:
+            await db.users.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        await db.users.bulk_write(updates, ordered=False)
+    logger.info("Backfilled user search fields")
+
+async def backfill_message_search():
+    """One-off: index messages sent before message search existed."""
+    postings = []
+    async for message in db.messages.find({}, {"id": 1, "conversation_id": 1, "timestamp": 1, "content": 1}):
+        postings.extend(message_postings(message))
+        if len(postings) >= 10000:
+            await insert_postings(postings)
+            postings = []
+    if postings:
+        await insert_postings(postings)
+    logger.info("Backfilled message search index")
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill-summaries":
+        asyncio.run(backfill_conversation_summaries())
+    elif len(sys.argv) > 1 and sys.argv[1] == "migrate-membership":
+        asyncio.run(migrate_conversation_membership())
+    elif len(sys.argv) > 1 and sys.argv[1] == "migrate-large-groups":
+        asyncio.run(migrate_large_groups())
+    elif len(sys.argv) > 1 and sys.argv[1] == "backfill-search":
+        asyncio.run(backfill_user_search_fields())
+    elif len(sys.argv) > 1 and sys.argv[1] == "backfill-message-search":
+        asyncio.run(backfill_message_search())
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8001, ws="websockets", ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
\ No newline at end of file
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Cross-worker WebSocket fan-out through the event bus.
+
+Starts two ConnectionManagers standing in for two uvicorn workers, both on a
+RedisEventBus. Recipients are connected to worker B, messages are sent from
+worker A, and every frame must arrive. Runs against the bundled RESP stand-in
+unless --redis-url points at a real Redis. The in-memory bus is measured as
+the single-worker baseline.
+
+    python benchmarks/bench_event_bus.py [--users 500] [--messages 200]
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+from resp_server import RespPubSubServer  # noqa: E402
+
+
+class FakeWebSocket:
+    def __init__(self, latencies: list, done: asyncio.Event, expected: int):
+        self.latencies = latencies
+        self.done = done
+        self.expected = expected
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, frame: str):
+        sent_at = float(frame[frame.index('"sent_at":') + 10:frame.index("}")])
+        self.latencies.append(time.perf_counter() - sent_at)
+        if len(self.latencies) == self.expected:
+            self.done.set()
+
+    async def close(self, code=None):
+        pass
+
+
+async def run(sender: server.ConnectionManager, receiver: server.ConnectionManager,
+              users: int, messages: int) -> dict:
+    latencies = []
+    done = asyncio.Event()
+    expected = users * messages
+    user_ids = [f"user-{i}" for i in range(users)]
+    for user_id in user_ids:
+        await receiver.connect(FakeWebSocket(latencies, done, expected), user_id, f"conn-{user_id}")
+    await asyncio.sleep(0.2)  # let SUBSCRIBE commands reach the bus
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        await sender.send_to_group({"type": "new_message", "sent_at": time.perf_counter()}, user_ids)
+        await asyncio.sleep(0)
+    await asyncio.wait_for(done.wait(), timeout=60)
+    elapsed = time.perf_counter() - start
+
+    for user_id in user_ids:
+        receiver.disconnect(f"conn-{user_id}", user_id)
+    latencies.sort()
+    return {
+        "frames": len(latencies),
+        "frames_per_s": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+async def main(args):
+    print(f"{'bus':<10} {'frames':>8} {'frames/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+
+    local = server.ConnectionManager(server.InMemoryEventBus())
+    r = await run(local, local, args.users, args.messages)
+    print(f"{'memory':<10} {r['frames']:>8} {r['frames_per_s']:>10.0f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f}")
+
+    standin = None
+    url = args.redis_url
+    if not url:
+        standin = RespPubSubServer()
+        url = f"redis://127.0.0.1:{await standin.start()}"
+    worker_a = server.ConnectionManager(server.RedisEventBus(url))
+    worker_b = server.ConnectionManager(server.RedisEventBus(url))
+    await worker_a.bus.start()
+    await worker_b.bus.start()
+    r = await run(worker_a, worker_b, args.users, args.messages)
+    print(f"{'redis':<10} {r['frames']:>8} {r['frames_per_s']:>10.0f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f}")
+    print("publish batches on worker A:", worker_a.bus.stats()["publish_batches"])
+    await worker_a.bus.stop()
+    await worker_b.bus.stop()
+    if standin:
+        await standin.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--redis-url", default="")
+    asyncio.run(main(parser.parse_args()))
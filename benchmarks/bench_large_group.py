@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Fan-out cost for a 10k-member group.
+
+"per-member" publishes the frame once per member id, which is what
+send_to_group does for small groups. "live-only" is the large-group path: a
+single publish that each worker intersects with the members it holds live
+sockets for. Both run on the in-memory bus; with RedisEventBus per-member also
+costs one network publish per member, against a single one for live-only.
+Also times paging through the member list from the cached,
+sorted member set.
+
+With --mongo-url it also times the database side on a real MongoDB: the
+per-message summary update and a read receipt for a group whose members are
+embedded in participant_ids, against the same group stored as a large group
+(members in conversation_members, receipts in read_receipts). mongomock-motor
+maintains no indexes, so it cannot show the write amplification.
+
+    python benchmarks/bench_large_group.py [--members 10000] [--online 100 1000 5000]
+    python benchmarks/bench_large_group.py --mongo-url mongodb://localhost:27017
+"""
+
+import argparse
+import asyncio
+import bisect
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+class CountingWebSocket:
+    frames = 0
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, frame: str):
+        CountingWebSocket.frames += 1
+
+    async def close(self, code=None):
+        pass
+
+
+def timed(func, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+async def main(args):
+    member_ids = frozenset(f"user-{i:06d}" for i in range(args.members))
+    frame = server.encode_frame({"type": "new_message", "message": {"content": "x" * 200}})
+
+    print(f"{args.members} members")
+    print(f"{'online':>7} {'per-member ms':>14} {'live-only ms':>13} {'speedup':>8}")
+    for online in args.online:
+        manager = server.ConnectionManager(server.InMemoryEventBus(), queue_size=args.repeat + 1)
+        for user_id in sorted(member_ids)[:online]:
+            await manager.connect(CountingWebSocket(), user_id, f"conn-{user_id}")
+
+        def per_member():
+            for user_id in member_ids:
+                manager.bus.publish(server.user_channel(user_id), frame)
+
+        def live_only():
+            manager.send_frame_to_members(frame, member_ids)
+
+        naive = timed(per_member, args.repeat)
+        live = timed(live_only, args.repeat)
+        print(f"{online:>7} {naive:>14.3f} {live:>13.3f} {naive / live:>7.1f}x")
+        for connection_id, connection in list(manager.active_connections.items()):
+            manager.disconnect(connection_id, connection.user_id)
+
+    members = {"member_ids": member_ids}
+    start = time.perf_counter()
+    sorted_ids = server.sorted_member_ids(members)
+    first_sort = (time.perf_counter() - start) * 1000
+
+    def page_through():
+        after = None
+        while True:
+            begin = bisect.bisect_right(sorted_ids, after) if after else 0
+            page = sorted_ids[begin:begin + 100]
+            if len(page) < 100:
+                break
+            after = page[-1]
+
+    print(f"member list: first sort {first_sort:.2f} ms, "
+          f"all {args.members // 100} pages of 100 in {timed(page_through, 5):.2f} ms")
+
+    if args.mongo_url:
+        await write_amplification(args, sorted(member_ids))
+
+
+async def write_amplification(args, member_ids: list):
+    server.client = server.AsyncIOMotorClient(args.mongo_url)
+    server.db = server.client[args.db_name]
+    for name in ("conversations", "conversation_members", "read_receipts"):
+        await server.db[name].drop()
+    await server.ensure_indexes()
+
+    def conversation(**fields) -> dict:
+        now = datetime.utcnow()
+        return {"id": str(uuid.uuid4()), "member_count": len(member_ids), "is_group": True, "group_name": "bench",
+                "message_count": 0, "last_message": None, "created_at": now, "updated_at": now, "seq": 0, **fields}
+
+    embedded = conversation(participant_ids=member_ids, read_state={
+        user_id: {"message_id": "m", "read_at": datetime.utcnow()} for user_id in member_ids
+    })
+    large = conversation(large=True, member_preview=member_ids[:server.LARGE_GROUP_PREVIEW])
+    await server.db.conversations.insert_many([embedded, large])
+    await server.insert_group_members(large["id"], member_ids)
+
+    async def summaries(conversation_id: str) -> float:
+        start = time.perf_counter()
+        for i in range(args.db_repeat):
+            now = datetime.utcnow()
+            await server.update_conversation_summaries([{
+                "id": str(uuid.uuid4()), "conversation_id": conversation_id, "sender_id": member_ids[0],
+                "sender_name": "User", "content": "x" * 200, "timestamp": now, "seq": i + 1,
+            }])
+        return (time.perf_counter() - start) * 1000 / args.db_repeat
+
+    async def receipts(read_embedded: bool) -> float:
+        start = time.perf_counter()
+        for i in range(args.db_repeat):
+            user_id = member_ids[i % len(member_ids)]
+            read = {"message_id": str(i), "read_at": datetime.utcnow()}
+            if read_embedded:
+                await server.db.conversations.update_one({"id": embedded["id"]}, {"$set": {f"read_state.{user_id}": read}})
+            else:
+                await server.db.read_receipts.update_one(
+                    {"conversation_id": large["id"], "user_id": user_id}, {"$set": read}, upsert=True
+                )
+        return (time.perf_counter() - start) * 1000 / args.db_repeat
+
+    print(f"\ndatabase, {args.db_repeat} writes each   {'embedded ms':>12} {'large ms':>9}")
+    print(f"{'summary update per message':<33} {await summaries(embedded['id']):>12.3f} {await summaries(large['id']):>9.3f}")
+    print(f"{'read receipt':<33} {await receipts(True):>12.3f} {await receipts(False):>9.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--members", type=int, default=10000)
+    parser.add_argument("--online", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--mongo-url", default="", help="also time database writes on this MongoDB")
+    parser.add_argument("--db-name", default="messenger_bench")
+    parser.add_argument("--db-repeat", type=int, default=200)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Message search latency over a synthetic multi-million message corpus.
+
+Seeds --messages messages (2M by default) spread over --conversations
+conversations, with words drawn from a Zipf-distributed vocabulary, and
+builds their postings exactly as the post-commit hook does. It then times
+search_messages against a case-insensitive $regex scan over the same
+conversations, for common, medium and rare terms. Needs a MongoDB at
+MONGO_URL (backend/.env) or --mongo-url; --mock runs a small corpus on
+mongomock-motor and only checks that the script works.
+
+    python benchmarks/bench_message_search.py [--messages 2000000] [--keep]
+"""
+
+import argparse
+import asyncio
+import itertools
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+from fastapi import Response  # noqa: E402
+
+VOCABULARY_SIZE = 50000
+CALLER_ID = "bench-caller"
+
+
+def make_vocabulary(rng: random.Random) -> list:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+
+async def seed(args, rng: random.Random, vocabulary: list):
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    conversation_ids = [str(uuid.uuid4()) for _ in range(args.conversations)]
+    member_of = set(rng.sample(conversation_ids, args.caller_conversations))
+    await server.db.conversations.insert_many([
+        {"id": cid, "participant_ids": [CALLER_ID] if cid in member_of else [], "is_group": False,
+         "created_at": datetime.utcnow(), "updated_at": datetime.utcnow()}
+        for cid in conversation_ids
+    ])
+
+    start = datetime.utcnow() - timedelta(days=365)
+    messages, postings = [], []
+    for i in range(args.messages):
+        message = {
+            "id": str(uuid.uuid4()),
+            "sender_id": "bench-sender",
+            "sender_name": "Bench",
+            "content": " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(3, 20))),
+            "conversation_id": rng.choice(conversation_ids),
+            "timestamp": start + timedelta(seconds=i * 15),
+            "message_type": "text",
+        }
+        messages.append(message)
+        postings.extend(server.message_postings(message))
+        if len(messages) == 10000:
+            await server.db.messages.insert_many(messages, ordered=False)
+            await server.insert_postings(postings)
+            messages, postings = [], []
+            print(f"  seeded {i + 1}", end="\r")
+    if messages:
+        await server.db.messages.insert_many(messages, ordered=False)
+        await server.insert_postings(postings)
+    print()
+
+
+async def regex_search(query: str, conversation_ids: list):
+    return await server.db.messages.find(
+        {"conversation_id": {"$in": conversation_ids}, "content": {"$regex": query, "$options": "i"}}
+    ).sort("timestamp", -1).to_list(20)
+
+
+async def indexed_search(query: str, caller):
+    return await server.search_messages(
+        response=Response(), query=query, conversation_id=None, after=None,
+        limit=20, current_user=caller,
+    )
+
+
+async def timed(func, *args, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func(*args)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+async def main(args):
+    if args.mock:
+        import mongomock_motor
+        server.client = mongomock_motor.AsyncMongoMockClient()
+    elif args.mongo_url:
+        server.client = server.AsyncIOMotorClient(args.mongo_url)
+    server.db = server.client[args.db_name]
+
+    rng = random.Random(7)
+    vocabulary = make_vocabulary(rng)
+    if await server.db.messages.estimated_document_count() < args.messages:
+        for name in ("messages", "message_terms", "conversations"):
+            await server.db[name].drop()
+        await server.ensure_indexes()
+        print(f"seeding {args.messages} messages")
+        await seed(args, rng, vocabulary)
+
+    caller = server.UserProfile(
+        id=CALLER_ID, username="caller", email="caller@example.com",
+        display_name="Caller", created_at=datetime.utcnow(),
+    )
+    conversation_ids = await server.db.conversations.distinct("id", {"participant_ids": CALLER_ID})
+    queries = {
+        "common": vocabulary[0],
+        "medium": vocabulary[500],
+        "rare": vocabulary[40000],
+        "two terms": f"{vocabulary[0]} {vocabulary[50]}",
+    }
+    print(f"caller in {len(conversation_ids)} conversations")
+    print(f"{'query':<10} {'regex ms':>9} {'indexed ms':>11}")
+    for label, query in queries.items():
+        regex = await timed(regex_search, query.split()[0], conversation_ids, repeat=args.repeat)
+        indexed = await timed(indexed_search, query, caller, repeat=args.repeat)
+        print(f"{label:<10} {regex:>9.2f} {indexed:>11.2f}")
+
+    if not args.keep:
+        for name in ("messages", "message_terms", "conversations"):
+            await server.db[name].drop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--conversations", type=int, default=20000)
+    parser.add_argument("--caller-conversations", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--mongo-url", default="")
+    parser.add_argument("--db-name", default="messenger_bench")
+    parser.add_argument("--keep", action="store_true", help="keep the seeded corpus for the next run")
+    parser.add_argument("--mock", action="store_true", help="use mongomock-motor instead of MongoDB")
+    asyncio.run(main(parser.parse_args()))
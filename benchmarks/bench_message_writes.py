@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Message insert throughput: group commit vs one insert/update pair per message.
+
+At each concurrency level, that many senders each write --per-sender messages
+into a shared pool of conversations. "single" is the old write path
+(insert_one + update_one per message); "batched" goes through
+MessageWriteBatcher, whose conversation summary updates run on the post-commit
+pipeline after callers are released. Needs a MongoDB at MONGO_URL (backend/.env) or
+--mongo-url; --mock runs against mongomock-motor, which only shows Python-side
+overhead because it has no network round trips.
+
+    python benchmarks/bench_message_writes.py [--concurrency 1 10 100 1000]
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+def new_message(conversation_id: str) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "sender_id": "bench-sender",
+        "sender_name": "Bench",
+        "sender_avatar": None,
+        "content": "benchmark message",
+        "conversation_id": conversation_id,
+        "timestamp": datetime.utcnow(),
+        "message_type": "text",
+    }
+
+
+async def single_write(message: dict):
+    await server.db.messages.insert_one(message)
+    await server.db.conversations.update_one(
+        {"id": message["conversation_id"]},
+        {
+            "$set": {"updated_at": message["timestamp"],
+                     "last_message": server.Message(**message).model_dump()},
+            "$inc": {"message_count": 1},
+        },
+    )
+
+
+async def run(write, concurrency: int, per_sender: int, conversation_ids: list) -> dict:
+    latencies = []
+
+    async def sender(n: int):
+        for i in range(per_sender):
+            message = new_message(conversation_ids[(n + i) % len(conversation_ids)])
+            start = time.perf_counter()
+            await write(message)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(sender(n) for n in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "msgs_per_s": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000,
+    }
+
+
+async def main(args):
+    if args.mock:
+        import mongomock_motor
+        server.client = mongomock_motor.AsyncMongoMockClient()
+    elif args.mongo_url:
+        server.client = server.AsyncIOMotorClient(args.mongo_url)
+    server.db = server.client[args.db_name]
+    await server.db.messages.drop()
+    await server.db.conversations.drop()
+    await server.ensure_indexes()
+
+    conversation_ids = [str(uuid.uuid4()) for _ in range(args.conversations)]
+    await server.db.conversations.insert_many([
+        {"id": cid, "participants": [], "is_group": False, "created_at": datetime.utcnow(),
+         "updated_at": datetime.utcnow(), "message_count": 0}
+        for cid in conversation_ids
+    ])
+
+    print(f"batch size {args.batch_size}, window {args.window_ms} ms")
+    print(f"{'mode':<8} {'senders':>7} {'msgs/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'avg batch':>9}")
+    for concurrency in args.concurrency:
+        r = await run(single_write, concurrency, args.per_sender, conversation_ids)
+        print(f"{'single':<8} {concurrency:>7} {r['msgs_per_s']:>9.0f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {1:>9}")
+
+        server.message_writer = server.MessageWriteBatcher(args.batch_size, args.window_ms)
+        r = await run(server.message_writer.submit, concurrency, args.per_sender, conversation_ids)
+        await server.db_side_effects.drain()
+        avg = server.message_writer.stats()["avg_batch_size"]
+        print(f"{'batched':<8} {concurrency:>7} {r['msgs_per_s']:>9.0f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {avg:>9.1f}")
+
+    await server.db.messages.drop()
+    await server.db.conversations.drop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--per-sender", type=int, default=20)
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=server.MESSAGE_BATCH_SIZE)
+    parser.add_argument("--window-ms", type=float, default=server.MESSAGE_BATCH_WINDOW_MS)
+    parser.add_argument("--mongo-url", default="")
+    parser.add_argument("--db-name", default="messenger_bench")
+    parser.add_argument("--mock", action="store_true", help="use mongomock-motor instead of MongoDB")
+    asyncio.run(main(parser.parse_args()))
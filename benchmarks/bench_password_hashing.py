@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Event-loop lag while logins run concurrently.
+
+Compares bcrypt called inline on the event loop (the old behaviour) with the
+offloaded verify_password/get_password_hash from server.py. A ticker coroutine
+wakes every TICK seconds and records how late it was woken up; with the
+offloaded pool that lag should stay flat no matter how many logins run.
+
+    python benchmarks/bench_password_hashing.py [--concurrency 8 32 64]
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+TICK = 0.005
+
+
+async def measure_lag(stop: asyncio.Event) -> list:
+    lags = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+    return lags
+
+
+async def inline_login(password: str, hashed: str):
+    # What login did before: bcrypt directly on the event loop
+    server.pwd_context.verify(password, hashed)
+    await asyncio.sleep(0)
+
+
+async def offloaded_login(password: str, hashed: str):
+    await server.verify_password(password, hashed)
+
+
+async def run_scenario(login, concurrency: int, hashed: str) -> dict:
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(measure_lag(stop))
+    await asyncio.sleep(TICK * 4)
+
+    rejected = 0
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(login("TestPass123!", hashed) for _ in range(concurrency)),
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - start
+    for result in results:
+        if isinstance(result, server.HTTPException) and result.status_code == 503:
+            rejected += 1
+        elif isinstance(result, Exception):
+            raise result
+
+    stop.set()
+    lags = sorted(await monitor)
+    return {
+        "logins": concurrency,
+        "rejected": rejected,
+        "elapsed_s": elapsed,
+        "lag_p50_ms": statistics.median(lags) * 1000,
+        "lag_p99_ms": lags[int(len(lags) * 0.99) - 1] * 1000 if len(lags) > 1 else lags[-1] * 1000,
+        "lag_max_ms": lags[-1] * 1000,
+    }
+
+
+async def main(concurrency_levels):
+    hashed = server.pwd_context.hash("TestPass123!")
+    print(f"bcrypt pool: {server.PASSWORD_HASH_WORKERS} workers, "
+          f"max pending {server.PASSWORD_HASH_MAX_PENDING}")
+    print(f"{'mode':<10} {'logins':>6} {'503s':>5} {'total s':>8} "
+          f"{'lag p50 ms':>11} {'lag p99 ms':>11} {'lag max ms':>11}")
+    for concurrency in concurrency_levels:
+        for name, login in (("inline", inline_login), ("offloaded", offloaded_login)):
+            r = await run_scenario(login, concurrency, hashed)
+            print(f"{name:<10} {r['logins']:>6} {r['rejected']:>5} {r['elapsed_s']:>8.2f} "
+                  f"{r['lag_p50_ms']:>11.2f} {r['lag_p99_ms']:>11.2f} {r['lag_max_ms']:>11.2f}")
+    server.password_hash_executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8, 32, 64])
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+User search latency: ranked index lookups vs the old unanchored regex.
+
+Seeds --users synthetic users (1M by default) with their search keys into a
+scratch database, then times search_users and the old case-insensitive
+$regex query for a mix of exact, prefix and substring queries. Needs a
+MongoDB at MONGO_URL (backend/.env) or --mongo-url; --mock runs a small
+corpus on mongomock-motor, which has no indexes and only checks that the
+script works.
+
+    python benchmarks/bench_user_search.py [--users 1000000] [--keep]
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+from fastapi import Response  # noqa: E402
+
+SYLLABLES = ["an", "na", "ka", "mi", "ro", "le", "ta", "so", "vi", "el", "ja", "ne", "ol", "ga", "ri", "us"]
+
+
+def fake_name(rng: random.Random) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).title()
+
+
+async def seed(count: int, rng: random.Random):
+    batch = []
+    for i in range(count):
+        first, last = fake_name(rng), fake_name(rng)
+        username = f"{first.lower()}_{last.lower()}{i}"
+        display_name = f"{first} {last}"
+        batch.append({
+            "id": str(uuid.uuid4()),
+            "username": username,
+            "email": f"{username}@example.com",
+            "display_name": display_name,
+            "password_hash": "x",
+            "created_at": datetime.utcnow(),
+            **server.user_search_fields(username, display_name),
+        })
+        if len(batch) == 10000:
+            await server.db.users.insert_many(batch, ordered=False)
+            batch = []
+            print(f"  seeded {i + 1}", end="\r")
+    if batch:
+        await server.db.users.insert_many(batch, ordered=False)
+    print()
+
+
+async def regex_search(query: str):
+    return await server.db.users.find(
+        {"$or": [
+            {"username": {"$regex": query, "$options": "i"}},
+            {"display_name": {"$regex": query, "$options": "i"}},
+        ]},
+        {"password_hash": 0},
+    ).to_list(50)
+
+
+async def ranked_search(query: str, caller):
+    return await server.search_users(
+        response=Response(), query=query, after=None, limit=50,
+        boost_contacts=False, current_user=caller,
+    )
+
+
+async def timed(func, *args, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func(*args)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+async def main(args):
+    if args.mock:
+        import mongomock_motor
+        server.client = mongomock_motor.AsyncMongoMockClient()
+    elif args.mongo_url:
+        server.client = server.AsyncIOMotorClient(args.mongo_url)
+    server.db = server.client[args.db_name]
+
+    if await server.db.users.estimated_document_count() < args.users:
+        await server.db.users.drop()
+        await server.ensure_indexes()
+        print(f"seeding {args.users} users")
+        await seed(args.users, random.Random(42))
+
+    caller = await server.db.users.find_one({}, server.USER_PUBLIC_PROJECTION)
+    caller = server.UserProfile(**{"is_online": False, **caller})
+    queries = ["a", "an", "kami", "rota", "nale", "ikaro", "soviel"]
+    print(f"{'query':<8} {'regex ms':>9} {'ranked ms':>10}")
+    for query in queries:
+        regex = await timed(regex_search, query, repeat=args.repeat)
+        ranked = await timed(ranked_search, query, caller, repeat=args.repeat)
+        print(f"{query:<8} {regex:>9.2f} {ranked:>10.2f}")
+
+    if not args.keep:
+        await server.db.users.drop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--mongo-url", default="")
+    parser.add_argument("--db-name", default="messenger_bench")
+    parser.add_argument("--keep", action="store_true", help="keep the seeded users for the next run")
+    parser.add_argument("--mock", action="store_true", help="use mongomock-motor instead of MongoDB")
+    asyncio.run(main(parser.parse_args()))
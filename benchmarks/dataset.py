@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Production-shaped synthetic data.
+
+generate fills users, conversations and messages with the skew seen in
+production. Most conversations are direct chats, group sizes follow a power
+law up to --max-group, and messages follow a Zipf distribution over
+conversations, so a few hot ones hold most of the history. Conversation
+summaries, search keys and sync seqs are filled in as the server would
+write them, and groups above LARGE_GROUP_THRESHOLD keep their members in
+conversation_members. --search also builds the message search postings.
+
+tests/test_query_plans.py generates a small dataset with it to check the
+query plans of every query shape server.py issues.
+
+    python benchmarks/dataset.py generate --messages 2000000 [--search]
+"""
+
+import argparse
+import asyncio
+import itertools
+import random
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+WORDS = ("hey hi ok sure thanks lunch meeting tomorrow today tonight call later coffee deploy build "
+         "review merge ticket release weekend photo link doc sounds good great see you soon").split()
+
+
+def group_size(rng: random.Random, args) -> int:
+    if rng.random() < args.direct_ratio:
+        return 2
+    return min(args.max_group, 3 + int(rng.paretovariate(args.group_alpha) * 2))
+
+
+async def generate(args):
+    rng = random.Random(args.seed)
+    for name in ("users", "conversations", "conversation_members", "read_receipts", "messages", "message_terms",
+                 "sync_removals"):
+        await server.db[name].drop()
+    await server.ensure_indexes()
+    password_hash = await server.get_password_hash("dataset-password")
+
+    started = time.perf_counter()
+    user_ids = []
+    batch = []
+    for i in range(args.users):
+        username = f"user{i:07d}"
+        display_name = f"User {i}"
+        user_ids.append(str(uuid.uuid4()))
+        batch.append({
+            "id": user_ids[-1],
+            "username": username,
+            "email": f"{username}@example.com",
+            "display_name": display_name,
+            "password_hash": password_hash,
+            "is_online": False,
+            "created_at": datetime.utcnow(),
+            **server.user_search_fields(username, display_name),
+        })
+        if len(batch) == 10000:
+            await server.db.users.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await server.db.users.insert_many(batch, ordered=False)
+    print(f"users: {args.users} in {time.perf_counter() - started:.1f}s")
+
+    started = time.perf_counter()
+    conversations = []
+    for i in range(args.conversations):
+        participant_ids = [user_ids[j] for j in rng.sample(range(len(user_ids)), min(group_size(rng, args), len(user_ids)))]
+        conversations.append({
+            "id": str(uuid.uuid4()),
+            "participant_ids": participant_ids,
+            "member_count": len(participant_ids),
+            "created_by": participant_ids[0],
+            "is_group": len(participant_ids) > 2,
+            "group_name": f"Group {i}" if len(participant_ids) > 2 else None,
+            "message_count": 0,
+            "last_message": None,
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow(),
+            "seq": server.next_sync_seq(),
+        })
+
+    # Hot conversations: Zipf weights over a shuffled rank order
+    ranks = list(range(len(conversations)))
+    rng.shuffle(ranks)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** args.hot_skew for rank in ranks))
+    start_epoch = time.time() - args.days * 86400
+    step = args.days * 86400 / max(args.messages, 1)
+    last_messages = {}
+    counts = {}
+    messages, postings = [], []
+    for i in range(args.messages):
+        conversation = rng.choices(conversations, cum_weights=cum_weights)[0]
+        sender_id = conversation["participant_ids"][rng.randrange(conversation["member_count"])]
+        epoch = start_epoch + i * step
+        message = {
+            "id": str(uuid.uuid4()),
+            "sender_id": sender_id,
+            "sender_name": "User",
+            "sender_avatar": None,
+            "content": " ".join(rng.choices(WORDS, k=rng.randint(1, 12))),
+            "conversation_id": conversation["id"],
+            "timestamp": datetime.utcfromtimestamp(epoch),
+            "message_type": "text",
+            "seq": server.sync_seq_at(epoch) | (i & ((1 << server.SYNC_SUFFIX_BITS) - 1)),
+        }
+        messages.append(message)
+        last_messages[conversation["id"]] = message
+        counts[conversation["id"]] = counts.get(conversation["id"], 0) + 1
+        if args.search:
+            postings.extend(server.message_postings(message))
+        if len(messages) == 10000:
+            await server.db.messages.insert_many(messages, ordered=False)
+            if postings:
+                await server.insert_postings(postings)
+            messages, postings = [], []
+            print(f"  messages: {i + 1}", end="\r")
+    if messages:
+        await server.db.messages.insert_many(messages, ordered=False)
+    if postings:
+        await server.insert_postings(postings)
+    print(f"messages: {args.messages} in {time.perf_counter() - started:.1f}s")
+
+    for conversation in conversations:
+        last = last_messages.get(conversation["id"])
+        if last:
+            conversation["last_message"] = server.Message(**last).model_dump()
+            conversation["message_count"] = counts[conversation["id"]]
+            conversation["updated_at"] = last["timestamp"]
+            conversation["seq"] = max(conversation["seq"], last["seq"])
+    for conversation in conversations:
+        if conversation["member_count"] > server.LARGE_GROUP_THRESHOLD:
+            participant_ids = conversation.pop("participant_ids")
+            conversation.update(large=True, member_preview=participant_ids[:server.LARGE_GROUP_PREVIEW])
+            for i in range(0, len(participant_ids), 10000):
+                await server.insert_group_members(conversation["id"], participant_ids[i:i + 10000])
+    for i in range(0, len(conversations), 5000):
+        await server.db.conversations.insert_many(conversations[i:i + 5000], ordered=False)
+
+    sizes = sorted((c["member_count"] for c in conversations), reverse=True)
+    hottest = sorted(counts.values(), reverse=True)[:10]
+    print(f"conversations: {len(conversations)}, {sum(1 for s in sizes if s == 2)} direct, largest groups {sizes[:5]}")
+    print(f"hottest conversations hold {sum(hottest) / max(args.messages, 1):.0%} of messages: {hottest[:5]}")
+
+
+async def main(args) -> int:
+    if args.mock:
+        import mongomock_motor
+        server.client = mongomock_motor.AsyncMongoMockClient()
+    elif args.mongo_url:
+        server.client = server.AsyncIOMotorClient(args.mongo_url)
+    server.db = server.client[args.db_name]
+    await generate(args)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mongo-url", default="")
+    parser.add_argument("--db-name", default="messenger_dataset")
+    parser.add_argument("--mock", action="store_true", help="use mongomock-motor")
+    commands = parser.add_subparsers(dest="command", required=True)
+    gen = commands.add_parser("generate", help="fill the database with synthetic data")
+    gen.add_argument("--users", type=int, default=100_000)
+    gen.add_argument("--conversations", type=int, default=50_000)
+    gen.add_argument("--messages", type=int, default=2_000_000)
+    gen.add_argument("--direct-ratio", type=float, default=0.8, help="share of two-person conversations")
+    gen.add_argument("--group-alpha", type=float, default=1.1, help="Pareto shape of group sizes")
+    gen.add_argument("--max-group", type=int, default=10_000)
+    gen.add_argument("--hot-skew", type=float, default=1.1, help="Zipf exponent of messages per conversation")
+    gen.add_argument("--days", type=int, default=180)
+    gen.add_argument("--search", action="store_true", help="also build message search postings")
+    gen.add_argument("--seed", type=int, default=7)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+In-process load test for the messaging hot paths.
+
+Runs the FastAPI app in this process (httpx over ASGI, startup and shutdown
+hooks included) against mongomock-motor, or a real MongoDB with --mongo-url.
+--clients WebSocket clients are attached to the real ConnectionManager, so
+fan-out, the event bus and the per-connection writers all run as in
+production; only the socket itself is a stand-in that timestamps every frame.
+It reports throughput and p50/p95/p99 for login, send_message, end-to-end
+delivery, get_conversations and get_messages.
+
+Results can be saved as a JSON baseline and compared with a later run; any
+p95 slower, or throughput lower, than the baseline by more than --tolerance
+is reported as a regression and the script exits with status 1.
+
+    python benchmarks/load_test.py --save benchmarks/baselines/local.json
+    python benchmarks/load_test.py --compare benchmarks/baselines/local.json
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import httpx  # noqa: E402
+import orjson  # noqa: E402
+import server  # noqa: E402
+
+PASSWORD = "load-test-password"
+
+
+class TimestampingWebSocket:
+    """Records when each new_message frame reaches the socket."""
+
+    def __init__(self, delivered: dict):
+        self.delivered = delivered
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, frame: str):
+        now = time.perf_counter()
+        events = orjson.loads(frame)
+        for event in events if isinstance(events, list) else [events]:
+            if event.get("type") == "new_message":
+                self.delivered.setdefault(event["message"]["id"], []).append(now)
+
+    async def close(self, code=None):
+        pass
+
+
+def summarize(latencies: list, elapsed: float, errors: int = 0) -> dict:
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000 if latencies else 0
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "per_s": len(latencies) / elapsed if elapsed else 0,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+    }
+
+
+async def run_concurrently(count: int, concurrency: int, request) -> dict:
+    """Issue count calls of request(i) with at most concurrency in flight."""
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await request(i)
+            if response.status_code >= 400:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return summarize(latencies, time.perf_counter() - start, errors)
+
+
+async def seed(args, rng: random.Random) -> tuple:
+    """Users (sharing one password hash) and groups of --group-size members."""
+    password_hash = await server.get_password_hash(PASSWORD)
+    users = []
+    for i in range(args.users):
+        username = f"load{i:06d}"
+        users.append({
+            "id": str(uuid.uuid4()),
+            "username": username,
+            "email": f"{username}@example.com",
+            "display_name": f"Load {i}",
+            "password_hash": password_hash,
+            "created_at": datetime.utcnow(),
+            **server.user_search_fields(username, f"Load {i}"),
+        })
+    await server.db.users.insert_many(users)
+
+    user_ids = [user["id"] for user in users]
+    conversations = []
+    for i in range(args.conversations):
+        participant_ids = rng.sample(user_ids, min(args.group_size, len(user_ids)))
+        conversations.append({
+            "id": str(uuid.uuid4()),
+            "participant_ids": participant_ids,
+            "member_count": len(participant_ids),
+            "created_by": participant_ids[0],
+            "is_group": True,
+            "group_name": f"group {i}",
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow(),
+            "seq": server.next_sync_seq(),
+        })
+    await server.db.conversations.insert_many(conversations)
+    return users, conversations
+
+
+async def main(args):
+    if args.mock:
+        import mongomock_motor
+        server.client = mongomock_motor.AsyncMongoMockClient()
+    else:
+        server.client = server.AsyncIOMotorClient(args.mongo_url, event_listeners=[server.MongoCommandMetrics()])
+    server.db = server.client[args.db_name]
+    for name in ("users", "conversations", "messages", "message_terms", "sync_removals"):
+        await server.db[name].drop()
+
+    rng = random.Random(11)
+    await server.app.router.startup()
+    print(f"seeding {args.users} users, {args.conversations} groups of {args.group_size}")
+    users, conversations = await seed(args, rng)
+    tokens = {user["id"]: server.create_access_token({"sub": user["username"], "user_id": user["id"]})
+              for user in users}
+    results = {}
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://load-test") as http:
+        def auth(user_id):
+            return {"Authorization": f"Bearer {tokens[user_id]}"}
+
+        results["login"] = await run_concurrently(
+            args.logins, args.concurrency,
+            lambda i: http.post("/api/login", json={"username": users[i % len(users)]["username"],
+                                                    "password": PASSWORD}),
+        )
+
+        delivered: dict = {}
+        online = users[:args.clients]
+        for user in online:
+            await server.manager.connect(TimestampingWebSocket(delivered), user["id"], str(uuid.uuid4()),
+                                         server.WS_COALESCE_MS if args.batch else 0)
+
+        sent_at = {}
+        memberships = [(conv["id"], member) for conv in conversations for member in conv["participant_ids"]]
+
+        async def send(i):
+            conversation_id, sender_id = memberships[rng.randrange(len(memberships))]
+            start = time.perf_counter()
+            response = await http.post("/api/messages", headers=auth(sender_id),
+                                       json={"conversation_id": conversation_id, "content": f"load message {i}"})
+            if response.status_code < 400:
+                sent_at[response.json()["id"]] = (start, conversation_id)
+            return response
+
+        results["send_message"] = await run_concurrently(args.messages, args.concurrency, send)
+        await server.message_writer.drain()
+        await server.post_commit.drain()
+        await server.db_side_effects.drain()
+        await asyncio.sleep(0.5)  # let writer tasks flush their queues
+        delivery = [at - sent_at[message_id][0]
+                    for message_id, times in delivered.items() if message_id in sent_at for at in times]
+        # Every online member of a message's conversation should get one frame;
+        # frames that never arrived are counted as errors
+        online_ids = {user["id"] for user in online}
+        online_members = {conv["id"]: len(online_ids.intersection(conv["participant_ids"]))
+                          for conv in conversations}
+        expected = sum(online_members[conversation_id] for _, conversation_id in sent_at.values())
+        results["delivery"] = summarize(delivery, 1, errors=expected - len(delivery))
+        results["delivery"]["per_s"] = None
+        for connection_id, connection in list(server.manager.active_connections.items()):
+            server.manager.disconnect(connection_id, connection.user_id)
+
+        results["get_conversations"] = await run_concurrently(
+            args.reads, args.concurrency,
+            lambda i: http.get("/api/conversations", headers=auth(users[i % len(users)]["id"])),
+        )
+
+        def read_history(i):
+            conversation = conversations[i % len(conversations)]
+            return http.get(f"/api/conversations/{conversation['id']}/messages",
+                            headers=auth(conversation["participant_ids"][0]))
+
+        results["get_messages"] = await run_concurrently(args.reads, args.concurrency, read_history)
+
+    await server.app.router.shutdown()
+
+    print(f"\n{'path':<18} {'requests':>8} {'errors':>6} {'per s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, r in results.items():
+        per_s = f"{r['per_s']:.0f}" if r["per_s"] is not None else "-"
+        print(f"{name:<18} {r['requests']:>8} {r['errors']:>6} {per_s:>9} "
+              f"{r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f}")
+
+    report = {
+        "created_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "store": "mongomock" if args.mock else "mongodb",
+        "params": {k: v for k, v in vars(args).items() if k not in ("save", "compare", "mongo_url")},
+        "results": results,
+    }
+    if args.save:
+        Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.save).write_text(json.dumps(report, indent=2) + "\n")
+        print(f"\nsaved baseline to {args.save}")
+    if args.compare:
+        return compare(json.loads(Path(args.compare).read_text()), report, args.tolerance)
+    return 0
+
+
+def compare(baseline: dict, report: dict, tolerance: float) -> int:
+    if baseline["params"] != report["params"] or baseline["store"] != report["store"]:
+        print("\nwarning: baseline was recorded with different parameters or store")
+    regressions = 0
+    print(f"\n{'path':<18} {'p95 ms':>16} {'per s':>16}")
+    for name, now in report["results"].items():
+        before = baseline["results"].get(name)
+        if not before:
+            continue
+        p95_change = (now["p95_ms"] - before["p95_ms"]) / before["p95_ms"] if before["p95_ms"] else 0
+        flags = []
+        if p95_change > tolerance:
+            flags.append("p95")
+        throughput = "-"
+        if now["per_s"] is not None and before["per_s"]:
+            per_s_change = (now["per_s"] - before["per_s"]) / before["per_s"]
+            throughput = f"{per_s_change:+.1%}"
+            if per_s_change < -tolerance:
+                flags.append("throughput")
+        regressions += bool(flags)
+        print(f"{name:<18} {p95_change:>+16.1%} {throughput:>16}  {'REGRESSION: ' + ', '.join(flags) if flags else ''}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=1000, help="connected WebSocket clients")
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--group-size", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--batch", action="store_true", help="clients use coalesced (?batch=1) delivery")
+    parser.add_argument("--mongo-url", default="")
+    parser.add_argument("--db-name", default="messenger_load_test")
+    parser.add_argument("--save", default="", help="write results as a JSON baseline to this path")
+    parser.add_argument("--compare", default="", help="compare with a JSON baseline from --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown (0.2 = 20%%)")
+    args = parser.parse_args()
+    args.mock = not args.mongo_url
+    sys.exit(asyncio.run(main(args)))
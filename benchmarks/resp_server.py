@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Minimal Redis-protocol pub/sub server for local runs of the event bus.
+
+Implements just enough of RESP2 for RedisEventBus: PING, AUTH, SUBSCRIBE,
+UNSUBSCRIBE and PUBLISH. Use it in place of Redis when running several
+uvicorn workers on a development machine:
+
+    python benchmarks/resp_server.py --port 6390
+    EVENT_BUS_URL=redis://localhost:6390 uvicorn server:app --workers 4
+"""
+
+import argparse
+import asyncio
+from typing import Dict, Set
+
+
+def encode(value) -> bytes:
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode(v) for v in value)
+    raise TypeError(value)
+
+
+class RespPubSubServer:
+    def __init__(self):
+        self.subscribers: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+        self.clients: Set[asyncio.Task] = set()
+        self.server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        for task in list(self.clients):
+            task.cancel()
+        await asyncio.gather(*self.clients, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def read_command(self, reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int((await reader.readline())[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        channels: Set[bytes] = set()
+        task = asyncio.current_task()
+        self.clients.add(task)
+        try:
+            while True:
+                args = await self.read_command(reader)
+                if args is None:
+                    break
+                name = args[0].upper()
+                if name == b"PING":
+                    writer.write(b"+PONG\r\n")
+                elif name == b"AUTH":
+                    writer.write(b"+OK\r\n")
+                elif name == b"SUBSCRIBE":
+                    for channel in args[1:]:
+                        channels.add(channel)
+                        self.subscribers.setdefault(channel, set()).add(writer)
+                        writer.write(encode([b"subscribe", channel, len(channels)]))
+                elif name == b"UNSUBSCRIBE":
+                    for channel in args[1:]:
+                        channels.discard(channel)
+                        self.subscribers.get(channel, set()).discard(writer)
+                        writer.write(encode([b"unsubscribe", channel, len(channels)]))
+                elif name == b"PUBLISH":
+                    channel, payload = args[1], args[2]
+                    receivers = self.subscribers.get(channel, ())
+                    frame = encode([b"message", channel, payload])
+                    for receiver in receivers:
+                        receiver.write(frame)
+                    writer.write(encode(len(receivers)))
+                else:
+                    writer.write(b"-ERR unknown command '%s'\r\n" % name)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.clients.discard(task)
+            for channel in channels:
+                self.subscribers.get(channel, set()).discard(writer)
+            writer.close()
+
+
+async def main(host: str, port: int):
+    server = RespPubSubServer()
+    port = await server.start(host, port)
+    print(f"RESP pub/sub stand-in listening on {host}:{port}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Minimal Redis-protocol pub/sub server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    asyncio.run(main(args.host, args.port))
@@ -5,13 +5,14 @@ import Sidebar from './Sidebar';
 import ChatWindow from './ChatWindow';
 import UserSettings from './UserSettings';
 import axios from 'axios';
+import { applyConversationChanges } from '../utils/conversationUtils';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
 const Dashboard = () => {
   const { user } = useAuth();
-  const { isConnected } = useWebSocket();
+  const { isConnected, conversationChanges } = useWebSocket();
   const [activeView, setActiveView] = useState('chat');
   const [selectedConversation, setSelectedConversation] = useState(null);
   const [conversations, setConversations] = useState([]);
@@ -39,6 +40,13 @@ const Dashboard = () => {
     loadData();
   }, []);
 
+  // Apply conversation changes fetched by /sync after a reconnect
+  useEffect(() => {
+    if (conversationChanges) {
+      setConversations(prev => applyConversationChanges(prev, conversationChanges));
+    }
+  }, [conversationChanges]);
+
   const handleStartConversation = async (userId) => {
     try {
       const response = await axios.post(`${API}/conversations`, {
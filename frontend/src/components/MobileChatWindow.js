@@ -105,7 +105,7 @@ const MobileChatWindow = ({ conversation, user, onConversationUpdate, onBack })
     if (!conversation) return '';
     
     if (conversation.is_group) {
-      return `${conversation.participants.length} участников`;
+      return `${conversation.member_count || conversation.participants.length} участников`;
     } else {
       const otherParticipant = conversation.participants.find(p => p.id !== user.id);
       return otherParticipant?.is_online ? 'В сети' : 'Не в сети';
@@ -1,6 +1,9 @@
 import React, { createContext, useContext, useEffect, useState, useRef } from 'react';
+import axios from 'axios';
 import { useAuth } from './AuthContext';
 
+const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
+
 const WebSocketContext = createContext();
 
 export const useWebSocket = () => {
@@ -16,28 +19,76 @@ export const WebSocketProvider = ({ children }) => {
   const [socket, setSocket] = useState(null);
   const [isConnected, setIsConnected] = useState(false);
   const [messages, setMessages] = useState([]);
+  // Conversation changes missed while disconnected, applied by the dashboards
+  const [conversationChanges, setConversationChanges] = useState(null);
+  // Sync cursor from the last event or /sync batch; reconnects resume from it
+  const syncCursor = useRef(null);
   const reconnectTimeoutRef = useRef(null);
   const reconnectAttempts = useRef(0);
   const maxReconnectAttempts = 5;
 
+  const mergeMessages = (incoming) => {
+    setMessages(prev => {
+      const known = new Set(prev.map(msg => msg.id));
+      const fresh = incoming.filter(msg => !known.has(msg.id));
+      return fresh.length ? [...prev, ...fresh] : prev;
+    });
+  };
+
+  // Fetch everything missed since the last cursor in one small request
+  const syncMissedChanges = async () => {
+    const conversations = [];
+    const removed = [];
+    try {
+      let hasMore = true;
+      while (hasMore) {
+        const params = syncCursor.current ? { since: syncCursor.current } : {};
+        const { data } = await axios.get(`${API}/sync`, { params });
+        syncCursor.current = data.cursor;
+        hasMore = data.has_more;
+        if (data.reset) {
+          // Too far behind (or first connect): the dashboards already load everything
+          return;
+        }
+        mergeMessages(data.messages);
+        removed.push(...data.removed_conversation_ids);
+        conversations.push(...data.conversations);
+      }
+    } catch (error) {
+      console.error('Error syncing missed changes:', error);
+    }
+    if (conversations.length || removed.length) {
+      setConversationChanges({ conversations, removed });
+    }
+  };
+
   const connectWebSocket = () => {
     if (!user) return;
 
     try {
       // Get WebSocket URL from backend URL
       const wsUrl = process.env.REACT_APP_BACKEND_URL.replace('https://', 'wss://').replace('http://', 'ws://');
-      const ws = new WebSocket(`${wsUrl}/ws/${user.id}`);
+      // batch=1: events arriving together are delivered as one array frame
+      const ws = new WebSocket(`${wsUrl}/ws/${user.id}?batch=1`);
       
       ws.onopen = () => {
         console.log('WebSocket connected');
+        // Nothing is delivered until the token arrives; without it the server
+        // closes the socket. It goes in the first frame, not the URL, which
+        // ends up in access logs.
+        const token = localStorage.getItem('token');
+        if (token) {
+          ws.send(JSON.stringify({ type: 'auth', token }));
+        }
         setIsConnected(true);
         reconnectAttempts.current = 0;
+        syncMissedChanges();
       };
 
       ws.onmessage = (event) => {
         try {
           const data = JSON.parse(event.data);
-          handleMessage(data);
+          (Array.isArray(data) ? data : [data]).forEach(handleMessage);
         } catch (error) {
           console.error('Error parsing WebSocket message:', error);
         }
@@ -70,6 +121,9 @@ export const WebSocketProvider = ({ children }) => {
 
   const handleMessage = (data) => {
     console.log('WebSocket message received:', data);
+    if (data.cursor) {
+      syncCursor.current = data.cursor;
+    }
     switch (data.type) {
       case 'new_message':
         // Parse timestamp back from ISO string
@@ -122,7 +176,8 @@ export const WebSocketProvider = ({ children }) => {
     isConnected,
     messages,
     sendMessage,
-    setMessages
+    setMessages,
+    conversationChanges
   };
 
   return (
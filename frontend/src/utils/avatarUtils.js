@@ -1,12 +1,20 @@
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 
+// Smallest server-rendered thumbnail that covers the requested size
+const pickThumbnail = (thumbnails, size) => {
+  const sizes = Object.keys(thumbnails || {}).map(Number).sort((a, b) => a - b);
+  const fit = sizes.find(s => s >= size) || sizes[sizes.length - 1];
+  return fit ? thumbnails[String(fit)] : null;
+};
+
 export const getAvatarUrl = (user, size = 48) => {
   if (user?.avatar_url) {
-    // If avatar_url starts with /api, prepend backend URL
-    if (user.avatar_url.startsWith('/api')) {
-      return `${BACKEND_URL}${user.avatar_url}`;
+    const url = pickThumbnail(user.avatar_thumbnails, size) || user.avatar_url;
+    // If the url starts with /api, prepend backend URL
+    if (url.startsWith('/api')) {
+      return `${BACKEND_URL}${url}`;
     }
-    return user.avatar_url;
+    return url;
   }
   
   // Generate beautiful avatar using UI Avatars service
@@ -0,0 +1,16 @@
+// Merge a /sync batch into the conversation list: removals first, then changed
+// conversations replace their old copies, newest activity on top.
+export const applyConversationChanges = (conversations, { conversations: changed, removed }) => {
+  const removedIds = new Set(removed);
+  const byId = new Map();
+  conversations.forEach(conv => {
+    if (!removedIds.has(conv.id)) {
+      byId.set(conv.id, conv);
+    }
+  });
+  changed.forEach(conv => byId.set(conv.id, conv));
+
+  return [...byId.values()].sort(
+    (a, b) => new Date(b.updated_at) - new Date(a.updated_at)
+  );
+};
@@ -0,0 +1,108 @@
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+# Before server.py loads backend/.env: the plan checks run only against a
+# MongoDB named explicitly in the environment
+MONGO_URL = os.environ.get("MONGO_URL", "")
+
+sys.path.insert(0, str(ROOT / "backend"))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+import mongomock_motor  # noqa: E402
+import server  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture(scope="session")
+def client():
+    """One app for the whole session: shutdown stops executors that cannot be restarted."""
+    server.client = mongomock_motor.AsyncMongoMockClient()
+    server.db = server.client["messenger_test"]
+    with TestClient(server.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def api(client):
+    """The test client against an empty database with the server's indexes."""
+    server.db = server.client[f"messenger_test_{uuid.uuid4().hex}"]
+    client.portal.call(server.ensure_indexes)
+    server.clear_invalidatable_caches()
+    server.token_cache.clear()
+    yield client
+    client.portal.call(server.message_writer.drain)
+    client.portal.call(server.db_side_effects.drain)
+
+
+@pytest.fixture
+def register(api):
+    """register(name) -> (user id, auth headers)"""
+    def register(name: str):
+        response = api.post("/api/register", json={
+            "username": name,
+            "email": f"{name}@example.com",
+            "password": "secret1",
+            "display_name": name.title(),
+        })
+        assert response.status_code == 200, response.text
+        body = response.json()
+        return body["user"]["id"], {"Authorization": f"Bearer {body['access_token']}"}
+    return register
+
+
+@pytest.fixture
+def chat(api, register):
+    """chat(count) -> (conversation id, alice's headers, ids of count messages alice sent to bob)"""
+    def chat(count: int):
+        _, headers = register("alice")
+        bob, _ = register("bob")
+        conversation = api.post("/api/conversations", json={"participant_ids": [bob]}, headers=headers).json()
+        sent = []
+        for i in range(count):
+            response = api.post("/api/messages", json={"conversation_id": conversation["id"], "content": f"message {i}"},
+                                headers=headers)
+            assert response.status_code == 200, response.text
+            sent.append(response.json()["id"])
+        return conversation["id"], headers, sent
+    return chat
+
+
+@pytest.fixture
+def connect(api):
+    """connect(user_id, headers) -> a WebSocket session that has sent its auth frame"""
+    def connect(user_id: str, headers: dict):
+        websocket = api.websocket_connect(f"/ws/{user_id}")
+        websocket.__enter__()
+        token = headers["Authorization"].split()[1]
+        websocket.send_json({"type": "auth", "token": token, "client_id": "auth"})
+        assert websocket.receive_json() == {"type": "ack", "client_id": "auth"}
+        return websocket
+    return connect
+
+
+@pytest.fixture
+def avatar_dir(tmp_path, monkeypatch):
+    """Avatars go to a temporary directory, served through an empty file cache."""
+    monkeypatch.setattr(server, "AVATAR_DIR", tmp_path)
+    monkeypatch.setattr(server, "avatar_file_cache", server.FileCache(1024 * 1024, 1024))
+    return tmp_path
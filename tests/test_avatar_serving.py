@@ -0,0 +1,88 @@
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-3", (0, 3)),
+    ("bytes=3-", (3, 9)),
+    ("bytes=-4", (6, 9)),
+    ("bytes=-40", (0, 9)),
+    ("bytes=8-20", (8, 9)),
+    (" bytes = 2-4 ", (2, 4)),
+])
+def test_parse_byte_range_satisfiable(header, expected):
+    assert server.parse_byte_range(header, 10) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "bytes=5-3",
+    "bytes=--3",
+    "bytes=-",
+    "bytes=a-3",
+    "bytes=1-b",
+    "bytes=0-1,3-4",
+    "items=0-1",
+])
+def test_parse_byte_range_ignores_invalid_specs(header):
+    assert server.parse_byte_range(header, 10) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=10-", "bytes=10-20", "bytes=-0"])
+def test_parse_byte_range_rejects_unsatisfiable_ranges(header):
+    with pytest.raises(server.HTTPException) as raised:
+        server.parse_byte_range(header, 10)
+    assert raised.value.status_code == 416
+    assert raised.value.headers["Content-Range"] == "bytes */10"
+
+
+@pytest.mark.parametrize("if_none_match, matches", [
+    (None, False),
+    ("", False),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"other", "abc"', True),
+    ("*", True),
+    ('"other"', False),
+    ("abc", False),
+])
+def test_etag_matches(if_none_match, matches):
+    assert server.etag_matches(if_none_match, '"abc"') is matches
+
+
+def get_avatar(api, filename, **headers):
+    return api.get(f"/api/uploads/avatars/{filename}", headers=headers)
+
+
+def test_avatars_are_served_immutable_with_their_name_as_etag(api, avatar_dir):
+    (avatar_dir / "abc.png").write_bytes(b"0123456789")
+    response = get_avatar(api, "abc.png")
+    assert response.status_code == 200
+    assert response.content == b"0123456789"
+    assert response.headers["etag"] == '"abc"'
+    assert response.headers["cache-control"] == server.AVATAR_CACHE_CONTROL
+    assert response.headers["content-type"] == "image/png"
+    assert get_avatar(api, "abc.png", **{"If-None-Match": '"abc"'}).status_code == 304
+
+
+def test_avatars_are_not_modified_only_while_they_exist(api, avatar_dir):
+    assert get_avatar(api, "gone.png", **{"If-None-Match": '"gone"'}).status_code == 404
+
+
+def test_avatar_ranges_from_memory_and_disk(api, avatar_dir):
+    small, large = b"0123456789", bytes(range(256)) * 8
+    (avatar_dir / "small.png").write_bytes(small)
+    (avatar_dir / "large.png").write_bytes(large)
+    for filename, content in (("small.png", small), ("large.png", large)):
+        response = get_avatar(api, filename, Range="bytes=2-5")
+        assert response.status_code == 206
+        assert response.content == content[2:6]
+        assert response.headers["content-range"] == f"bytes 2-5/{len(content)}"
+        # Invalid ranges and ranges for another version are ignored
+        for headers in ({"Range": "bytes=5-2"}, {"Range": "bytes=2-5", "If-Range": '"other"'}):
+            response = get_avatar(api, filename, **headers)
+            assert (response.status_code, response.content) == (200, content)
+        response = get_avatar(api, filename, Range=f"bytes={len(content)}-")
+        assert response.status_code == 416
+        assert response.headers["content-range"] == f"bytes */{len(content)}"
+    assert server.avatar_file_cache.stats()["files"] == 1
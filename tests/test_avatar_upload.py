@@ -0,0 +1,72 @@
+import io
+
+from PIL import Image
+
+import server
+
+
+def png(size=(64, 32)) -> bytes:
+    out = io.BytesIO()
+    Image.new("RGB", size, "red").save(out, "PNG")
+    return out.getvalue()
+
+
+def upload(api, headers, content: bytes, filename="avatar.gif", content_type="text/plain"):
+    return api.post("/api/upload-avatar", files={"file": (filename, content, content_type)}, headers=headers)
+
+
+def test_uploads_are_typed_by_content_and_get_thumbnails(api, register, avatar_dir):
+    _, headers = register("alice")
+    response = upload(api, headers, png())
+    assert response.status_code == 200, response.text
+    body = response.json()
+    stem = body["avatar_url"].rsplit("/", 1)[1].removesuffix(".png")
+    assert body["avatar_url"] == f"/api/uploads/avatars/{stem}.png"
+    assert sorted(path.name for path in avatar_dir.iterdir()) == sorted(
+        [f"{stem}.png"] + [f"{stem}_{size}.webp" for size in server.AVATAR_THUMBNAIL_SIZES]
+    )
+    with Image.open(avatar_dir / f"{stem}_48.webp") as thumbnail:
+        assert thumbnail.size == (48, 48)
+    assert api.get("/api/me", headers=headers).json()["avatar_url"] == body["avatar_url"]
+    # The same image again shares the file
+    assert upload(api, headers, png()).json() == body
+
+
+def test_uploads_that_are_not_images_are_rejected(api, register, avatar_dir):
+    _, headers = register("alice")
+    response = upload(api, headers, b"<html>not an image</html>", "avatar.png", "image/png")
+    assert response.status_code == 400
+    assert response.json()["detail"] == "File must be a JPEG, PNG, GIF or WebP image"
+    response = upload(api, headers, b"\x89PNG\r\n\x1a\n" + b"\x00" * 100)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid image"
+    assert list(avatar_dir.iterdir()) == []
+
+
+def test_uploads_over_the_limit_answer_413(api, register, avatar_dir, monkeypatch):
+    monkeypatch.setattr(server, "AVATAR_MAX_BYTES", 1000)
+    monkeypatch.setattr(server, "UPLOAD_FORM_OVERHEAD", 1000)
+    _, headers = register("alice")
+    # Past the file limit, within the form's
+    assert upload(api, headers, b"\xff\xd8\xff" + b"x" * 1500).status_code == 413
+    # Past the form's limit by Content-Length
+    assert upload(api, headers, b"x" * 5000).status_code == 413
+    # Past it while streaming a body sent without a Content-Length
+    boundary = "upload-boundary"
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.jpg\"\r\n\r\n".encode()
+            + b"x" * 5000 + f"\r\n--{boundary}--\r\n".encode())
+    response = api.post("/api/upload-avatar", content=iter([body[:1000], body[1000:]]),
+                        headers={**headers, "Content-Type": f"multipart/form-data; boundary={boundary}"})
+    assert response.status_code == 413
+    assert list(avatar_dir.iterdir()) == []
+
+
+def test_uploads_need_a_multipart_file_field(api, register, avatar_dir):
+    _, headers = register("alice")
+    response = api.post("/api/upload-avatar", data={"name": "value"}, files={"other": ("a.png", png())},
+                        headers=headers)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Upload the image in the file field"
+    response = api.post("/api/upload-avatar", content=png(), headers={**headers, "Content-Type": "image/png"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Expected a multipart/form-data upload"
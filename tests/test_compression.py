@@ -0,0 +1,56 @@
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    ("", None),
+    ("gzip", "gzip"),
+    ("GZIP", "gzip"),
+    ("gzip, deflate, br", "br"),
+    ("br;q=0, gzip", "gzip"),
+    ("br; q=0.0, gzip;q=0", None),
+    ("gzip;q=bogus", None),
+    ("identity", None),
+])
+def test_choose_encoding(accept_encoding, expected, monkeypatch):
+    if server.brotli is None and expected == "br":
+        expected = "gzip"
+    assert server.choose_encoding(accept_encoding) == expected
+
+
+def test_choose_encoding_falls_back_to_gzip_without_brotli(monkeypatch):
+    monkeypatch.setattr(server, "brotli", None)
+    assert server.choose_encoding("br, gzip") == "gzip"
+    assert server.choose_encoding("br") is None
+
+
+def test_large_lists_are_compressed(api, chat):
+    conversation_id, headers, _ = chat(30)
+    response = api.get(f"/api/conversations/{conversation_id}/messages", headers={**headers, "Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert len(response.json()) == 30
+    response = api.get(f"/api/conversations/{conversation_id}/messages?limit=1",
+                       headers={**headers, "Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+    response = api.get(f"/api/conversations/{conversation_id}/messages", headers={**headers, "Accept-Encoding": ""})
+    assert "content-encoding" not in response.headers
+
+
+def test_batched_sockets_get_arrays_of_events(api, chat):
+    conversation_id, headers, _ = chat(0)
+    bob = api.get("/api/users/search", params={"query": "bob"}, headers=headers).json()[0]
+    login = api.post("/api/login", json={"username": "bob", "password": "secret1"}).json()
+    with api.websocket_connect(f"/ws/{bob['id']}?batch=1") as websocket:
+        websocket.send_json({"type": "auth", "token": login["access_token"], "client_id": "auth"})
+        assert websocket.receive_json() == [{"type": "ack", "client_id": "auth"}]
+        for i in range(3):
+            api.post("/api/messages", json={"conversation_id": conversation_id, "content": f"burst {i}"},
+                     headers=headers)
+        events = []
+        while len(events) < 3:
+            frame = websocket.receive_json()
+            assert isinstance(frame, list)
+            events += frame
+        assert [event["message"]["content"] for event in events] == ["burst 0", "burst 1", "burst 2"]
@@ -0,0 +1,66 @@
+from datetime import datetime
+
+import pytest
+
+import server
+
+
+def test_decode_cursor_round_trips_typed_values():
+    timestamp = datetime(2024, 5, 1, 12, 30, 15, 250000)
+    cursor = server.encode_cursor(timestamp, "message-id")
+    assert server.decode_cursor(cursor, datetime, str) == [timestamp, "message-id"]
+    assert server.decode_cursor(server.encode_cursor(3, "ann"), int, str) == [3, "ann"]
+
+
+@pytest.mark.parametrize("cursor, types", [
+    ("not base64!", (str,)),
+    (server.encode_cursor("a", "b"), (str,)),
+    (server.encode_cursor("a"), (str, str)),
+    (server.encode_cursor(1), (str,)),
+    (server.encode_cursor("1"), (int,)),
+    (server.encode_cursor(True), (int,)),
+    (server.encode_cursor("yesterday", "id"), (datetime, str)),
+    (server.encode_cursor(None), (datetime,)),
+])
+def test_decode_cursor_rejects_malformed_cursors(cursor, types):
+    with pytest.raises(server.HTTPException) as raised:
+        server.decode_cursor(cursor, *types)
+    assert raised.value.status_code == 400
+
+
+def test_decode_cursor_rejects_non_list_payloads():
+    cursor = server.base64.urlsafe_b64encode(b'{"a": 1}').decode()
+    with pytest.raises(server.HTTPException):
+        server.decode_cursor(cursor, str)
+
+
+def test_message_history_pages_back_without_gaps_or_repeats(api, chat):
+    conversation_id, headers, sent = chat(7)
+    seen = []
+    url = f"/api/conversations/{conversation_id}/messages?limit=3"
+    cursor = None
+    while True:
+        response = api.get(url + (f"&before={cursor}" if cursor else ""), headers=headers)
+        assert response.status_code == 200
+        # Each page is chronological; pages go back in time
+        seen = [message["id"] for message in response.json()] + seen
+        cursor = response.headers.get(server.NEXT_CURSOR_HEADER)
+        if not cursor:
+            break
+    assert seen == sent
+
+
+def test_message_history_pages_forward_from_a_cursor(api, chat):
+    conversation_id, headers, sent = chat(5)
+    oldest = api.get(f"/api/conversations/{conversation_id}/messages?limit=200", headers=headers).json()[0]
+    after = server.encode_cursor(datetime.fromisoformat(oldest["timestamp"]), oldest["id"])
+    response = api.get(f"/api/conversations/{conversation_id}/messages?limit=2&after={after}", headers=headers)
+    assert [message["id"] for message in response.json()] == sent[1:3]
+    assert response.headers.get(server.NEXT_CURSOR_HEADER)
+
+
+def test_message_history_rejects_foreign_cursors(api, chat):
+    conversation_id, headers, _ = chat(1)
+    cursor = server.encode_cursor(1, "id")
+    response = api.get(f"/api/conversations/{conversation_id}/messages?before={cursor}", headers=headers)
+    assert response.status_code == 400
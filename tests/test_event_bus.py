@@ -0,0 +1,139 @@
+import asyncio
+
+import server
+from resp_server import RespPubSubServer
+
+
+class RecordingWebSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, frame: str):
+        self.frames.append(frame)
+
+    async def close(self, code=None):
+        pass
+
+
+async def eventually(condition, timeout: float = 2):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "condition not met in time"
+        await asyncio.sleep(0.01)
+
+
+def bus_for(port: int, **kwargs) -> server.RedisEventBus:
+    bus = server.RedisEventBus(f"redis://127.0.0.1:{port}", **kwargs)
+    bus.received_frames = []
+    bus.handler = lambda channel, frame: bus.received_frames.append((channel, frame))
+    return bus
+
+
+def test_publishes_reach_subscribers_on_other_buses():
+    async def run():
+        resp = RespPubSubServer()
+        port = await resp.start()
+        first, second = bus_for(port), bus_for(port)
+        await first.start()
+        await second.start()
+        try:
+            second.subscribe("user:alice")
+            await asyncio.sleep(0.05)
+            for i in range(3):
+                first.publish("user:alice", f"frame {i}")
+            first.publish("user:bob", "not subscribed")
+            await eventually(lambda: len(second.received_frames) == 3)
+            assert second.received_frames == [("user:alice", f"frame {i}") for i in range(3)]
+            # Publishes of one loop iteration go out as one write
+            assert first.stats()["publish_batches"] == 1
+
+            second.unsubscribe("user:alice")
+            await asyncio.sleep(0.05)
+            first.publish("user:alice", "after unsubscribe")
+            await asyncio.sleep(0.05)
+            assert len(second.received_frames) == 3
+        finally:
+            await first.stop()
+            await second.stop()
+            await resp.stop()
+
+    asyncio.run(run())
+
+
+def test_drops_publishes_while_down_and_resubscribes_on_reconnect():
+    async def run():
+        resp = RespPubSubServer()
+        port = await resp.start()
+        publisher, subscriber = bus_for(port), bus_for(port)
+        await publisher.start()
+        await subscriber.start()
+        subscriber.subscribe("user:alice")
+        await asyncio.sleep(0.05)
+        await resp.stop()
+        await eventually(lambda: not publisher.stats()["connected"])
+
+        publisher.publish("user:alice", "lost")
+        await asyncio.sleep(0.01)
+        assert publisher.stats()["dropped_publishes"] == 1
+
+        resp = RespPubSubServer()
+        await resp.start(port=port)
+        try:
+            await eventually(lambda: publisher.stats()["connected"] and subscriber.stats()["connected"], timeout=5)
+            await asyncio.sleep(0.05)
+            publisher.publish("user:alice", "after reconnect")
+            await eventually(lambda: ("user:alice", "after reconnect") in subscriber.received_frames)
+            assert ("user:alice", "lost") not in subscriber.received_frames
+        finally:
+            await publisher.stop()
+            await subscriber.stop()
+            await resp.stop()
+
+    asyncio.run(run())
+
+
+def test_drops_publishes_past_the_buffer_cap():
+    async def run():
+        resp = RespPubSubServer()
+        port = await resp.start()
+        bus = bus_for(port, max_buffer_bytes=1000)
+        await bus.start()
+        try:
+            command = server._resp_command(b"PUBLISH", b"user:alice", b"x" * 300)
+            for _ in range(10):
+                bus.publish("user:alice", "x" * 300)
+            stats = bus.stats()
+            assert stats["dropped_publishes"] == 10 - 1000 // len(command)
+            assert stats["buffered_bytes"] <= 1000
+        finally:
+            await bus.stop()
+            await resp.stop()
+
+    asyncio.run(run())
+
+
+def test_connection_managers_deliver_across_workers():
+    async def run():
+        resp = RespPubSubServer()
+        port = await resp.start()
+        sender = server.ConnectionManager(server.RedisEventBus(f"redis://127.0.0.1:{port}"))
+        receiver = server.ConnectionManager(server.RedisEventBus(f"redis://127.0.0.1:{port}"))
+        await sender.bus.start()
+        await receiver.bus.start()
+        websocket = RecordingWebSocket()
+        try:
+            await receiver.connect(websocket, "alice", "connection-1")
+            await asyncio.sleep(0.05)
+            await sender.send_to_group({"type": "new_message", "content": "hi"}, ["alice", "bob"])
+            await eventually(lambda: websocket.frames)
+            assert websocket.frames == ['{"type":"new_message","content":"hi"}']
+        finally:
+            receiver.disconnect("connection-1", "alice")
+            await sender.bus.stop()
+            await receiver.bus.stop()
+            await resp.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,99 @@
+import pytest
+
+import server
+
+
+@pytest.fixture
+def small_threshold(monkeypatch):
+    monkeypatch.setattr(server, "LARGE_GROUP_THRESHOLD", 3)
+    monkeypatch.setattr(server, "LARGE_GROUP_PREVIEW", 2)
+
+
+def create_group(api, headers, member_ids):
+    response = api.post("/api/groups", json={"name": "group", "description": None, "participant_ids": member_ids},
+                        headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()["id"]
+
+
+def add(api, headers, group_id, user_ids) -> int:
+    response = api.put(f"/api/groups/{group_id}/participants", json=user_ids, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()["added"]
+
+
+def stored_group(api, group_id) -> dict:
+    return api.portal.call(server.db.conversations.find_one, {"id": group_id})
+
+
+def test_adding_members_counts_only_new_ones(api, register):
+    _, headers = register("owner")
+    users = [register(f"member{i}")[0] for i in range(3)]
+    group_id = create_group(api, headers, users[:1])
+    assert add(api, headers, group_id, users) == 2
+    assert add(api, headers, group_id, users) == 0
+    group = stored_group(api, group_id)
+    assert group["member_count"] == 4
+    # Appended in the order given, after the two founding members
+    assert group["participant_ids"][2:] == users[1:]
+
+
+def test_groups_past_the_threshold_move_members_out(api, register, small_threshold):
+    owner, headers = register("owner")
+    users = [register(f"member{i}")[0] for i in range(4)]
+    group_id = create_group(api, headers, users[:1])
+    assert add(api, headers, group_id, users) == 3
+
+    group = stored_group(api, group_id)
+    assert group["large"] is True
+    assert "participant_ids" not in group
+    assert len(group["member_preview"]) == 2
+    assert set(group["member_preview"]) <= {owner, *users}
+    assert group["member_count"] == 5
+    members = api.portal.call(server.db.conversation_members.distinct, "user_id", {"conversation_id": group_id})
+    assert set(members) == {owner, *users}
+
+    members_page = api.get(f"/api/groups/{group_id}/members", headers=headers).json()
+    assert {member["id"] for member in members_page} == {owner, *users}
+    inbox = api.get("/api/conversations", headers=headers).json()
+    assert [(conversation["id"], conversation["member_count"]) for conversation in inbox] == [(group_id, 5)]
+
+
+def test_large_group_members_can_send_and_leave(api, register, small_threshold):
+    _, headers = register("owner")
+    users = [register(f"member{i}") for i in range(4)]
+    group_id = create_group(api, headers, [user_id for user_id, _ in users])
+    member_id, member_headers = users[3]
+
+    response = api.post("/api/messages", json={"conversation_id": group_id, "content": "hi"}, headers=member_headers)
+    assert response.status_code == 200
+    assert api.delete(f"/api/groups/{group_id}/participants/{member_id}", headers=member_headers).status_code == 200
+    assert api.delete(f"/api/groups/{group_id}/participants/{member_id}", headers=headers).status_code == 404
+    response = api.get(f"/api/conversations/{group_id}/messages", headers=member_headers)
+    assert response.status_code == 403
+    assert stored_group(api, group_id)["member_count"] == 4
+
+
+def test_large_groups_get_typing_and_read_events_through_one_publish(api, register, connect, small_threshold,
+                                                                     monkeypatch):
+    owner, headers = register("owner")
+    users = [register(f"member{i}") for i in range(4)]
+    group_id = create_group(api, headers, [user_id for user_id, _ in users])
+    published = []
+    publish = server.publish_to_large_group
+    monkeypatch.setattr(server, "publish_to_large_group",
+                        lambda *args, **kwargs: published.append(args[1]["type"]) or publish(*args, **kwargs))
+    member_id, member_headers = users[0]
+    sender, receiver = connect(owner, headers), connect(member_id, member_headers)
+
+    sender.send_json({"type": "typing", "conversation_id": group_id, "client_id": "t"})
+    assert sender.receive_json() == {"type": "ack", "client_id": "t"}
+    assert receiver.receive_json() == {"type": "typing", "conversation_id": group_id, "user_id": owner,
+                                       "is_typing": True}
+    sender.send_json({"type": "mark_read", "conversation_id": group_id, "message_id": "m1", "client_id": "r"})
+    # Not the sender's own typing event, which was delivered with the receiver's
+    assert sender.receive_json() == {"type": "ack", "client_id": "r"}
+    assert receiver.receive_json()["type"] == "message_read"
+    assert published == ["typing", "message_read"]
+    sender.close()
+    receiver.close()
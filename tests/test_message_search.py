@@ -0,0 +1,46 @@
+import server
+
+
+def test_build_snippet_highlights_normalized_matches():
+    snippet, highlights = server.build_snippet("Café and coffee? Café!", {"cafe", "coffee"})
+    assert snippet == "Café and coffee? Café!"
+    assert [snippet[start:end] for start, end in highlights] == ["Café", "coffee", "Café"]
+
+
+def test_build_snippet_windows_long_messages_around_the_first_match():
+    content = "x" * 200 + " needle " + "y" * 200
+    snippet, highlights = server.build_snippet(content, {"needle"})
+    assert len(snippet) <= 2 * server.SNIPPET_CONTEXT + len("needle")
+    assert [snippet[start:end] for start, end in highlights] == ["needle"]
+
+
+def test_build_snippet_without_matches_returns_the_start():
+    snippet, highlights = server.build_snippet("z" * 500, {"needle"})
+    assert snippet == "z" * (2 * server.SNIPPET_CONTEXT)
+    assert highlights == []
+
+
+def search(api, headers, query: str, **params) -> tuple:
+    response = api.get("/api/messages/search", params={"query": query, **params}, headers=headers)
+    assert response.status_code == 200, response.text
+    return [hit["message"]["content"] for hit in response.json()], response.headers.get(server.NEXT_CURSOR_HEADER)
+
+
+def test_message_search_matches_every_term_newest_first(api, chat, register):
+    conversation_id, headers, _ = chat(0)
+    for content in ("the quick brown fox", "a lazy dog", "Quick, dog!"):
+        api.post("/api/messages", json={"conversation_id": conversation_id, "content": content}, headers=headers)
+    api.portal.call(server.message_writer.drain)
+    api.portal.call(server.db_side_effects.drain)
+
+    assert search(api, headers, "quick")[0] == ["Quick, dog!", "the quick brown fox"]
+    assert search(api, headers, "dog quick")[0] == ["Quick, dog!"]
+    page, cursor = search(api, headers, "quick", limit=1)
+    assert page == ["Quick, dog!"]
+    assert search(api, headers, "quick", limit=1, after=cursor)[0] == ["the quick brown fox"]
+
+    _, outsider = register("carol")
+    assert search(api, outsider, "quick")[0] == []
+    response = api.get("/api/messages/search", params={"query": "quick", "conversation_id": conversation_id},
+                       headers=outsider)
+    assert response.status_code == 403
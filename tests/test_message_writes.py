@@ -0,0 +1,94 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import server
+
+
+def message(i: int, client_id=None) -> dict:
+    message = {
+        "id": f"m{i}", "sender_id": "u", "sender_name": "U", "content": f"message {i}",
+        "conversation_id": "c", "timestamp": datetime.utcnow(), "message_type": "text",
+    }
+    if client_id:
+        message["client_id"] = client_id
+    return message
+
+
+def test_batch_fails_only_the_duplicate(api):
+    batcher = server.MessageWriteBatcher(max_batch=10, window_ms=20)
+
+    async def write():
+        return await asyncio.gather(
+            batcher.submit(message(1, "retry")),
+            batcher.submit(message(2, "retry")),
+            batcher.submit(message(3)),
+            batcher.submit(message(4)),
+            return_exceptions=True,
+        )
+
+    results = api.portal.call(write)
+    assert results[0] is None
+    assert isinstance(results[1], server.DuplicateKeyError)
+    assert results[2:] == [None, None]
+    assert batcher.stats()["batches"] == 1
+    assert batcher.stats()["messages"] == 3
+    stored = api.portal.call(server.db.messages.distinct, "id")
+    assert sorted(stored) == ["m1", "m3", "m4"]
+
+
+def test_duplicate_of_an_earlier_batch(api):
+    batcher = server.MessageWriteBatcher(max_batch=1)
+    api.portal.call(batcher.submit, message(1, "retry"))
+    try:
+        api.portal.call(batcher.submit, message(2, "retry"))
+    except server.DuplicateKeyError:
+        pass
+    else:
+        raise AssertionError("the second write with the same client_id was stored")
+    assert api.portal.call(server.db.messages.count_documents, {}) == 1
+
+
+def test_a_failed_insert_fails_every_waiter(api, monkeypatch):
+    async def insert_many(documents, ordered):
+        raise server.OperationFailure("not primary")
+
+    monkeypatch.setattr(server, "db", SimpleNamespace(messages=SimpleNamespace(insert_many=insert_many)))
+    batcher = server.MessageWriteBatcher(max_batch=10, window_ms=20)
+
+    async def write():
+        return await asyncio.gather(*(batcher.submit(message(i)) for i in range(3)), return_exceptions=True)
+
+    results = api.portal.call(write)
+    assert all(isinstance(result, server.OperationFailure) for result in results)
+    assert batcher.stats()["batches"] == 0
+
+
+def test_retried_send_returns_the_stored_message(api, register):
+    alice, headers = register("alice")
+    bob, _ = register("bob")
+    conversation = api.post("/api/conversations", json={"participant_ids": [bob]}, headers=headers).json()
+    body = {"conversation_id": conversation["id"], "content": "hi", "client_id": "client-1"}
+    first = api.post("/api/messages", json=body, headers=headers).json()
+    retry = api.post("/api/messages", json=body, headers=headers).json()
+    assert retry["id"] == first["id"]
+    api.portal.call(server.db_side_effects.drain)
+    stored = api.portal.call(server.db.conversations.find_one, {"id": conversation["id"]})
+    assert stored["message_count"] == 1
+    assert stored["last_message"]["id"] == first["id"]
+
+
+def test_summaries_keep_the_newest_last_message(api):
+    api.portal.call(server.db.conversations.insert_one, {"id": "c", "message_count": 0})
+    newer, older = message(2), message(1)
+    newer["content"] = "$cost"  # Not an expression
+    newer["seq"], older["seq"] = 2, 1
+    older["timestamp"] = newer["timestamp"].replace(year=2000)
+    before = server.next_sync_seq()
+    api.portal.call(server.update_conversation_summaries, [newer])
+    api.portal.call(server.update_conversation_summaries, [older])
+    stored = api.portal.call(server.db.conversations.find_one, {"id": "c"})
+    assert stored["message_count"] == 2
+    assert (stored["last_message"]["id"], stored["last_message"]["content"]) == ("m2", "$cost")
+    # Taken when the summary was written, not from the message
+    assert stored["seq"] > before
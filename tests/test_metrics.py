@@ -0,0 +1,36 @@
+import server
+
+
+def test_histograms_render_cumulative_buckets():
+    histogram = server.Histogram("test_seconds", "A test histogram.", ("path",), buckets=(0.1, 1.0))
+    server.metrics_registry.remove(histogram)
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, 'a "quoted"\npath')
+    labels = 'path="a \\"quoted\\"\\npath"'
+    assert histogram.render() == [
+        "# HELP test_seconds A test histogram.",
+        "# TYPE test_seconds histogram",
+        f'test_seconds_bucket{{{labels},le="0.1"}} 1',
+        f'test_seconds_bucket{{{labels},le="1.0"}} 3',
+        f'test_seconds_bucket{{{labels},le="+Inf"}} 4',
+        f"test_seconds_sum{{{labels}}} 6.05",
+        f"test_seconds_count{{{labels}}} 4",
+    ]
+
+
+def test_metrics_report_routes_by_template_and_live_gauges(api, chat, connect):
+    conversation_id, headers, _ = chat(1)
+    alice = api.get("/api/me", headers=headers).json()["id"]
+    websocket = connect(alice, headers)
+    api.get(f"/api/conversations/{conversation_id}/messages", headers=headers)
+
+    response = api.get("/api/metrics")
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    route = 'method="GET",route="/api/conversations/{conversation_id}/messages",status="200"'
+    assert any(line.startswith(f"messenger_http_request_duration_seconds_count{{{route}}} ") for line in lines)
+    assert not any(conversation_id in line for line in lines)
+    assert f"messenger_ws_active_connections {len(server.manager.active_connections)}" in lines
+    assert any(line.startswith('messenger_ws_users_by_connection_count{connections="1"} ') for line in lines)
+    assert any(line.startswith('messenger_post_commit_queued{pipeline="fanout"} ') for line in lines)
+    websocket.close()
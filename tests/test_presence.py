@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+import server
+
+
+def stored_user(api, user_id) -> dict:
+    return api.portal.call(server.db.users.find_one, {"id": user_id})
+
+
+def wait_until(condition, timeout: float = 2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def short_grace(monkeypatch):
+    monkeypatch.setattr(server, "PRESENCE_OFFLINE_GRACE", 0.05)
+
+
+def test_online_until_the_last_tab_closes(api, register, connect, short_grace):
+    alice, headers = register("alice")
+    first, second = connect(alice, headers), connect(alice, headers)
+    api.portal.call(server.presence.flush)
+    assert stored_user(api, alice)["is_online"] is True
+
+    first.close()
+    wait_until(lambda: len(server.manager.user_connections.get(alice, ())) == 1)
+    api.portal.call(server.presence.flush)
+    assert stored_user(api, alice)["is_online"] is True
+
+    second.close()
+    wait_until(lambda: alice not in server.manager.user_connections and alice not in server.presence.pending_offline)
+    api.portal.call(server.presence.flush)
+    user = stored_user(api, alice)
+    assert user["is_online"] is False
+    assert user["presence_workers"] == []
+
+
+def test_reconnecting_within_the_grace_period_stays_online(api, register, connect):
+    alice, headers = register("alice")
+    connect(alice, headers).close()
+    wait_until(lambda: alice in server.presence.pending_offline)
+    assert server.presence.is_online(alice)
+
+    websocket = connect(alice, headers)
+    assert alice not in server.presence.pending_offline
+    api.portal.call(server.presence.flush)
+    assert stored_user(api, alice)["is_online"] is True
+    websocket.close()
+
+
+def test_login_and_logout_leave_is_online_to_the_sockets(api, register, connect):
+    alice, headers = register("alice")
+    response = api.post("/api/login", json={"username": "alice", "password": "secret1"})
+    assert response.status_code == 200
+    assert stored_user(api, alice)["is_online"] is False
+
+    websocket = connect(alice, headers)
+    api.portal.call(server.presence.flush)
+    assert api.post("/api/logout", headers=headers).status_code == 200
+    # Another tab's socket is still open
+    assert stored_user(api, alice)["is_online"] is True
+    websocket.close()
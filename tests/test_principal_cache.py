@@ -0,0 +1,68 @@
+import server
+
+
+def test_ttl_cache_expires_entries(clock):
+    cache = server.TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    clock.now += 6
+    assert cache.get("a") is None
+    assert cache.stats() == {"size": 0, "hits": 1, "misses": 1}
+
+
+def test_ttl_cache_caps_per_entry_ttl(clock):
+    cache = server.TTLCache(maxsize=10, ttl=5)
+    cache.set("short", 1, ttl=1)
+    cache.set("long", 2, ttl=60)
+    clock.now += 2
+    assert cache.get("short") is None
+    assert cache.get("long") == 2
+    clock.now += 4
+    assert cache.get("long") is None
+
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    cache = server.TTLCache(maxsize=2, ttl=5)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_ttl_cache_pop_and_clear():
+    cache = server.TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.pop("a")
+    cache.pop("missing")
+    assert cache.get("a") is None
+    cache.clear()
+    assert cache.get("b") is None
+
+
+def test_principal_cache_skips_the_database_once_warm(api, register):
+    user_id, headers = register("alice")
+    assert api.get("/api/me", headers=headers).status_code == 200
+    token = headers["Authorization"].split()[1]
+    assert server.token_cache.get(token)["user_id"] == user_id
+    assert server.profile_cache.get(user_id).username == "alice"
+
+
+def test_profile_changes_are_not_served_from_the_cache(api, register):
+    _, headers = register("alice")
+    api.get("/api/me", headers=headers)
+    response = api.put("/api/me", json={"display_name": "Alice Liddell"}, headers=headers)
+    assert response.status_code == 200, response.text
+    assert api.get("/api/me", headers=headers).json()["display_name"] == "Alice Liddell"
+
+
+def test_expired_tokens_are_rejected_even_when_cached(api, register, monkeypatch):
+    _, headers = register("alice")
+    assert api.get("/api/me", headers=headers).status_code == 200
+    token = headers["Authorization"].split()[1]
+    claims = server.token_cache.get(token)
+    monkeypatch.setattr(server.time, "time", lambda: claims["exp"] + 1)
+    assert api.get("/api/me", headers=headers).status_code == 401
@@ -0,0 +1,180 @@
+"""
+Query plans for every query shape server.py issues, explained against a small
+generated dataset (benchmarks/dataset.py) with values taken from it. A shape
+fails if its winning plan contains a COLLSCAN or an in-memory SORT stage. It
+needs a real MongoDB, because mongomock-motor has no query planner, so the
+module is skipped unless MONGO_URL is set. Add a shape here when a route gains
+a new query.
+"""
+
+import argparse
+import asyncio
+import os
+from datetime import datetime
+
+import pytest
+
+import dataset
+import server
+from tests.conftest import MONGO_URL
+
+pytestmark = pytest.mark.skipif(not MONGO_URL, reason="set MONGO_URL to a MongoDB to check query plans")
+
+PLAN_CHECK_DB = os.environ.get("PLAN_CHECK_DB", "messenger_plan_check")
+DATASET = argparse.Namespace(
+    users=3000, conversations=1500, messages=20000, direct_ratio=0.8, group_alpha=1.1, max_group=1000,
+    hot_skew=1.1, days=30, search=True, seed=7,
+)
+
+
+def query_shapes(sample: dict) -> list:
+    """(name, explain command body) for every query shape in server.py."""
+    user_id, username = sample["user_id"], sample["username"]
+    conversation_id, conversation_ids = sample["conversation_id"], sample["conversation_ids"]
+    member_ids, message = sample["member_ids"], sample["message"]
+    small_group = f"participant_ids.{server.PRESENCE_MAX_GROUP_SIZE}"
+    inbox_keyset = server.keyset_filter("updated_at", message["timestamp"], conversation_id, "$lt")
+    history_keyset = server.keyset_filter("timestamp", message["timestamp"], message["id"], "$lt")
+    postings_keyset = server.keyset_filter("timestamp", message["timestamp"], message["id"], "$lt",
+                                           id_field="message_id")
+
+    def find(collection, query, sort=None, limit=None):
+        command = {"find": collection, "filter": query}
+        if sort:
+            command["sort"] = sort
+        if limit:
+            command["limit"] = limit
+        return command
+
+    def update(collection, query):
+        return {"update": collection, "updates": [{"q": query, "u": {"$set": {"explain_probe": 1}}}]}
+
+    return [
+        ("auth/login by username", find("users", {"username": username}, limit=1)),
+        ("register duplicate check", find("users", {"$or": [{"username": username},
+                                                            {"email": f"{username}@example.com"}]}, limit=1)),
+        ("user update by id", update("users", {"id": user_id})),
+        ("users list", find("users", {"id": {"$ne": user_id, "$gt": ""}}, {"id": 1}, 100)),
+        ("user search exact", find("users", {"search_tokens": "user"}, {"username": 1}, 50)),
+        ("user search prefix", find("users", {"search_prefixes": "use", "username": {"$gt": username}},
+                                    {"username": 1}, 50)),
+        ("user search substring", find("users", {"search_grams": "ser"}, {"username": 1}, 50)),
+        ("presence entries of a worker", {"distinct": "users", "key": "id",
+                                          "query": {"presence_workers": server.WORKER_ID}}),
+        ("expired presence workers", find("presence_workers", {"expires_at": {"$lt": message["timestamp"]}})),
+        ("hydrate participants", find("users", {"id": {"$in": member_ids}})),
+        ("group members page", find("users", {"id": {"$in": member_ids}}, {"id": 1})),
+        ("conversation by id", find("conversations", {"id": conversation_id}, limit=1)),
+        ("inbox first page", find("conversations", {"participant_ids": user_id},
+                                  {"updated_at": -1, "id": -1}, 100)),
+        ("inbox next page", find("conversations", {"participant_ids": user_id, **inbox_keyset},
+                                 {"updated_at": -1, "id": -1}, 100)),
+        ("contacts", find("conversations", {"participant_ids": user_id, small_group: {"$exists": False}},
+                          {"updated_at": -1}, 500)),
+        ("presence contacts", find("conversations", {"participant_ids": {"$in": member_ids},
+                                                     small_group: {"$exists": False}})),
+        ("direct chat lookup", find("conversations", {"is_group": False,
+                                                      "participant_ids": {"$all": member_ids[:2], "$size": 2}},
+                                    limit=1)),
+        ("my conversation ids", {"distinct": "conversations", "key": "id",
+                                 "query": {"participant_ids": user_id}}),
+        ("summary update", update("conversations", {"id": conversation_id, "$or": [
+            {"last_message": None}, {"last_message.timestamp": {"$lte": message["timestamp"]}}]})),
+        ("add participant", update("conversations", {"id": conversation_id, "large": {"$ne": True}})),
+        ("my large groups", {"distinct": "conversation_members", "key": "conversation_id",
+                             "query": {"user_id": user_id}}),
+        ("large inbox", find("conversations", {"id": {"$in": conversation_ids}, **inbox_keyset})),
+        ("large group members", find("conversation_members", {"conversation_id": conversation_id})),
+        ("remove large group member", update("conversation_members",
+                                             {"conversation_id": conversation_id, "user_id": user_id})),
+        ("read receipt", update("read_receipts", {"conversation_id": conversation_id, "user_id": user_id})),
+        ("history first page", find("messages", {"conversation_id": conversation_id},
+                                    {"timestamp": -1, "id": -1}, 50)),
+        ("history next page", find("messages", {"conversation_id": conversation_id, **history_keyset},
+                                   {"timestamp": -1, "id": -1}, 50)),
+        ("message by id", find("messages", {"id": message["id"]}, limit=1)),
+        ("message retry by client_id", find("messages", {"sender_id": message["sender_id"], "client_id": "probe"},
+                                            limit=1)),
+        ("search hits by id", find("messages", {"id": {"$in": [message["id"]]}})),
+        ("search postings", find("message_terms", {"term": "coffee", "conversation_id": {"$in": conversation_ids}},
+                                 {"timestamp": -1, "message_id": -1})),
+        ("search postings next page", find("message_terms", {"term": "coffee",
+                                                             "conversation_id": {"$in": conversation_ids},
+                                                             **postings_keyset},
+                                           {"timestamp": -1, "message_id": -1})),
+        ("sync conversations", find("conversations", {"participant_ids": user_id, "seq": {"$gt": message["seq"]}},
+                                    {"seq": 1}, 501)),
+        ("sync messages", find("messages", {"conversation_id": {"$in": conversation_ids},
+                                            "seq": {"$gt": message["seq"]}}, {"seq": 1}, 501)),
+        ("sync removals", find("sync_removals", {"user_id": user_id, "seq": {"$gt": message["seq"]}},
+                               {"seq": 1}, 501)),
+    ]
+
+
+def plan_stages(plan) -> list:
+    """Every stage name in a winning plan, classic or slot-based engine."""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(plan_stages(item))
+    return stages
+
+
+async def explain_all() -> tuple:
+    """({shape name: winning plan stages}, index problems)"""
+    saved = server.client, server.db
+    server.client = server.AsyncIOMotorClient(MONGO_URL)
+    server.db = server.client[PLAN_CHECK_DB]
+    try:
+        await dataset.generate(DATASET)
+        problems = await server.ensure_indexes()
+        # The busiest member of a busy conversation makes the plans most telling
+        conversation = await server.db.conversations.find_one({"is_group": True}, sort=[("message_count", -1)])
+        member_ids = server.listed_member_ids(conversation)
+        user = await server.db.users.find_one({"id": member_ids[0]})
+        sample = {
+            "user_id": user["id"],
+            "username": user["username"],
+            "conversation_id": conversation["id"],
+            "conversation_ids": await server.member_conversation_ids(user["id"]),
+            "member_ids": member_ids[:100],
+            "message": await server.db.messages.find_one({"conversation_id": conversation["id"]}),
+        }
+        plans = {}
+        for name, command in query_shapes(sample):
+            explained = await server.db.command({"explain": command, "verbosity": "queryPlanner"})
+            plans[name] = plan_stages(explained["queryPlanner"]["winningPlan"])
+        return plans, problems
+    finally:
+        await server.client.drop_database(PLAN_CHECK_DB)
+        server.client.close()
+        server.client, server.db = saved
+
+
+@pytest.fixture(scope="module")
+def explained():
+    return asyncio.run(explain_all())
+
+
+# Names only; the values are filled in from the generated data
+SHAPE_NAMES = [name for name, _ in query_shapes({
+    "user_id": "u", "username": "u", "conversation_id": "c", "conversation_ids": ["c"], "member_ids": ["u", "v"],
+    "message": {"id": "m", "sender_id": "u", "timestamp": datetime(2024, 1, 1), "seq": 0},
+})]
+
+
+def test_indexes_match_specs(explained):
+    _, problems = explained
+    assert problems == []
+
+
+@pytest.mark.parametrize("name", SHAPE_NAMES)
+def test_query_shape_uses_an_index(explained, name):
+    plans, _ = explained
+    bad = [stage for stage in plans[name] if stage in ("COLLSCAN", "SORT")]
+    assert not bad, f"{name}: {' <- '.join(plans[name])}"
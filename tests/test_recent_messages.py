@@ -0,0 +1,133 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import server
+from resp_server import RespPubSubServer
+
+
+def message(i: int, conversation_id: str = "c", content: str = "hello") -> server.Message:
+    return server.Message(
+        id=f"m{i:03d}", sender_id="u", sender_name="U", content=content, conversation_id=conversation_id,
+        timestamp=datetime(2024, 1, 1) + timedelta(seconds=i),
+    )
+
+
+def test_recent_messages_miss_until_loaded():
+    buffer = server.RecentMessageBuffer(per_conversation=5)
+    assert buffer.page("c", 5) is None
+    buffer.start_loading("c")
+    assert buffer.page("c", 5) is None
+    buffer.finish_loading("c", [message(1), message(2)])
+    assert [m.id for m in buffer.page("c", 5)] == ["m001", "m002"]
+
+
+def test_recent_messages_keep_messages_added_while_loading():
+    buffer = server.RecentMessageBuffer(per_conversation=5)
+    buffer.start_loading("c")
+    # Committed after the load's query ran, delivered before it returned
+    buffer.add(message(3))
+    buffer.finish_loading("c", [message(1), message(2)])
+    assert [m.id for m in buffer.page("c", 5)] == ["m001", "m002", "m003"]
+
+
+def test_recent_messages_ignore_duplicates_and_out_of_order_delivery():
+    buffer = server.RecentMessageBuffer(per_conversation=5)
+    buffer.start_loading("c")
+    buffer.finish_loading("c", [message(1), message(3)])
+    buffer.add(message(2))
+    buffer.add(message(3))
+    assert [m.id for m in buffer.page("c", 5)] == ["m001", "m002", "m003"]
+
+
+def test_recent_messages_do_not_cache_a_load_popped_meanwhile():
+    buffer = server.RecentMessageBuffer(per_conversation=5)
+    buffer.start_loading("c")
+    buffer.pop("c")
+    buffer.finish_loading("c", [message(1)])
+    assert buffer.page("c", 5) is None
+    buffer.start_loading("c")
+    buffer.clear()
+    buffer.finish_loading("c", [message(1)])
+    assert buffer.page("c", 5) is None
+    assert buffer.stats()["bytes"] == 0
+
+
+def test_recent_messages_only_buffer_loaded_conversations():
+    buffer = server.RecentMessageBuffer(per_conversation=5)
+    buffer.add(message(1))
+    assert buffer.page("c", 5) is None
+    assert buffer.stats()["conversations"] == 0
+
+
+def test_recent_messages_keep_the_newest_per_conversation():
+    buffer = server.RecentMessageBuffer(per_conversation=3)
+    buffer.start_loading("c")
+    buffer.finish_loading("c", [message(i) for i in range(3)])
+    buffer.add(message(3))
+    assert [m.id for m in buffer.page("c", 10)] == ["m001", "m002", "m003"]
+    assert buffer.stats()["bytes"] == 3 * (len("hello") + server.RECENT_MESSAGE_OVERHEAD_BYTES)
+
+
+def test_recent_messages_evict_least_recently_used_conversations():
+    per_message = len("hello") + server.RECENT_MESSAGE_OVERHEAD_BYTES
+    buffer = server.RecentMessageBuffer(per_conversation=5, max_bytes=3 * per_message)
+    for conversation_id, first in (("a", 0), ("b", 10)):
+        buffer.start_loading(conversation_id)
+        buffer.finish_loading(conversation_id, [message(first, conversation_id)])
+    buffer.page("a", 5)
+    buffer.start_loading("c")
+    buffer.finish_loading("c", [message(20, "c"), message(21, "c")])
+    assert buffer.page("b", 5) is None
+    assert buffer.page("a", 5) is not None
+    assert buffer.stats()["bytes"] == 3 * per_message
+
+
+def test_recent_messages_expire(clock):
+    buffer = server.RecentMessageBuffer(per_conversation=5, ttl=5)
+    buffer.start_loading("c")
+    buffer.finish_loading("c", [message(1)])
+    clock.now += 6
+    assert buffer.page("c", 5) is None
+    assert buffer.stats()["bytes"] == 0
+
+
+def test_bus_gaps_clear_every_invalidatable_cache():
+    server.membership_cache.set("conversation", {"member_ids": frozenset()})
+    server.profile_cache.set("user", {"id": "user"})
+    server.recent_messages.start_loading("c")
+    server.recent_messages.finish_loading("c", [message(1)])
+    server.manager.bus.gap_handler()
+    assert server.membership_cache.get("conversation") is None
+    assert server.profile_cache.get("user") is None
+    assert server.recent_messages.page("c", 5) is None
+
+
+def test_workers_that_drop_publishes_make_the_others_clear_their_caches():
+    async def run():
+        resp = RespPubSubServer()
+        port = await resp.start()
+        dropping = server.RedisEventBus(f"redis://127.0.0.1:{port}", max_buffer_bytes=200)
+        other = server.RedisEventBus(f"redis://127.0.0.1:{port}")
+        other.handler = lambda channel, frame: None
+        await dropping.start()
+        await other.start()
+        try:
+            await asyncio.sleep(0.05)
+            other.gap_handler = server.clear_invalidatable_caches
+            server.recent_messages.start_loading("c")
+            server.recent_messages.finish_loading("c", [message(1)])
+            dropping.publish(server.RECENT_MESSAGES_CHANNEL, "x" * 500)
+            assert dropping.stats()["dropped_publishes"] == 1
+            # Announced with the next publish that goes out
+            dropping.publish(server.RECENT_MESSAGES_CHANNEL, "{}")
+            deadline = asyncio.get_running_loop().time() + 2
+            while server.recent_messages.page("c", 5) is not None:
+                assert asyncio.get_running_loop().time() < deadline, "gap was not announced"
+                await asyncio.sleep(0.01)
+            assert other.stats()["gaps"] == 2  # Its own connect, then the announcement
+        finally:
+            await dropping.stop()
+            await other.stop()
+            await resp.stop()
+
+    asyncio.run(run())
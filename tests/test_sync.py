@@ -0,0 +1,49 @@
+import time
+
+import pytest
+
+import server
+
+
+def test_sync_pages_through_every_change(api, chat):
+    conversation_id, headers, sent = chat(5)
+    cursor = server.encode_cursor(server.sync_seq_at(time.time() - 60))
+    messages, conversations = set(), set()
+    for _ in range(10):
+        batch = api.get(f"/api/sync?since={cursor}&limit=2", headers=headers).json()
+        assert len(batch["messages"]) <= 2
+        messages.update(message["id"] for message in batch["messages"])
+        conversations.update(conversation["id"] for conversation in batch["conversations"])
+        cursor = batch["cursor"]
+        if not batch["has_more"]:
+            break
+    else:
+        pytest.fail("sync never reported has_more=False")
+    assert messages == set(sent)
+    assert conversations == {conversation_id}
+
+
+def test_sync_resets_without_a_usable_cursor(api, register):
+    _, headers = register("alice")
+    assert api.get("/api/sync", headers=headers).json()["reset"] is True
+    expired = server.encode_cursor(server.sync_seq_at(time.time() - (server.SYNC_RETENTION_DAYS + 1) * 86400))
+    assert api.get(f"/api/sync?since={expired}", headers=headers).json()["reset"] is True
+    assert api.get(f"/api/sync?since={server.encode_cursor('x')}", headers=headers).status_code == 400
+
+
+def test_summaries_written_after_a_sync_are_found_by_the_next(api, chat):
+    conversation_id, headers, _ = chat(0)
+    old_seq = server.sync_seq_at(time.time() - 60)
+    api.portal.call(server.db.conversations.update_one, {"id": conversation_id}, {"$set": {"seq": old_seq}})
+    cursor = api.get("/api/sync", headers=headers).json()["cursor"]
+    # A message whose seq was taken before the cursor, with its summary
+    # written only after the sync
+    message = {
+        "id": "m1", "sender_id": "u", "sender_name": "U", "content": "late", "conversation_id": conversation_id,
+        "timestamp": server.datetime.utcnow(), "message_type": "text",
+        "seq": old_seq + 1,
+    }
+    api.portal.call(server.update_conversation_summaries, [message])
+    batch = api.get(f"/api/sync?since={cursor}", headers=headers).json()
+    assert [conversation["id"] for conversation in batch["conversations"]] == [conversation_id]
+    assert batch["conversations"][0]["last_message"]["content"] == "late"
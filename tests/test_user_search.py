@@ -0,0 +1,61 @@
+import server
+
+
+def test_user_search_fields_index_name_and_handle_parts():
+    fields = server.user_search_fields("Zoë_smith", "Zoë Smith")
+    assert fields["search_tokens"] == ["smith", "zoe", "zoe smith", "zoe_smith"]
+    assert {"z", "zo", "zoe", "s", "smi"} <= set(fields["search_prefixes"])
+    assert {"zoe", "mit", "ith"} <= set(fields["search_grams"])
+
+
+def search(api, headers, query: str, **params) -> tuple:
+    response = api.get("/api/users/search", params={"query": query, **params}, headers=headers)
+    assert response.status_code == 200, response.text
+    return [user["username"] for user in response.json()], response.headers.get(server.NEXT_CURSOR_HEADER)
+
+
+def test_user_search_ranks_exact_then_prefix_then_substring(api, register):
+    _, headers = register("searcher")
+    for name in ("joanna", "annabel", "ann", "bob"):
+        register(name)
+    assert search(api, headers, "ANN")[0] == ["ann", "annabel", "joanna"]
+    # Within a tier by username; substring matching needs a trigram
+    assert search(api, headers, "an")[0] == ["ann", "annabel"]
+
+
+def test_user_search_pages_across_tiers(api, register):
+    _, headers = register("searcher")
+    for name in ("joanna", "annabel", "ann", "annie"):
+        register(name)
+    found, cursor = search(api, headers, "ann", limit=1)
+    while cursor:
+        page, cursor = search(api, headers, "ann", limit=1, after=cursor)
+        found += page
+    assert found == ["ann", "annabel", "annie", "joanna"]
+
+
+def test_user_search_boosts_contacts_within_each_tier(api, register):
+    _, headers = register("searcher")
+    register("annabel")
+    annie, _ = register("annie")
+    api.post("/api/conversations", json={"participant_ids": [annie]}, headers=headers)
+    assert search(api, headers, "ann")[0] == ["annabel", "annie"]
+    assert search(api, headers, "ann", boost_contacts=True)[0] == ["annie", "annabel"]
+
+
+def test_user_search_rejects_out_of_range_tiers(api, register):
+    _, headers = register("searcher")
+    for tier in (-1, 3, 99):
+        response = api.get("/api/users/search", params={"query": "ann", "after": server.encode_cursor(tier, "a")},
+                           headers=headers)
+        assert response.status_code == 400
+
+
+def test_user_search_substring_tier_needs_the_whole_query(api, register):
+    _, headers = register("searcher")
+    # Every trigram of "anna", but not "anna" itself
+    for i in range(5):
+        register(f"annxnna{i}")
+    register("joanna")
+    assert search(api, headers, "anna")[0] == ["joanna"]
+    assert search(api, headers, "anna", limit=1) == (["joanna"], server.encode_cursor(2, "joanna"))
@@ -0,0 +1,103 @@
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+import server
+
+
+def token_of(headers: dict) -> str:
+    return headers["Authorization"].split()[1]
+
+
+def assert_closed_with_policy_violation(websocket):
+    with pytest.raises(WebSocketDisconnect) as closed:
+        websocket.receive_json()
+    assert closed.value.code == 1008
+
+
+def test_sockets_get_nothing_until_they_authenticate(api, register):
+    alice, headers = register("alice")
+    with api.websocket_connect(f"/ws/{alice}") as websocket:
+        websocket.send_json({"type": "typing", "conversation_id": "c", "client_id": "early"})
+        assert websocket.receive_json() == {
+            "type": "error", "client_id": "early", "status": 401, "detail": "Send an auth frame to send commands"
+        }
+        assert alice not in server.manager.user_connections
+        assert not server.presence.is_online(alice)
+
+        websocket.send_json({"type": "auth", "token": token_of(headers), "client_id": "auth"})
+        assert websocket.receive_json() == {"type": "ack", "client_id": "auth"}
+        assert alice in server.manager.user_connections
+
+
+def test_sockets_without_an_auth_frame_are_closed(api, register, monkeypatch):
+    monkeypatch.setattr(server, "WS_AUTH_TIMEOUT", 0.05)
+    alice, _ = register("alice")
+    with api.websocket_connect(f"/ws/{alice}") as websocket:
+        assert_closed_with_policy_violation(websocket)
+
+
+def test_a_token_for_another_user_closes_the_socket(api, register):
+    alice, _ = register("alice")
+    _, bob_headers = register("bob")
+    with api.websocket_connect(f"/ws/{alice}") as websocket:
+        websocket.send_json({"type": "auth", "token": token_of(bob_headers)})
+        assert_closed_with_policy_violation(websocket)
+
+
+def test_failed_commands_answer_with_error_frames(api, register, connect):
+    alice, headers = register("alice")
+    websocket = connect(alice, headers)
+    websocket.send_text("{not json")
+    assert websocket.receive_json() == {"type": "error", "status": 400, "detail": "Invalid JSON"}
+    websocket.send_json({"type": "shout", "client_id": "c1"})
+    error = websocket.receive_json()
+    assert (error["client_id"], error["status"]) == ("c1", 422)
+    websocket.send_json({"type": "typing", "conversation_id": "missing", "client_id": "c2"})
+    assert websocket.receive_json() == {
+        "type": "error", "client_id": "c2", "status": 404, "detail": "Conversation not found"
+    }
+    websocket.close()
+
+
+def test_retried_sends_are_acked_with_the_stored_message(api, chat, connect):
+    conversation_id, headers, _ = chat(0)
+    alice = api.get("/api/me", headers=headers).json()["id"]
+    websocket = connect(alice, headers)
+    command = {"type": "send_message", "conversation_id": conversation_id, "content": "hi", "client_id": "c1"}
+    websocket.send_json(command)
+    frames = [websocket.receive_json() for _ in range(2)]
+    assert sorted(frame["type"] for frame in frames) == ["ack", "new_message"]
+    ack, = [frame for frame in frames if frame["type"] == "ack"]
+    # The retry is only acked: the message was already delivered
+    websocket.send_json(command)
+    retry = websocket.receive_json()
+    assert (retry["type"], retry["message"]["id"]) == ("ack", ack["message"]["id"])
+
+    websocket.send_json({**command, "content": "something else"})
+    assert websocket.receive_json() == {
+        "type": "error", "client_id": "c1", "status": 409,
+        "detail": "client_id was already used for another message"
+    }
+    websocket.close()
+
+
+def test_commands_use_the_current_profile(api, chat, connect):
+    conversation_id, headers, _ = chat(0)
+    alice = api.get("/api/me", headers=headers).json()["id"]
+    websocket = connect(alice, headers)
+    assert api.put("/api/me", json={"display_name": "Alice Renamed"}, headers=headers).status_code == 200
+    websocket.send_json({"type": "send_message", "conversation_id": conversation_id, "content": "hi",
+                         "client_id": "c1"})
+    frames = [websocket.receive_json() for _ in range(2)]
+    ack, = [frame for frame in frames if frame["type"] == "ack"]
+    assert ack["message"]["sender_name"] == "Alice Renamed"
+    websocket.close()
+
+
+def test_commands_after_the_token_expires_close_the_socket(api, register, connect, monkeypatch):
+    alice, headers = register("alice")
+    websocket = connect(alice, headers)
+    claims = server.token_cache.get(token_of(headers))
+    monkeypatch.setattr(server.time, "time", lambda: claims["exp"] + 1)
+    websocket.send_json({"type": "typing", "conversation_id": "c"})
+    assert_closed_with_policy_violation(websocket)